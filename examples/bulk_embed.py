@@ -0,0 +1,53 @@
+import argparse
+import json
+from typing import List
+
+from research_town.utils.bulk_embed import bulk_embed
+from research_town.utils.retriever import DEFAULT_RETRIEVER_MODEL
+
+
+def load_texts(file_paths: List[str], field: str) -> List[str]:
+    # files in the PaperDB / ProfileDB json format: {pk: record}
+    texts: List[str] = []
+    for file_path in file_paths:
+        with open(file_path, 'r') as f:
+            records = json.load(f)
+        texts.extend(record[field] for record in records.values() if record.get(field))
+    return texts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Embed a paper or profile corpus into an embedding cache. '
+        'Rerunning after an interruption only embeds what is missing.'
+    )
+    parser.add_argument('files', nargs='+', help='e.g. ../data/paper_data/*.json')
+    parser.add_argument('--cache_dir', type=str, required=True)
+    parser.add_argument('--field', type=str, default='abstract')
+    parser.add_argument('--model_name', type=str, default=DEFAULT_RETRIEVER_MODEL)
+    parser.add_argument('--num_workers', type=int, default=None)
+    parser.add_argument('--num_threads', type=int, default=None)
+    parser.add_argument('--chunk_size', type=int, default=256)
+    parser.add_argument(
+        '--cache_token_ids',
+        action='store_true',
+        help='also store token ids, so that re-embedding skips tokenization',
+    )
+    args = parser.parse_args()
+
+    stats = bulk_embed(
+        load_texts(args.files, args.field),
+        args.cache_dir,
+        model_name=args.model_name,
+        num_workers=args.num_workers,
+        num_threads=args.num_threads,
+        chunk_size=args.chunk_size,
+        cache_token_ids=args.cache_token_ids,
+    )
+    for pid, worker in sorted(stats.items()):
+        print(
+            f'worker {pid}: {int(worker["embedded"])} texts, '
+            f'{worker["texts_per_sec"]:.2f} texts/sec, '
+            f'{worker["tokenize_seconds"]:.2f}s tokenizing, '
+            f'{worker["model_seconds"]:.2f}s in the model'
+        )
@@ -1,4 +1,4 @@
-from typing import List, Literal
+from typing import List, Literal, Optional
 
 from ..configs import Config
 from ..data import Profile, Proposal
@@ -20,50 +20,140 @@ class AgentManager:
             model_name=self.config.param.base_llm,
         )
 
-    def find_agents(self, role: Role, query: str, num: int = 1) -> List[Agent]:
-        profiles = self.profile_db.match(query=query, role=role, num=num)
+    def find_agents(
+        self,
+        role: Role,
+        query: str,
+        num: int = 1,
+        mmr_lambda: Optional[float] = None,
+    ) -> List[Agent]:
+        profiles = self.profile_db.match(
+            query=query, role=role, num=num, mmr_lambda=mmr_lambda
+        )
         return [self.create_agent(profile, role) for profile in profiles]
 
+    def find_agents_batch(
+        self,
+        role: Role,
+        queries: List[str],
+        num: int = 1,
+        mmr_lambda: Optional[float] = None,
+    ) -> List[List[Agent]]:
+        profiles_list = self.profile_db.match_many(
+            queries=queries, role=role, num=num, mmr_lambda=mmr_lambda
+        )
+        return [
+            [self.create_agent(profile, role) for profile in profiles]
+            for profiles in profiles_list
+        ]
+
     def sample_agents(self, role: Role, num: int = 1) -> List[Agent]:
         profiles = self.profile_db.sample(role=role, num=num)
         return [self.create_agent(profile, role) for profile in profiles]
 
+    def _get_mmr_lambda(self, mmr_lambda: Optional[float]) -> Optional[float]:
+        return self.config.param.mmr_lambda if mmr_lambda is None else mmr_lambda
+
     # Specific methods for roles
-    def find_leader(self, task: str) -> Agent:
-        agents = self.find_agents(role='leader', query=task, num=1)
+    def find_leader(self, task: str, mmr_lambda: Optional[float] = None) -> Agent:
+        agents = self.find_agents(
+            role='leader',
+            query=task,
+            num=1,
+            mmr_lambda=self._get_mmr_lambda(mmr_lambda),
+        )
         assert agents is not None
         return agents[0]
 
+    def find_leader_batch(
+        self, tasks: List[str], mmr_lambda: Optional[float] = None
+    ) -> List[Agent]:
+        agents_list = self.find_agents_batch(
+            role='leader',
+            queries=tasks,
+            num=1,
+            mmr_lambda=self._get_mmr_lambda(mmr_lambda),
+        )
+        return [agents[0] for agents in agents_list]
+
     def sample_leader(self) -> Agent:
         agents = self.sample_agents(role='leader', num=1)
         assert agents is not None
         return agents[0]
 
-    def find_members(self, leader_profile: Profile) -> List[Agent]:
+    def find_members(
+        self, leader_profile: Profile, mmr_lambda: Optional[float] = None
+    ) -> List[Agent]:
         agents = self.find_agents(
-            role='member', query=leader_profile.bio, num=self.config.param.member_num
+            role='member',
+            query=leader_profile.bio,
+            num=self.config.param.member_num,
+            mmr_lambda=self._get_mmr_lambda(mmr_lambda),
         )
         return agents
 
+    def find_members_batch(
+        self, leader_profiles: List[Profile], mmr_lambda: Optional[float] = None
+    ) -> List[List[Agent]]:
+        return self.find_agents_batch(
+            role='member',
+            queries=[leader_profile.bio for leader_profile in leader_profiles],
+            num=self.config.param.member_num,
+            mmr_lambda=self._get_mmr_lambda(mmr_lambda),
+        )
+
     def sample_members(self) -> List[Agent]:
         agents = self.sample_agents(role='member', num=self.config.param.member_num)
         return agents
 
-    def find_reviewers(self, proposal: Proposal) -> List[Agent]:
+    def find_reviewers(
+        self, proposal: Proposal, mmr_lambda: Optional[float] = None
+    ) -> List[Agent]:
         agents = self.find_agents(
-            role='reviewer', query=proposal.content, num=self.config.param.reviewer_num
+            role='reviewer',
+            query=proposal.content,
+            num=self.config.param.reviewer_num,
+            mmr_lambda=self._get_mmr_lambda(mmr_lambda),
         )
         return agents
 
+    def find_reviewers_batch(
+        self, proposals: List[Proposal], mmr_lambda: Optional[float] = None
+    ) -> List[List[Agent]]:
+        return self.find_agents_batch(
+            role='reviewer',
+            queries=[proposal.content for proposal in proposals],
+            num=self.config.param.reviewer_num,
+            mmr_lambda=self._get_mmr_lambda(mmr_lambda),
+        )
+
     def sample_reviewers(self) -> List[Agent]:
         agents = self.sample_agents(role='reviewer', num=self.config.param.reviewer_num)
         return agents
 
-    def find_chair(self, proposal: Proposal) -> Agent:
-        agents = self.find_agents(role='chair', query=proposal.content, num=1)
+    def find_chair(
+        self, proposal: Proposal, mmr_lambda: Optional[float] = None
+    ) -> Agent:
+        agents = self.find_agents(
+            role='chair',
+            query=proposal.content,
+            num=1,
+            mmr_lambda=self._get_mmr_lambda(mmr_lambda),
+        )
         assert agents is not None
         return agents[0]
 
+    def find_chair_batch(
+        self, proposals: List[Proposal], mmr_lambda: Optional[float] = None
+    ) -> List[Agent]:
+        agents_list = self.find_agents_batch(
+            role='chair',
+            queries=[proposal.content for proposal in proposals],
+            num=1,
+            mmr_lambda=self._get_mmr_lambda(mmr_lambda),
+        )
+        return [agents[0] for agents in agents_list]
+
     def sample_chair(self) -> Agent:
         agents = self.sample_agents(role='chair', num=1)
         assert agents is not None
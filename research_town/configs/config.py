@@ -18,6 +18,25 @@ class ParamConfig(BaseModel):
     stream: Optional[bool] = None
     write_proposal_strategy: str
     max_env_run_num: int
+    warmup_retriever: bool = False
+    retriever_model: str = 'facebook/contriever'
+    reembed_in_background: bool = False
+    retriever_quantize: bool = False
+    retriever_num_threads: Optional[int] = None
+    retriever_compile: Optional[str] = None
+    embed_cache_dir: Optional[str] = None
+    embed_cache_size: int = 100000
+    cache_token_ids: bool = False
+    query_cache_size: int = 1024
+    embed_in_background: bool = False
+    embed_wait_timeout: Optional[float] = None
+    paper_match_mode: str = 'dense'
+    paper_dedup_mode: str = 'off'
+    paper_dedup_threshold: float = 0.8
+    embed_format: str = 'pkl'
+    embed_storage: str = 'float32'
+    mmr_lambda: Optional[float] = None
+    mmr_candidate_num: int = 20
 
 
 # EvalPromptTemplate for validation of eval-related prompts
@@ -1,34 +1,428 @@
 import json
 import os
 import pickle
-from typing import Any, Dict, Generic, List, Optional, Type, TypeVar, Union
+import re
+import threading
+from typing import (
+    Any,
+    Dict,
+    Generic,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Type,
+    TypeVar,
+    Union,
+)
 
+import numpy as np
 import torch
+from numpy.typing import NDArray
 
 from ..data.data import Data
+from ..utils.ann_index import ANNIndex, IVFIndex
+from ..utils.bulk_embed import bulk_embed
+from ..utils.embed_build import EmbedBuild
+from ..utils.embed_cache import EmbedCache, QueryEmbedCache
+from ..utils.embed_matrix import EmbedMatrix
+from ..utils.embed_storage import (
+    embed_file_exists,
+    load_embed_file,
+    load_embed_index,
+    read_embed_rows,
+    remove_embed_file,
+    rewrite_embed_file,
+    search_embed_file,
+    write_embed_file,
+)
+from ..utils.embed_worker import EmbedWorker
 from ..utils.logger import logger
+from ..utils.mmr import mmr_rerank
+from ..utils.retriever import (
+    DEFAULT_RETRIEVER_MODEL,
+    RetrieverModel,
+    RetrieverTokenizer,
+    get_embed,
+    get_embed_batch,
+    get_retriever,
+)
 
 T = TypeVar('T', bound=Data)
 
 
 class BaseDB(Generic[T]):
+    # name of the text field that gets embedded, None if the DB has no embeddings
+    embed_field: Optional[str] = None
+    # fields kept as filter columns next to the embeddings, so that match
+    # conditions on them become a mask instead of a scan over all records
+    filter_fields: Tuple[str, ...] = ()
+
     def __init__(
-        self, data_class: Type[T], load_file_path: Optional[str] = None
+        self,
+        data_class: Type[T],
+        load_file_path: Optional[str] = None,
+        retriever_model_name: str = DEFAULT_RETRIEVER_MODEL,
     ) -> None:
         self.project_name: Optional[str] = None
         self.data_class = data_class
         self.data: Dict[str, T] = {}
-        self.data_embed: Dict[str, torch.Tensor] = {}
+        self.data_embed = EmbedMatrix()
+        # pks whose embedding is missing or out of date
+        self.dirty_pks: Set[str] = set()
+        # with a worker, dirty records are embedded in the background and
+        # searches wait at most embed_wait_timeout seconds for them
+        self.embed_worker: Optional[EmbedWorker] = None
+        self.embed_wait_timeout: Optional[float] = None
+        self._embed_lock = threading.RLock()
+        # bumped whenever the embedding set is replaced, so that batches of the
+        # previous model still in flight are dropped
+        self.embed_version = 0
+        self._worker_embed_version = 0
+        # a new embedding set built in the background while searches use this one
+        self.embed_build: Optional[EmbedBuild] = None
+        self.embed_cache: Optional[EmbedCache] = None
+        self.query_cache: Optional[QueryEmbedCache] = None
+        self.embed_format = 'pkl'
+        self.embed_storage = 'float32'
+        # with the 'disk' format the embeddings stay in this file and are searched
+        # blockwise; data_embed then only holds records embedded since it was
+        # written
+        self.embed_file: Optional[str] = None
+        self.embed_file_dim = 0
+        self.embed_file_pks: List[str] = []
+        self.embed_file_rows: Dict[str, int] = {}
+        # file rows that searches read: rows of records that were deleted or
+        # changed since the file was written are cleared as that happens
+        self.embed_file_mask: NDArray[np.bool_] = np.zeros(0, dtype=bool)
+        # whether embed_file was written by a background build, and is removed
+        # once it is replaced
+        self.embed_file_owned = False
+        self.embed_file_builds = 0
+        self.disk_block_size = 16384
+        self.disk_threads: Optional[int] = None
+        self.rescore_factor = 4
+        # candidates fetched per query before an MMR re-rank picks the results
+        self.mmr_candidate_num = 20
+        self.retriever_model_name = retriever_model_name
+        self.retriever_options: Dict[str, Any] = {
+            'quantize': False,
+            'num_threads': None,
+            'compile_mode': None,
+        }
+        self.retriever_tokenizer: Optional[RetrieverTokenizer] = None
+        self.retriever_model: Optional[RetrieverModel] = None
         if load_file_path is not None:
             self.load_from_json(load_file_path)
 
+    def _initialize_retriever(self) -> None:
+        if self.retriever_tokenizer is None or self.retriever_model is None:
+            self.retriever_tokenizer, self.retriever_model = get_retriever(
+                self.retriever_model_name, **self.retriever_options
+            )
+
+    def _embed_queries(self, queries: List[str]) -> torch.Tensor:
+        self._initialize_retriever()
+        assert self.retriever_tokenizer is not None
+        assert self.retriever_model is not None
+        return get_embed_batch(
+            queries,
+            self.retriever_tokenizer,
+            self.retriever_model,
+            embed_cache=self.query_cache,
+        )
+
     def set_project_name(self, project_name: str) -> None:
         self.project_name = project_name
 
+    def set_retriever_options(
+        self,
+        quantize: bool = False,
+        num_threads: Optional[int] = None,
+        compile_mode: Optional[str] = None,
+    ) -> None:
+        retriever_options = {
+            'quantize': quantize,
+            'num_threads': num_threads,
+            'compile_mode': compile_mode,
+        }
+        if retriever_options != self.retriever_options:
+            self.retriever_options = retriever_options
+            self.retriever_tokenizer = None
+            self.retriever_model = None
+
+    def set_retriever_model(
+        self, retriever_model_name: str, background: bool = False
+    ) -> None:
+        """
+        Switches to another Hugging Face model or embedding backend, e.g.
+        'hashing'. Embeddings of the previous model live in another vector
+        space, so every record is embedded again on the next search. With
+        background, searches keep using the current embeddings until
+        start_reembed has built the new ones.
+        """
+        if self.embed_build is not None and self.embed_build.running:
+            if retriever_model_name == self.embed_build.retriever_model_name:
+                return
+            self._cancel_embed_build()
+        if retriever_model_name == self.retriever_model_name:
+            return
+        if background and (len(self.data_embed) or self.embed_file is not None):
+            self.start_reembed(retriever_model_name)
+            return
+        # a batch of the old model in flight must not land in the new matrix
+        embed_worker = self.embed_worker
+        self.set_embed_worker(False, self.embed_wait_timeout)
+        self.retriever_model_name = retriever_model_name
+        self.retriever_tokenizer = None
+        self.retriever_model = None
+        self._clear_embeds()
+        if embed_worker is not None:
+            self.set_embed_worker(
+                True, self.embed_wait_timeout, embed_worker.batch_size
+            )
+
+    def set_embed_worker(
+        self,
+        enabled: bool,
+        wait_timeout: Optional[float] = None,
+        batch_size: int = 32,
+    ) -> None:
+        """
+        Embeds new and changed records on a background thread as they are
+        added. A search first waits up to wait_timeout seconds (None waits
+        until the queue is empty) and then searches the vectors that are
+        ready; records still pending are left out of the dense scan.
+        """
+        if self.embed_worker is not None:
+            self.embed_worker.stop()
+            self.embed_worker = None
+        self.embed_wait_timeout = wait_timeout
+        if not enabled:
+            return
+        if self.embed_field is None:
+            raise ValueError(f'{self.__class__.__name__} has no field to embed')
+        self.embed_worker = EmbedWorker(
+            self._embed_texts, self._add_background_embeds, batch_size
+        )
+        with self._embed_lock:
+            for pk in self.dirty_pks:
+                self._submit_embed(pk)
+
+    def start_reembed(
+        self,
+        retriever_model_name: Optional[str] = None,
+        embed_storage: Optional[str] = None,
+        batch_size: int = 64,
+    ) -> EmbedBuild:
+        """
+        Embeds every record with retriever_model_name (the current model by
+        default) into a new set with embed_storage on a background thread.
+        Searches keep using the current set until the new one is complete and
+        is switched in at once; the previous set is dropped then. Returns the
+        build, whose progress() reports how far it got.
+        """
+        if self.embed_field is None:
+            raise ValueError(f'{self.__class__.__name__} has no field to embed')
+        self._cancel_embed_build()
+        with self._embed_lock:
+            self.embed_build = EmbedBuild(
+                retriever_model_name or self.retriever_model_name,
+                embed_storage or self.embed_storage,
+                list(self.data),
+                self._build_embeds,
+                batch_size,
+            )
+        return self.embed_build
+
+    def get_embed_progress(self) -> Optional[Dict[str, Any]]:
+        """Progress of the running or the last background build."""
+        return self.embed_build.progress() if self.embed_build is not None else None
+
+    def _cancel_embed_build(self) -> None:
+        with self._embed_lock:
+            if self.embed_build is not None:
+                self.embed_build.cancel()
+                self.embed_build = None
+
+    def _build_embeds(self, build: EmbedBuild) -> None:
+        assert self.embed_field is not None
+        retriever_tokenizer, retriever_model = get_retriever(
+            build.retriever_model_name, **self.retriever_options
+        )
+        # the new set; for a DB searched from disk it is written to a new file
+        # instead and this only holds the records changed during the build
+        data_embed = EmbedMatrix()
+        data_embed.set_storage(build.embed_storage, self.rescore_factor)
+        with self._embed_lock:
+            embed_file = self._get_build_embed_file()
+
+        def embed(pks: List[str]) -> Tuple[List[str], torch.Tensor]:
+            records = [(pk, self.data.get(pk)) for pk in pks]
+            for pk, record in records:
+                if record is None:
+                    data_embed.pop(pk, None)
+            ready = [(pk, record) for pk, record in records if record is not None]
+            if not ready:
+                return [], torch.empty(0)
+            return [pk for pk, _ in ready], get_embed_batch(
+                [getattr(record, str(self.embed_field)) for _, record in ready],
+                retriever_tokenizer,
+                retriever_model,
+                embed_cache=self.embed_cache,
+            )
+
+        def add(pks: List[str]) -> None:
+            ready_pks, embeds = embed(pks)
+            if ready_pks:
+                data_embed.add_many(ready_pks, embeds)
+
+        def blocks() -> Iterator[Tuple[List[str], torch.Tensor]]:
+            for start in range(0, len(build.pks), build.batch_size):
+                if build.cancelled:
+                    return
+                ready_pks, embeds = embed(build.pks[start : start + build.batch_size])
+                if ready_pks:
+                    yield ready_pks, embeds
+                build.advance(len(build.pks[start : start + build.batch_size]))
+
+        try:
+            if embed_file is not None:
+                # written blockwise, so that the corpus is never held in memory
+                write_embed_file(
+                    embed_file,
+                    (
+                        (pks, EmbedMatrix.normalize(embeds).numpy())
+                        for pks, embeds in blocks()
+                    ),
+                )
+            else:
+                for pks, embeds in blocks():
+                    data_embed.add_many(pks, embeds)
+            # records changed during the build, a few rounds as they keep coming
+            for _ in range(3):
+                stale_pks = build.take_stale()
+                if not stale_pks or build.cancelled:
+                    break
+                add(list(stale_pks))
+        except BaseException:
+            if embed_file is not None:
+                remove_embed_file(embed_file)
+            raise
+        with self._embed_lock:
+            if build.cancelled:
+                if embed_file is not None:
+                    remove_embed_file(embed_file)
+                return
+            # the rest is left dirty and embedded like any other change
+            stale_pks = build.take_stale()
+            for pk in stale_pks:
+                data_embed.pop(pk, None)
+            self.retriever_model_name = build.retriever_model_name
+            self.retriever_tokenizer = retriever_tokenizer
+            self.retriever_model = retriever_model
+            self.embed_storage = build.embed_storage
+            self._clear_embeds(data_embed, embed_file)
+            for pk in stale_pks:
+                if pk in self.data and pk not in self.dirty_pks:
+                    self.dirty_pks.add(pk)
+                    self._mask_file_rows([pk])
+                    self._submit_embed(pk)
+            self._set_filter_columns(list(self.data))
+            build.finish(self.embed_version)
+        logger.info(
+            f"Switched to {len(build.pks)} embeddings of '{build.retriever_model_name}' "
+            f'(version {build.version})'
+        )
+
+    def _get_build_embed_file(self) -> Optional[str]:
+        # a DB searched from disk gets its new set in a file next to the current
+        # one, numbered by build
+        if self.embed_file is None:
+            return None
+        self.embed_file_builds += 1
+        prefix = (
+            re.sub(r'\.v\d+$', '', self.embed_file)
+            if self.embed_file_owned
+            else self.embed_file
+        )
+        return f'{prefix}.v{self.embed_file_builds}'
+
+    def _release_embed_file(self) -> None:
+        # a file written by a background build is referenced by nothing else
+        if self.embed_file_owned and self.embed_file is not None:
+            remove_embed_file(self.embed_file)
+        self.embed_file_owned = False
+
+    def _clear_embeds(
+        self,
+        data_embed: Optional[EmbedMatrix] = None,
+        embed_file: Optional[str] = None,
+    ) -> None:
+        # searches hold the lock, so nothing uses the previous set after this
+        with self._embed_lock:
+            self.embed_version += 1
+            self._release_embed_file()
+            if embed_file is not None:
+                pks, dim, _ = load_embed_index(embed_file)
+                self._set_embed_file(embed_file, pks, dim)
+                self.embed_file_owned = True
+            else:
+                self.embed_file = None
+                self.embed_file_dim = 0
+                self.embed_file_pks = []
+                self.embed_file_rows = {}
+                self.embed_file_mask = np.zeros(0, dtype=bool)
+            if data_embed is None:
+                data_embed = EmbedMatrix()
+                data_embed.set_storage(self.embed_storage, self.rescore_factor)
+            self.data_embed = data_embed
+            self._reset_dirty_pks()
+
+    def set_embed_cache(self, embed_cache: Optional[EmbedCache]) -> None:
+        self.embed_cache = embed_cache
+
+    def set_query_cache(self, query_cache: Optional[QueryEmbedCache]) -> None:
+        self.query_cache = query_cache
+
+    def set_embed_format(
+        self,
+        embed_format: str,
+        block_size: int = 16384,
+        num_threads: Optional[int] = None,
+    ) -> None:
+        if embed_format not in ('pkl', 'mmap', 'disk'):
+            raise ValueError(f'Unsupported embedding format: {embed_format}')
+        self.embed_format = embed_format
+        self.disk_block_size = block_size
+        self.disk_threads = num_threads
+
+    def set_embed_storage(self, embed_storage: str, rescore_factor: int = 4) -> None:
+        self.data_embed.set_storage(embed_storage, rescore_factor)
+        self.embed_storage = embed_storage
+        self.rescore_factor = rescore_factor
+
+    def set_mmr_candidate_num(self, mmr_candidate_num: int) -> None:
+        if mmr_candidate_num <= 0:
+            raise ValueError('Expected mmr_candidate_num > 0')
+        self.mmr_candidate_num = mmr_candidate_num
+
     def add(self, data: T) -> None:
         if self.project_name is not None:
             data.project_name = self.project_name
+        dirty = False
+        if self.embed_field is not None:
+            old_data = self.data.get(data.pk)
+            if old_data is None or getattr(old_data, self.embed_field) != getattr(
+                data, self.embed_field
+            ):
+                dirty = True
         self.data[data.pk] = data
+        if dirty:
+            self._set_dirty(data.pk)
+        self._set_filter_columns([data.pk])
         logger.info(
             f"Creating instance of '{data.__class__.__name__}': '{data.model_dump()}'"
         )
@@ -37,13 +431,26 @@ class BaseDB(Generic[T]):
         if pk in self.data:
             for key, value in updates.items():
                 if value is not None:
+                    dirty = key == self.embed_field and value != getattr(
+                        self.data[pk], key
+                    )
                     setattr(self.data[pk], key, value)
+                    if dirty:
+                        self._set_dirty(pk)
+            if any(key in self.filter_fields for key in updates):
+                self._set_filter_columns([pk])
             return True
         return False
 
     def delete(self, pk: str) -> bool:
         if pk in self.data:
             del self.data[pk]
+            with self._embed_lock:
+                self.dirty_pks.discard(pk)
+                self._mask_file_rows([pk])
+                self.data_embed.pop(pk, None)
+                if self.embed_build is not None:
+                    self.embed_build.mark_stale(pk)
             return True
         return False
 
@@ -56,6 +463,388 @@ class BaseDB(Generic[T]):
                 result.append(data)
         return result
 
+    def transform_to_embed(self) -> None:
+        if self.embed_field is None:
+            raise ValueError(f'{self.__class__.__name__} has no field to embed')
+        if self.embed_worker is not None:
+            self.embed_worker.wait()
+        self._embed_dirty_pks()
+
+    def _embed_ready(self) -> None:
+        # what a search needs: without a worker every dirty record is embedded
+        # now, with one the records still pending after the deadline are skipped
+        if self.embed_worker is None:
+            self.transform_to_embed()
+            return
+        self.embed_worker.wait(timeout=self.embed_wait_timeout)
+        self._embed_dirty_pks(self.embed_worker.pending_pks())
+
+    def _embed_dirty_pks(
+        self,
+        pending_pks: Optional[Set[str]] = None,
+        embed_cache: Optional[EmbedCache] = None,
+    ) -> None:
+        assert self.embed_field is not None
+        pending_pks = pending_pks or set()
+        with self._embed_lock:
+            # with a worker, these are records whose background batch failed
+            pks = [
+                pk for pk in self.dirty_pks if pk in self.data and pk not in pending_pks
+            ]
+            texts = [getattr(self.data[pk], self.embed_field) for pk in pks]
+            embed_version = self.embed_version
+        if not pks:
+            return
+        self._initialize_retriever()
+        embeds = get_embed(
+            texts,
+            self.retriever_tokenizer,
+            self.retriever_model,
+            embed_cache=embed_cache or self.embed_cache,
+        )
+        with self._embed_lock:
+            if embed_version != self.embed_version:
+                # another embedding set was switched in meanwhile
+                return
+            # records deleted or changed again meanwhile stay dirty
+            ready = [
+                i
+                for i, (pk, text) in enumerate(zip(pks, texts))
+                if pk in self.dirty_pks
+                and pk in self.data
+                and getattr(self.data[pk], self.embed_field) == text
+            ]
+            if not ready:
+                return
+            ready_pks = [pks[i] for i in ready]
+            self.data_embed.add_many(
+                ready_pks, torch.cat([embeds[i] for i in ready], 0)
+            )
+            self._set_filter_columns(ready_pks)
+            self.dirty_pks.difference_update(ready_pks)
+        logger.info(f'Embedded {len(ready_pks)} new or changed records')
+
+    def get_pending_pks(self) -> Set[str]:
+        """Dirty records that are queued for the background worker."""
+        if self.embed_worker is None:
+            return set()
+        with self._embed_lock:
+            return self.embed_worker.pending_pks() & self.dirty_pks
+
+    def _set_dirty(self, pk: str) -> None:
+        with self._embed_lock:
+            self.dirty_pks.add(pk)
+            self._mask_file_rows([pk])
+            if self.embed_build is not None:
+                self.embed_build.mark_stale(pk)
+        self._submit_embed(pk)
+
+    def _submit_embed(self, pk: str) -> None:
+        if self.embed_worker is not None and pk in self.data:
+            self.embed_worker.submit(pk, getattr(self.data[pk], str(self.embed_field)))
+
+    def _embed_texts(self, texts: List[str]) -> torch.Tensor:
+        # read before the model, a switch in between drops the batch
+        self._worker_embed_version = self.embed_version
+        self._initialize_retriever()
+        assert self.retriever_tokenizer is not None
+        assert self.retriever_model is not None
+        return get_embed_batch(
+            texts,
+            self.retriever_tokenizer,
+            self.retriever_model,
+            embed_cache=self.embed_cache,
+        )
+
+    def _add_background_embeds(
+        self, pks: List[str], texts: List[str], embeds: torch.Tensor
+    ) -> None:
+        assert self.embed_field is not None
+        with self._embed_lock:
+            if self._worker_embed_version != self.embed_version:
+                return
+            # records deleted or changed again since they were queued are skipped
+            ready = [
+                i
+                for i, (pk, text) in enumerate(zip(pks, texts))
+                if pk in self.dirty_pks
+                and pk in self.data
+                and getattr(self.data[pk], self.embed_field) == text
+            ]
+            if not ready:
+                return
+            ready_pks = [pks[i] for i in ready]
+            self.data_embed.add_many(ready_pks, embeds[ready])
+            self._set_filter_columns(ready_pks)
+            self.dirty_pks.difference_update(ready_pks)
+        logger.info(f'Embedded {len(ready_pks)} records in the background')
+
+    def bulk_embed(
+        self,
+        cache_dir: str,
+        num_workers: Optional[int] = None,
+        num_threads: Optional[int] = None,
+        chunk_size: int = 256,
+        cache_token_ids: bool = False,
+    ) -> Dict[int, Dict[str, float]]:
+        """
+        Embeds the records whose embedding is missing across a process pool into
+        the embedding cache at cache_dir, then fills the in-memory embeddings
+        from that cache.
+        """
+        if self.embed_field is None:
+            raise ValueError(f'{self.__class__.__name__} has no field to embed')
+        stats = bulk_embed(
+            [
+                getattr(self.data[pk], self.embed_field)
+                for pk in self.dirty_pks
+                if pk in self.data
+            ],
+            cache_dir,
+            model_name=self.retriever_model_name,
+            num_workers=num_workers,
+            num_threads=num_threads,
+            chunk_size=chunk_size,
+            cache_token_ids=cache_token_ids,
+            max_entries=len(self.data),
+            quantize=self.retriever_options['quantize'],
+            compile_mode=self.retriever_options['compile_mode'],
+        )
+        if self.embed_cache is None:
+            self.set_embed_cache(
+                EmbedCache(
+                    cache_dir,
+                    max_entries=max(100000, len(self.data)),
+                    cache_token_ids=cache_token_ids,
+                )
+            )
+        assert self.embed_cache is not None
+        if os.path.dirname(os.path.abspath(self.embed_cache.cache_path)) == (
+            os.path.abspath(cache_dir)
+        ):
+            self.transform_to_embed()
+            return stats
+        # the DB caches elsewhere, so this run is read back from cache_dir
+        embed_cache = EmbedCache(
+            cache_dir,
+            max_entries=max(100000, len(self.data)),
+            cache_token_ids=cache_token_ids,
+        )
+        if self.embed_worker is not None:
+            self.embed_worker.wait()
+        self._embed_dirty_pks(embed_cache=embed_cache)
+        embed_cache.close()
+        return stats
+
+    def _set_filter_columns(self, pks: List[str]) -> None:
+        pks = [pk for pk in pks if pk in self.data and pk in self.data_embed]
+        if self.filter_fields and pks:
+            self.data_embed.set_columns(
+                pks,
+                {
+                    field: [getattr(self.data[pk], field) for pk in pks]
+                    for field in self.filter_fields
+                },
+            )
+
+    def _search_embeds(
+        self,
+        queries: List[str],
+        num: int,
+        conditions: Dict[str, Any],
+        candidate_pks: Optional[List[str]] = None,
+        mmr_lambda: Optional[float] = None,
+    ) -> List[List[Tuple[str, float]]]:
+        self._embed_ready()
+        # a new embedding set is only switched in between searches
+        with self._embed_lock:
+            query_embeds = self._embed_queries(queries)
+            search_num = self._get_search_num(num, mmr_lambda)
+            if candidate_pks is not None:
+                results = self._search_candidates(
+                    query_embeds, search_num, candidate_pks
+                )
+            else:
+                results = self._search_query_embeds(
+                    query_embeds, search_num, conditions
+                )
+            return self._rerank_mmr(query_embeds, results, num, mmr_lambda)
+
+    def _get_search_num(self, num: int, mmr_lambda: Optional[float]) -> int:
+        return num if mmr_lambda is None else max(num, self.mmr_candidate_num)
+
+    def _get_embeds(self, pks: List[str]) -> torch.Tensor:
+        embeds = torch.empty(
+            (len(pks), self.data_embed.dim or self.embed_file_dim), dtype=torch.float32
+        )
+        file_positions = []
+        for i, pk in enumerate(pks):
+            if pk in self.data_embed:
+                embeds[i] = self.data_embed[pk][0]
+            else:
+                file_positions.append(i)
+        if file_positions:
+            assert self.embed_file is not None
+            embeds[file_positions] = torch.from_numpy(
+                read_embed_rows(
+                    self.embed_file,
+                    self.embed_file_dim,
+                    [self.embed_file_rows[pks[i]] for i in file_positions],
+                )
+            )
+        return embeds
+
+    def _rerank_mmr(
+        self,
+        query_embeds: torch.Tensor,
+        results: List[List[Tuple[str, float]]],
+        num: int,
+        mmr_lambda: Optional[float],
+    ) -> List[List[Tuple[str, float]]]:
+        """
+        Re-ranks the top candidates of every query by maximal marginal relevance
+        so that near-duplicates of an earlier result are pushed down. Results
+        keep the scores of the first stage.
+        """
+        if mmr_lambda is None:
+            return results
+        candidate_num = max((len(result) for result in results), default=0)
+        if candidate_num == 0:
+            return results
+        pks = list({pk: None for result in results for pk, _ in result})
+        embeds = self._get_embeds(pks)
+        positions = {pk: i for i, pk in enumerate(pks)}
+        candidate_ids = torch.zeros((len(results), candidate_num), dtype=torch.long)
+        candidate_mask = torch.zeros((len(results), candidate_num), dtype=torch.bool)
+        for i, result in enumerate(results):
+            candidate_ids[i, : len(result)] = torch.tensor(
+                [positions[pk] for pk, _ in result], dtype=torch.long
+            )
+            candidate_mask[i, : len(result)] = True
+        picks = mmr_rerank(
+            query_embeds, embeds[candidate_ids], candidate_mask, num, mmr_lambda
+        )
+        return [
+            [result[position] for position in pick]
+            for result, pick in zip(results, picks)
+        ]
+
+    def _search_query_embeds(
+        self, query_embeds: torch.Tensor, num: int, conditions: Dict[str, Any]
+    ) -> List[List[Tuple[str, float]]]:
+        if self.embed_file is not None:
+            return self._search_disk(
+                query_embeds,
+                num,
+                [data.pk for data in self.get(**conditions)] if conditions else None,
+            )
+        if not conditions:
+            return self.data_embed.search(query_embeds, num)
+        if self.data_embed.has_columns(conditions):
+            return self.data_embed.search(query_embeds, num, conditions=conditions)
+        candidate_pks = [data.pk for data in self.get(**conditions)]
+        return self.data_embed.search(query_embeds, num, candidate_pks)
+
+    def _search_candidates(
+        self, query_embeds: torch.Tensor, num: int, candidate_pks: List[str]
+    ) -> List[List[Tuple[str, float]]]:
+        if self.embed_file is not None:
+            return self._search_disk(query_embeds, num, candidate_pks)
+        return self.data_embed.search(query_embeds, num, candidate_pks, exact=True)
+
+    def _mask_file_rows(self, pks: Iterable[str]) -> None:
+        rows = [self.embed_file_rows[pk] for pk in pks if pk in self.embed_file_rows]
+        if rows:
+            self.embed_file_mask[rows] = False
+
+    def _file_row_mask(
+        self, candidate_pks: Optional[List[str]] = None
+    ) -> NDArray[np.bool_]:
+        if candidate_pks is None:
+            return self.embed_file_mask
+        row_mask = np.zeros_like(self.embed_file_mask)
+        row_mask[
+            [
+                self.embed_file_rows[pk]
+                for pk in candidate_pks
+                if pk in self.embed_file_rows
+            ]
+        ] = True
+        return row_mask & self.embed_file_mask
+
+    def _search_disk(
+        self,
+        query_embeds: torch.Tensor,
+        num: int,
+        candidate_pks: Optional[List[str]] = None,
+    ) -> List[List[Tuple[str, float]]]:
+        assert self.embed_file is not None
+        results = [
+            [(self.embed_file_pks[row], score) for row, score in result]
+            for result in search_embed_file(
+                self.embed_file,
+                self.embed_file_dim,
+                EmbedMatrix.normalize(query_embeds).numpy(),
+                num,
+                row_mask=self._file_row_mask(candidate_pks),
+                block_size=self.disk_block_size,
+                num_threads=self.disk_threads,
+            )
+        ]
+        delta_pks = (
+            list(self.data_embed)
+            if candidate_pks is None
+            else [pk for pk in candidate_pks if pk in self.data_embed]
+        )
+        if delta_pks:
+            delta_results = self.data_embed.search(
+                query_embeds,
+                num,
+                None if candidate_pks is None else delta_pks,
+                exact=True,
+            )
+            results = [
+                sorted(result + delta, key=lambda item: item[1], reverse=True)[:num]
+                for result, delta in zip(results, delta_results)
+            ]
+        return results
+
+    def build_index(self, index: Optional[ANNIndex] = None) -> None:
+        self.transform_to_embed()
+        self.data_embed.build_index(index if index is not None else IVFIndex())
+        logger.info(
+            f'Built {self.data_embed.index.__class__.__name__} over '
+            f'{len(self.data_embed)} embeddings'
+        )
+
+    def _drop_embeds(self, pks: Iterable[str]) -> None:
+        # the records get embedded again if they are still in data
+        with self._embed_lock:
+            pks = list(pks)
+            self._mask_file_rows(pks)
+            for pk in pks:
+                self.data_embed.pop(pk, None)
+                self.embed_file_rows.pop(pk, None)
+
+    def _reset_dirty_pks(self) -> None:
+        if self.embed_field is not None:
+            with self._embed_lock:
+                # rows of records that are gone, e.g. after loading other data
+                self._drop_embeds(
+                    [
+                        pk
+                        for pk in list(self.data_embed) + list(self.embed_file_rows)
+                        if pk not in self.data
+                    ]
+                )
+                self.dirty_pks = {
+                    pk
+                    for pk in self.data
+                    if pk not in self.data_embed and pk not in self.embed_file_rows
+                }
+                for pk in self.dirty_pks:
+                    self._submit_embed(pk)
+
     def save_to_json(
         self, save_path: str, with_embed: bool = False, class_name: Optional[str] = None
     ) -> None:
@@ -67,7 +856,12 @@ class BaseDB(Generic[T]):
             file_name = f'{class_name}.json'
 
         if with_embed:
-            self.save_to_pkl(save_path, class_name=class_name)
+            if self.embed_format == 'mmap':
+                self.save_to_mmap(save_path, class_name=class_name)
+            elif self.embed_format == 'disk':
+                self.save_to_disk(save_path, class_name=class_name)
+            else:
+                self.save_to_pkl(save_path, class_name=class_name)
 
         with open(os.path.join(save_path, file_name), 'w') as f:
             json.dump(
@@ -84,26 +878,57 @@ class BaseDB(Generic[T]):
         else:
             file_name = f'{class_name}.pkl'
         with open(os.path.join(save_path, file_name), 'wb') as pkl_file:
-            pickle.dump(self.data_embed, pkl_file)
+            pickle.dump(dict(self.data_embed.items()), pkl_file)
+        self._save_index(save_path, class_name)
 
     def load_from_json(
         self, load_path: str, with_embed: bool = False, class_name: Optional[str] = None
     ) -> None:
+        # a build in progress embeds records that are about to be replaced
+        self._cancel_embed_build()
         if class_name is None:
             file_name = f'{self.__class__.__name__}.json'
         else:
             file_name = f'{class_name}.json'
 
-        if with_embed:
-            self.load_from_pkl(load_path, class_name=class_name)
-
         with open(os.path.join(load_path, file_name), 'r') as f:
             data: Dict[str, Any] = json.load(f)
-            if with_embed:
-                for pk in data.keys():
-                    if pk in self.data_embed:
-                        data[pk]['embed'] = self.data_embed[pk]
-            self.data = {pk: self.data_class(**data) for pk, data in data.items()}
+        old_data = self.data
+        # set first, so that loading the embeddings drops rows of other records
+        self.data = {pk: self.data_class(**record) for pk, record in data.items()}
+
+        if with_embed:
+            embed_prefix = os.path.join(
+                load_path, class_name or self.__class__.__name__
+            )
+            if self.embed_format == 'disk':
+                self.load_from_disk(load_path, class_name=class_name)
+            elif self.embed_format == 'mmap' or embed_file_exists(embed_prefix):
+                self.load_from_mmap(load_path, class_name=class_name)
+            else:
+                self.load_from_pkl(load_path, class_name=class_name)
+            self.data = {
+                pk: record.model_copy(update={'embed': self.data_embed[pk]})
+                if pk in self.data_embed
+                else record
+                for pk, record in self.data.items()
+            }
+        elif self.embed_field is not None:
+            # embeddings of the previous records only hold where the text is the same
+            self._drop_embeds(
+                [
+                    pk
+                    for pk in list(self.data_embed) + list(self.embed_file_rows)
+                    if pk in self.data
+                    and (
+                        pk not in old_data
+                        or getattr(old_data[pk], self.embed_field)
+                        != getattr(self.data[pk], self.embed_field)
+                    )
+                ]
+            )
+        self._reset_dirty_pks()
+        self._set_filter_columns(list(self.data))
 
     def load_from_pkl(self, load_path: str, class_name: Optional[str] = None) -> None:
         if class_name is None:
@@ -111,4 +936,116 @@ class BaseDB(Generic[T]):
         else:
             file_name = f'{class_name}.pkl'
         with open(os.path.join(load_path, file_name), 'rb') as pkl_file:
-            self.data_embed = pickle.load(pkl_file)
+            data_embed: Dict[str, torch.Tensor] = pickle.load(pkl_file)
+        self.data_embed = EmbedMatrix()
+        self.data_embed.set_storage(self.embed_storage, self.rescore_factor)
+        if data_embed:
+            self.data_embed.add_many(
+                data_embed.keys(),
+                torch.cat([embed.reshape(1, -1) for embed in data_embed.values()], 0),
+            )
+        self._load_index(load_path, class_name)
+        self._reset_dirty_pks()
+        self._set_filter_columns(list(self.data))
+
+    def save_to_mmap(self, save_path: str, class_name: Optional[str] = None) -> None:
+        if not os.path.exists(save_path):
+            os.makedirs(save_path)
+        if class_name is None:
+            file_prefix = self.__class__.__name__
+        else:
+            file_prefix = class_name
+        embed_prefix = os.path.join(save_path, file_prefix)
+        with self._embed_lock:
+            # written blockwise, so that mapped rows are never copied as a whole
+            write_embed_file(
+                embed_prefix,
+                (
+                    (pks, embeds.numpy())
+                    for pks, embeds in self.data_embed.blocks(self.disk_block_size)
+                ),
+            )
+            self._save_index(save_path, class_name)
+            if self.data_embed.base is not None:
+                # the new file holds the delta too, so it is mapped in its place
+                self._map_embed_file(embed_prefix, save_path, class_name)
+
+    def load_from_mmap(self, load_path: str, class_name: Optional[str] = None) -> None:
+        if class_name is None:
+            file_prefix = self.__class__.__name__
+        else:
+            file_prefix = class_name
+        embed_prefix = os.path.join(load_path, file_prefix)
+        if not embed_file_exists(embed_prefix):
+            # convert an existing pickle once, later loads map the new files
+            self.load_from_pkl(load_path, class_name=class_name)
+            self.save_to_mmap(load_path, class_name=class_name)
+            logger.info(f'Converted embeddings of {file_prefix} to {embed_prefix}')
+        self._map_embed_file(embed_prefix, load_path, class_name)
+        self._reset_dirty_pks()
+
+    def _map_embed_file(
+        self, embed_prefix: str, load_path: str, class_name: Optional[str] = None
+    ) -> None:
+        pks, embeds = load_embed_file(embed_prefix)
+        self.data_embed = EmbedMatrix.from_normalized(pks, torch.from_numpy(embeds))
+        self.data_embed.set_storage(self.embed_storage, self.rescore_factor)
+        self._load_index(load_path, class_name)
+        self._set_filter_columns(list(self.data))
+
+    def save_to_disk(self, save_path: str, class_name: Optional[str] = None) -> None:
+        """
+        Rewrites the embedding file blockwise: rows of live records are copied
+        from the current file and the in-memory embeddings are appended.
+        """
+        if not os.path.exists(save_path):
+            os.makedirs(save_path)
+        embed_prefix = os.path.join(save_path, class_name or self.__class__.__name__)
+        delta_pks = list(self.data_embed)
+        dim = self.embed_file_dim or self.data_embed.dim or 0
+        pks = rewrite_embed_file(
+            self.embed_file,
+            embed_prefix,
+            self.embed_file_mask if self.embed_file is not None else None,
+            delta_pks,
+            self.data_embed.embeds().numpy()
+            if delta_pks
+            else np.empty((0, 0), dtype=np.float32),
+            block_size=self.disk_block_size,
+        )
+        self._set_embed_file(embed_prefix, pks, dim)
+
+    def load_from_disk(self, load_path: str, class_name: Optional[str] = None) -> None:
+        file_prefix = class_name or self.__class__.__name__
+        embed_prefix = os.path.join(load_path, file_prefix)
+        if not embed_file_exists(embed_prefix):
+            self.load_from_pkl(load_path, class_name=class_name)
+            self.save_to_mmap(load_path, class_name=class_name)
+            logger.info(f'Converted embeddings of {file_prefix} to {embed_prefix}')
+        pks, dim, _ = load_embed_index(embed_prefix)
+        self._set_embed_file(embed_prefix, pks, dim)
+        self._reset_dirty_pks()
+
+    def _set_embed_file(self, embed_prefix: str, pks: List[str], dim: int) -> None:
+        if embed_prefix != self.embed_file:
+            self._release_embed_file()
+        self.embed_file = embed_prefix
+        self.embed_file_dim = dim
+        self.embed_file_pks = pks
+        self.embed_file_rows = {pk: row for row, pk in enumerate(pks)}
+        self.embed_file_mask = np.array([pk in self.data for pk in pks], dtype=bool)
+        self.data_embed = EmbedMatrix()
+        self.data_embed.set_storage(self.embed_storage, self.rescore_factor)
+
+    def _save_index(self, save_path: str, class_name: Optional[str] = None) -> None:
+        if self.data_embed.index is not None:
+            file_prefix = class_name or self.__class__.__name__
+            self.data_embed.save_index(
+                os.path.join(save_path, f'{file_prefix}.index.npz')
+            )
+
+    def _load_index(self, load_path: str, class_name: Optional[str] = None) -> None:
+        file_prefix = class_name or self.__class__.__name__
+        index_path = os.path.join(load_path, f'{file_prefix}.index.npz')
+        if os.path.exists(index_path):
+            self.data_embed.load_index(index_path)
@@ -1,35 +1,330 @@
 import random
-from typing import Any, List, Optional, TypeVar
+from typing import Any, Dict, List, Optional, Set, Tuple, TypeVar, Union
 
 import torch
-from transformers import BertModel, BertTokenizer
 
 from ..data.data import Data, Paper
+from ..utils.bm25 import BM25Index
+from ..utils.embed_matrix import EmbedMatrix
 from ..utils.logger import logger
-from ..utils.paper_collector import get_recent_papers, get_related_papers
-from ..utils.retriever import get_embed, rank_topk
+from ..utils.minhash import MinHashLSH
+from ..utils.paper_collector import (
+    get_paper_key,
+    get_recent_papers,
+    get_related_papers,
+)
+from ..utils.passage_index import Passage, PassageIndex
+from ..utils.retriever import DEFAULT_RETRIEVER_MODEL, get_embed
+from ..utils.timestamp_index import TimestampIndex
 from .db_base import BaseDB
 
 T = TypeVar('T', bound=Data)
 
 
 class PaperDB(BaseDB[Paper]):
-    def __init__(self, load_file_path: Optional[str] = None) -> None:
-        super().__init__(Paper, load_file_path)
-        self.retriever_tokenizer: Optional[BertTokenizer] = None
-        self.retriever_model: Optional[BertModel] = None
-
-    def _initialize_retriever(self) -> None:
-        if self.retriever_tokenizer is None or self.retriever_model is None:
-            self.retriever_tokenizer = BertTokenizer.from_pretrained(
-                'facebook/contriever'
-            )
-            self.retriever_model = BertModel.from_pretrained('facebook/contriever')
+    embed_field = 'abstract'
+    filter_fields = ('domain', 'project_name')
+    lexical_fields = ('title', 'abstract', 'keywords')
+
+    def __init__(
+        self,
+        load_file_path: Optional[str] = None,
+        retriever_model_name: str = DEFAULT_RETRIEVER_MODEL,
+    ) -> None:
+        self.passage_index: Optional[PassageIndex] = None
+        self.lexical_index = BM25Index()
+        # pks whose lexical entry is missing or out of date
+        self.lexical_dirty_pks: Set[str] = set()
+        # natural key (arXiv id or URL) -> pk, checked against the paper on lookup
+        self.paper_keys: Dict[str, str] = {}
+        self.timestamp_index = TimestampIndex()
+        # near-duplicate detection over title and abstract, off by default
+        self.dedup_mode = 'off'
+        self.dedup_index: Optional[MinHashLSH] = None
+        # pk of a near-duplicate -> pk of the paper it duplicates
+        self.duplicates: Dict[str, str] = {}
+        self.match_mode = 'dense'
+        self.hybrid_candidate_num = 200
+        self.rrf_k = 60
+        super().__init__(Paper, load_file_path, retriever_model_name)
+
+    def set_match_mode(
+        self, match_mode: str, candidate_num: int = 200, rrf_k: int = 60
+    ) -> None:
+        """
+        'dense' ranks the whole corpus by embedding similarity. 'hybrid' takes
+        the candidate_num best BM25 matches over title, abstract and keywords,
+        scores only those densely and fuses both rankings with reciprocal rank
+        fusion.
+        """
+        if match_mode not in ('dense', 'hybrid'):
+            raise ValueError(f'Unsupported match mode: {match_mode}')
+        self.match_mode = match_mode
+        self.hybrid_candidate_num = candidate_num
+        self.rrf_k = rrf_k
+
+    def set_dedup_mode(
+        self,
+        dedup_mode: str,
+        threshold: float = 0.8,
+        num_perm: int = 128,
+        bands: int = 16,
+    ) -> None:
+        """
+        Looks every added paper up in a MinHash LSH index over the word
+        shingles of its title and abstract. 'flag' keeps a near-duplicate and
+        records the paper it duplicates in duplicates, 'merge' folds the fields
+        missing on the stored paper in and drops the new one, so that it is
+        never embedded. Papers stored already are checked in insertion order.
+        """
+        if dedup_mode not in ('off', 'flag', 'merge'):
+            raise ValueError(f'Unsupported dedup mode: {dedup_mode}')
+        self.dedup_mode = dedup_mode
+        self.dedup_index = (
+            MinHashLSH(num_perm, bands, threshold) if dedup_mode != 'off' else None
+        )
+        self._rebuild_dedup_index()
+
+    def add(self, data: Paper) -> None:
+        if self.dedup_index is not None:
+            self._remove_from_dedup_index(data.pk)
+            canonical = self._find_duplicate(data)
+            if canonical is not None and self.dedup_mode == 'merge':
+                if data.pk in self.data:
+                    self.delete(data.pk)
+                self._merge_duplicate(canonical, data)
+                return
+        else:
+            canonical = None
+        super().add(data)
+        self.lexical_dirty_pks.add(data.pk)
+        self._set_paper_key(data)
+        self.timestamp_index.add(data.pk, data.timestamp)
+        self._index_duplicate(data, canonical)
+        self._remove_stale_passages(data.pk)
+
+    def update(self, pk: str, updates: Dict[str, Any]) -> bool:
+        if any(key in self.lexical_fields for key in updates):
+            self.lexical_dirty_pks.add(pk)
+        updated = super().update(pk, updates)
+        if updated and updates.get('url') is not None:
+            self._set_paper_key(self.data[pk])
+        if updated and updates.get('timestamp') is not None:
+            self.timestamp_index.add(pk, self.data[pk].timestamp)
+        if (
+            updated
+            and self.dedup_index is not None
+            and pk in self.dedup_index
+            and any(updates.get(key) is not None for key in ('title', 'abstract'))
+        ):
+            self.dedup_index.add(pk, self._get_dedup_text(self.data[pk]))
+        if updated and updates.get('sections') is not None:
+            self._remove_stale_passages(pk)
+        return updated
+
+    def upsert(self, data: Paper) -> Paper:
+        """
+        Adds the paper unless a paper with the same natural key is stored
+        already. The stored paper then keeps its pk and takes every field that
+        is set on the new one, so that its embedding is only recomputed when the
+        abstract changed. Returns the stored paper.
+        """
+        existing = self.get_by_key(data.url)
+        if existing is None:
+            self.add(data)
+            if data.pk not in self.data:
+                # merged into a near-duplicate stored under another URL
+                return self.data[self.duplicates[data.pk]]
+            return data
+        self.update(
+            existing.pk,
+            data.model_dump(
+                exclude_defaults=True, exclude={'pk', 'project_name', 'embed'}
+            ),
+        )
+        return existing
+
+    def get_by_key(self, url: Optional[str]) -> Optional[Paper]:
+        key = get_paper_key(url)
+        pk = self.paper_keys.get(key) if key is not None else None
+        if pk is None or pk not in self.data:
+            return None
+        paper = self.data[pk]
+        # the paper may have been deleted, replaced or moved to another URL
+        return paper if get_paper_key(paper.url) == key else None
+
+    def _set_paper_key(self, paper: Paper) -> None:
+        key = get_paper_key(paper.url)
+        if key is not None and self.get_by_key(paper.url) is None:
+            self.paper_keys[key] = paper.pk
+
+    def get_canonical(self, pk: str) -> Optional[Paper]:
+        """The stored paper that pk was flagged or merged as a duplicate of."""
+        return self.data.get(self.duplicates.get(pk, pk))
+
+    def _get_dedup_text(self, paper: Paper) -> str:
+        return f'{paper.title} {paper.abstract}'
+
+    def _find_duplicate(self, paper: Paper) -> Optional[Paper]:
+        assert self.dedup_index is not None
+        duplicate = self.dedup_index.find_duplicate(self._get_dedup_text(paper))
+        if duplicate is None:
+            return None
+        logger.info(
+            f'Paper {paper.title!r} duplicates {self.data[duplicate[0]].title!r} '
+            f'(similarity {duplicate[1]:.2f})'
+        )
+        return self.data[duplicate[0]]
+
+    def _index_duplicate(self, paper: Paper, canonical: Optional[Paper]) -> None:
+        if self.dedup_index is None:
+            return
+        if canonical is None:
+            self.dedup_index.add(paper.pk, self._get_dedup_text(paper))
+        else:
+            # only the first paper of a group is indexed, so buckets stay small
+            self.duplicates[paper.pk] = canonical.pk
+
+    def _merge_duplicate(self, canonical: Paper, duplicate: Paper) -> None:
+        # the stored title and abstract stay, so that nothing is embedded again
+        updates = {
+            key: value
+            for key, value in duplicate.model_dump(
+                exclude={'pk', 'project_name', 'embed', 'title', 'abstract'}
+            ).items()
+            if value and not getattr(canonical, key)
+        }
+        if updates:
+            self.update(canonical.pk, updates)
+        self.duplicates[duplicate.pk] = canonical.pk
+
+    def _remove_from_dedup_index(self, pk: str) -> None:
+        self.duplicates.pop(pk, None)
+        if self.dedup_index is None or pk not in self.dedup_index:
+            return
+        self.dedup_index.remove(pk)
+        # papers flagged as duplicates of pk are checked again without it
+        flagged = [
+            duplicate_pk
+            for duplicate_pk, canonical_pk in self.duplicates.items()
+            if canonical_pk == pk
+        ]
+        for duplicate_pk in flagged:
+            del self.duplicates[duplicate_pk]
+            if duplicate_pk in self.data:
+                paper = self.data[duplicate_pk]
+                self._index_duplicate(paper, self._find_duplicate(paper))
+
+    def _rebuild_dedup_index(self) -> None:
+        self.duplicates = {}
+        if self.dedup_index is None:
+            return
+        self.dedup_index = MinHashLSH(
+            self.dedup_index.num_perm,
+            self.dedup_index.bands,
+            self.dedup_index.threshold,
+        )
+        for paper in list(self.data.values()):
+            canonical = self._find_duplicate(paper)
+            if canonical is not None and self.dedup_mode == 'merge':
+                self.delete(paper.pk)
+                self._merge_duplicate(canonical, paper)
+            else:
+                self._index_duplicate(paper, canonical)
+        logger.info(
+            f'Indexed {len(self.dedup_index)} papers for deduplication, '
+            f'found {len(self.duplicates)} near-duplicates'
+        )
+
+    def delete(self, pk: str) -> bool:
+        self.lexical_dirty_pks.add(pk)
+        self.timestamp_index.remove(pk)
+        self._remove_from_dedup_index(pk)
+        deleted = super().delete(pk)
+        self._remove_stale_passages(pk)
+        return deleted
+
+    def get(self, **conditions: Union[str, int, float, List[int], None]) -> List[Paper]:
+        """
+        With before and/or after, only papers with after < timestamp < before
+        are returned, in timestamp order; they are looked up in the timestamp
+        index, so the other conditions are checked on that range only.
+        """
+        before = self._get_timestamp_bound(conditions.pop('before', None))
+        after = self._get_timestamp_bound(conditions.pop('after', None))
+        if before is None and after is None:
+            return super().get(**conditions)
+        papers = [self.data[pk] for pk in self.timestamp_index.range(before, after)]
+        if not conditions:
+            return papers
+        return [
+            paper
+            for paper in papers
+            if all(getattr(paper, key) == value for key, value in conditions.items())
+        ]
+
+    @staticmethod
+    def _get_timestamp_bound(
+        value: Union[str, int, float, List[int], None],
+    ) -> Optional[int]:
+        if value is not None and not isinstance(value, int):
+            raise TypeError(f'Expected a timestamp, got {value!r}')
+        return value
+
+    def load_from_json(
+        self, load_path: str, with_embed: bool = False, class_name: Optional[str] = None
+    ) -> None:
+        super().load_from_json(load_path, with_embed, class_name)
+        self.lexical_dirty_pks = set(self.lexical_index.doc_ids) | set(self.data)
+        self.paper_keys = {}
+        self.timestamp_index = TimestampIndex()
+        for paper in self.data.values():
+            self._set_paper_key(paper)
+            self.timestamp_index.add(paper.pk, paper.timestamp)
+        # bulk loads are deduplicated like papers added one by one
+        self._rebuild_dedup_index()
+
+    def _is_passage_stale(self, pk: str) -> bool:
+        assert self.passage_index is not None
+        paper = self.data.get(pk)
+        return paper is None or self.passage_index.needs_update(
+            pk, paper.sections or {}
+        )
+
+    def _remove_stale_passages(self, pk: str) -> None:
+        # the next build_passage_index indexes the paper again
+        if (
+            self.passage_index is not None
+            and pk in self.passage_index.fingerprints
+            and self._is_passage_stale(pk)
+        ):
+            self.passage_index.remove(pk)
+
+    def _clear_embeds(
+        self,
+        data_embed: Optional[EmbedMatrix] = None,
+        embed_file: Optional[str] = None,
+    ) -> None:
+        super()._clear_embeds(data_embed, embed_file)
+        self.passage_index = None
+
+    def _update_lexical_index(self) -> None:
+        for pk in self.lexical_dirty_pks:
+            if pk in self.data:
+                paper = self.data[pk]
+                self.lexical_index.add(
+                    pk,
+                    ' '.join([paper.title, paper.abstract, *(paper.keywords or [])]),
+                )
+            else:
+                self.lexical_index.remove(pk)
+        self.lexical_dirty_pks.clear()
 
     def pull_papers(self, num: int, domain: Optional[str] = None) -> List[Paper]:
-        papers = get_recent_papers(domain=domain, max_results=num)
-        for paper in papers:
-            self.add(paper)
+        papers = [
+            self.upsert(paper)
+            for paper in get_recent_papers(domain=domain, max_results=num)
+        ]
         logger.info(f'Pulled {num} papers')
         return papers
 
@@ -40,54 +335,248 @@ class PaperDB(BaseDB[Paper]):
         domain: Optional[str] = None,
         author: Optional[str] = None,
     ) -> List[Paper]:
-        papers = get_related_papers(
-            query=query, domain=domain, author=author, num_results=num
-        )
-        for paper in papers:
-            self.add(paper)
+        # the same papers come back across queries and runs, merge them
+        papers = [
+            self.upsert(paper)
+            for paper in get_related_papers(
+                query=query, domain=domain, author=author, num_results=num
+            )
+        ]
         logger.info(f'Searched {num} papers')
         return papers
 
-    def match(self, query: str, num: int = 1, **conditions: Any) -> List[Paper]:
-        self._initialize_retriever()
-        papers = self.get(**conditions)
+    def match(
+        self,
+        query: str,
+        num: int = 1,
+        before: Optional[int] = None,
+        after: Optional[int] = None,
+        mmr_lambda: Optional[float] = None,
+        **conditions: Any,
+    ) -> List[Paper]:
+        return self.match_many([query], num, before, after, mmr_lambda, **conditions)[0]
 
-        query_embed = get_embed(
-            instructions=[query],
-            retriever_tokenizer=self.retriever_tokenizer,
-            retriever_model=self.retriever_model,
+    def match_many(
+        self,
+        queries: List[str],
+        num: int = 1,
+        before: Optional[int] = None,
+        after: Optional[int] = None,
+        mmr_lambda: Optional[float] = None,
+        **conditions: Any,
+    ) -> List[List[Paper]]:
+        """
+        With mmr_lambda set, the top mmr_candidate_num papers of every query are
+        re-ranked by maximal marginal relevance: 1 keeps the relevance order and
+        lower values favour papers unlike the ones already picked.
+        """
+        if not queries:
+            return []
+        # a time range is cut out of the timestamp index before anything is scored
+        candidate_pks = (
+            [paper.pk for paper in self.get(before=before, after=after, **conditions)]
+            if before is not None or after is not None
+            else None
         )
-        corpus_embed: List[torch.Tensor] = []
+        # one encoder pass and one scan of the corpus for all queries
+        if self.match_mode == 'hybrid':
+            results = self._search_hybrid(
+                queries, num, conditions, candidate_pks, mmr_lambda
+            )
+        else:
+            results = self._search_embeds(
+                queries, num, conditions, candidate_pks, mmr_lambda
+            )
+            results = self._add_pending_matches(
+                queries, results, num, conditions, candidate_pks
+            )
+        match_papers = [[self.data[pk] for pk, _ in result] for result in results]
+        logger.info(f'Matched papers: {match_papers}')
+        return match_papers
 
-        for paper in papers:
-            if paper.pk in self.data_embed:
-                corpus_embed.append(self.data_embed[paper.pk])
-            else:
-                paper_embed = get_embed(
-                    instructions=[paper.abstract],
-                    retriever_tokenizer=self.retriever_tokenizer,
-                    retriever_model=self.retriever_model,
+    def _search_hybrid(
+        self,
+        queries: List[str],
+        num: int,
+        conditions: Dict[str, Any],
+        candidate_pks: Optional[List[str]] = None,
+        mmr_lambda: Optional[float] = None,
+    ) -> List[List[Tuple[str, float]]]:
+        self._embed_ready()
+        # a new embedding set is only switched in between searches
+        with self._embed_lock:
+            self._update_lexical_index()
+            query_embeds = self._embed_queries(queries)
+            search_num = self._get_search_num(num, mmr_lambda)
+            if candidate_pks is None and conditions:
+                candidate_pks = [paper.pk for paper in self.get(**conditions)]
+            results: List[List[Tuple[str, float]]] = []
+            short = []
+            for i, query in enumerate(queries):
+                lexical = self.lexical_index.search(
+                    query, max(search_num, self.hybrid_candidate_num), candidate_pks
+                )
+                if len(lexical) < num:
+                    # too few term matches, rank this query densely instead
+                    short.append(i)
+                    results.append([])
+                    continue
+                dense = self._search_candidates(
+                    query_embeds[i : i + 1], len(lexical), [pk for pk, _ in lexical]
                 )[0]
-                corpus_embed.append(paper_embed)
-        topk_indexes = rank_topk(
-            query_embed=query_embed, corpus_embed=corpus_embed, num=num
+                results.append(self._fuse_rankings([lexical, dense], search_num))
+            if short:
+                dense_results = (
+                    self._search_query_embeds(
+                        query_embeds[short], search_num, conditions
+                    )
+                    if candidate_pks is None
+                    else self._search_candidates(
+                        query_embeds[short], search_num, candidate_pks
+                    )
+                )
+                for i, result in zip(short, dense_results):
+                    results[i] = result
+            return self._rerank_mmr(query_embeds, results, num, mmr_lambda)
+
+    def _fuse_rankings(
+        self, rankings: List[List[Tuple[str, float]]], num: int
+    ) -> List[Tuple[str, float]]:
+        # reciprocal rank fusion: scores of different rankers are not comparable
+        fused: Dict[str, float] = {}
+        for ranking in rankings:
+            for rank, (pk, _) in enumerate(ranking, 1):
+                fused[pk] = fused.get(pk, 0.0) + 1 / (self.rrf_k + rank)
+        return sorted(fused.items(), key=lambda item: item[1], reverse=True)[:num]
+
+    def _add_pending_matches(
+        self,
+        queries: List[str],
+        results: List[List[Tuple[str, float]]],
+        num: int,
+        conditions: Dict[str, Any],
+        candidate_pks: Optional[List[str]],
+    ) -> List[List[Tuple[str, float]]]:
+        """
+        Papers still queued for the background worker have no vector yet. They
+        are ranked by BM25 and fused with the dense results, so that papers
+        found by the last search can be matched right away.
+        """
+        pending_pks = self.get_pending_pks()
+        if candidate_pks is not None:
+            pending_pks &= set(candidate_pks)
+        pending_pks = {
+            pk
+            for pk in pending_pks
+            if pk in self.data
+            and all(
+                getattr(self.data[pk], key) == value
+                for key, value in conditions.items()
+            )
+        }
+        if not pending_pks:
+            return results
+        self._update_lexical_index()
+        fused_results = []
+        for query, result in zip(queries, results):
+            lexical = self.lexical_index.search(query, num, pending_pks)
+            fused_results.append(
+                self._fuse_rankings([result, lexical], num) if lexical else result
+            )
+        return fused_results
+
+    def build_passage_index(self, window: int = 128, stride: int = 96) -> None:
+        """
+        Embeds overlapping windows of the sections of every paper. Papers whose
+        sections did not change since the last build are skipped, and passage
+        texts go through the embedding cache when one is set.
+        """
+        if (
+            self.passage_index is None
+            or self.passage_index.window != window
+            or self.passage_index.stride != stride
+        ):
+            self.passage_index = PassageIndex(window, stride)
+        passage_index = self.passage_index
+        for pk in list(passage_index.fingerprints):
+            if pk not in self.data or not self.data[pk].sections:
+                passage_index.remove(pk)
+
+        papers = [
+            paper
+            for paper in self.data.values()
+            if paper.sections and passage_index.needs_update(paper.pk, paper.sections)
+        ]
+        chunks = [passage_index.chunk(paper.sections or {}) for paper in papers]
+        texts = [
+            (paper.sections or {})[section][start:end]
+            for paper, passages in zip(papers, chunks)
+            for section, start, end in passages
+        ]
+        embeds = torch.empty(0)
+        if texts:
+            self._initialize_retriever()
+            embeds = torch.cat(
+                get_embed(
+                    texts,
+                    self.retriever_tokenizer,
+                    self.retriever_model,
+                    embed_cache=self.embed_cache,
+                ),
+                0,
+            )
+        offset = 0
+        for paper, passages in zip(papers, chunks):
+            passage_index.add(
+                paper.pk,
+                paper.sections or {},
+                passages,
+                embeds[offset : offset + len(passages)],
+            )
+            offset += len(passages)
+        logger.info(f'Indexed {len(texts)} passages of {len(papers)} papers')
+
+    def match_passages(
+        self,
+        query: str,
+        num: int = 1,
+        passages_per_paper: int = 1,
+        **conditions: Any,
+    ) -> List[Tuple[Paper, List[Passage]]]:
+        """
+        Papers ranked by their best matching passage, each with the offsets and
+        text of its passages_per_paper best passages.
+        """
+        if self.passage_index is None:
+            raise ValueError('Call build_passage_index before match_passages')
+        candidate_pks = (
+            [paper.pk for paper in self.get(**conditions)] if conditions else None
         )
-        indexes = [index for topk_index in topk_indexes for index in topk_index]
-        match_papers = [papers[index] for index in indexes]
-        logger.info(f'Matched papers: {match_papers}')
-        return match_papers
+        results = self.passage_index.search(
+            self._embed_queries([query]), num, candidate_pks, passages_per_paper
+        )
+        matches = []
+        for pk, _, passages in results[0]:
+            if self._is_passage_stale(pk):
+                # sections changed in place since the last build
+                continue
+            paper = self.data[pk]
+            sections = paper.sections or {}
+            matches.append(
+                (
+                    paper,
+                    [
+                        passage._replace(
+                            text=sections[passage.section][passage.start : passage.end]
+                        )
+                        for passage in passages
+                    ],
+                )
+            )
+        logger.info(f'Matched passages of papers: {[paper for paper, _ in matches]}')
+        return matches
 
     def sample(self, num: int = 1, **conditions: Any) -> List[Paper]:
         papers = self.get(**conditions)
         random.shuffle(papers)
         return papers[:num]
-
-    def transform_to_embed(self) -> None:
-        self._initialize_retriever()
-
-        for paper_pk in self.data:
-            self.data_embed[paper_pk] = get_embed(
-                [self.data[paper_pk].abstract],
-                self.retriever_tokenizer,
-                self.retriever_model,
-            )[0]
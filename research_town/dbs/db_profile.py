@@ -1,8 +1,6 @@
 import random
 from typing import List, Literal, Optional, TypeVar
 
-from transformers import BertModel, BertTokenizer
-
 from ..configs import Config
 from ..data.data import Data, Profile
 from ..utils.logger import logger
@@ -11,7 +9,7 @@ from ..utils.profile_collector import (
     summarize_domain_prompting,
     write_bio_prompting,
 )
-from ..utils.retriever import get_embed, rank_topk
+from ..utils.retriever import DEFAULT_RETRIEVER_MODEL
 from .db_base import BaseDB
 
 T = TypeVar('T', bound=Data)
@@ -20,17 +18,22 @@ Role = Literal['reviewer', 'leader', 'member', 'chair'] | None
 
 
 class ProfileDB(BaseDB[Profile]):
-    def __init__(self, load_file_path: Optional[str] = None) -> None:
-        super().__init__(Profile, load_file_path)
-        self.retriever_tokenizer: Optional[BertTokenizer] = None
-        self.retriever_model: Optional[BertModel] = None
-
-    def _initialize_retriever(self) -> None:
-        if not self.retriever_tokenizer or not self.retriever_model:
-            self.retriever_tokenizer = BertTokenizer.from_pretrained(
-                'facebook/contriever'
-            )
-            self.retriever_model = BertModel.from_pretrained('facebook/contriever')
+    embed_field = 'bio'
+    filter_fields = (
+        'is_leader_candidate',
+        'is_member_candidate',
+        'is_reviewer_candidate',
+        'is_chair_candidate',
+        'domain',
+        'project_name',
+    )
+
+    def __init__(
+        self,
+        load_file_path: Optional[str] = None,
+        retriever_model_name: str = DEFAULT_RETRIEVER_MODEL,
+    ) -> None:
+        super().__init__(Profile, load_file_path, retriever_model_name)
 
     def pull_profiles(self, names: List[str], config: Config) -> None:
         for name in names:
@@ -56,29 +59,29 @@ class ProfileDB(BaseDB[Profile]):
             self.add(profile)
         self.transform_to_embed()
 
-    def transform_to_embed(self) -> None:
-        self._initialize_retriever()
-        for pk, profile in self.data.items():
-            self.data_embed[pk] = get_embed(
-                [profile.bio], self.retriever_tokenizer, self.retriever_model
-            )[0]
-
-    def match(self, query: str, role: Role, num: int = 1) -> List[Profile]:
-        self._initialize_retriever()
-
-        profiles = self.get(**{f'is_{role}_candidate': True})
-        query_embed = get_embed([query], self.retriever_tokenizer, self.retriever_model)
-
-        corpus_embed = [
-            self.data_embed.get(profile.pk)
-            or get_embed([profile.bio], self.retriever_tokenizer, self.retriever_model)[
-                0
-            ]
-            for profile in profiles
-        ]
-
-        topk_indexes = rank_topk(query_embed, corpus_embed, num=num)
-        matched_profiles = [profiles[idx] for topk in topk_indexes for idx in topk]
+    def match(
+        self,
+        query: str,
+        role: Role,
+        num: int = 1,
+        mmr_lambda: Optional[float] = None,
+    ) -> List[Profile]:
+        return self.match_many([query], role, num, mmr_lambda)[0]
+
+    def match_many(
+        self,
+        queries: List[str],
+        role: Role,
+        num: int = 1,
+        mmr_lambda: Optional[float] = None,
+    ) -> List[List[Profile]]:
+        if not queries:
+            return []
+        # one encoder pass and one scan of the corpus for all queries
+        results = self._search_embeds(
+            queries, num, {f'is_{role}_candidate': True}, mmr_lambda=mmr_lambda
+        )
+        matched_profiles = [[self.data[pk] for pk, _ in result] for result in results]
 
         logger.info(f'Matched profiles for role {role}: {matched_profiles}')
         return matched_profiles
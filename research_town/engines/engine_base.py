@@ -1,5 +1,5 @@
 import os
-from typing import Dict, List, Tuple, Type
+from typing import Any, Dict, List, Tuple, Type
 
 from ..agents import Agent, AgentManager
 from ..configs import Config
@@ -21,6 +21,8 @@ from ..data.data import (
 )
 from ..dbs import LogDB, PaperDB, ProfileDB, ProgressDB
 from ..envs.env_base import BaseEnv
+from ..utils.embed_cache import EmbedCache, QueryEmbedCache
+from ..utils.retriever import warmup_retriever
 
 
 class BaseEngine:
@@ -46,6 +48,8 @@ class BaseEngine:
         self.envs: Dict[str, BaseEnv] = {}
         self.transitions: Dict[Tuple[BaseEnv, str], BaseEnv] = {}
         self._setup_dbs()
+        if self.config.param.warmup_retriever:
+            self._warmup_retriever()
         self.set_envs()
         self.set_transitions()
 
@@ -53,6 +57,59 @@ class BaseEngine:
         self.profile_db.reset_role_availability()
         for db in [self.log_db, self.progress_db]:
             db.set_project_name(self.project_name)
+        self.profile_db.set_embed_format(self.config.param.embed_format)
+        self.paper_db.set_embed_format(self.config.param.embed_format)
+        self.profile_db.set_embed_storage(self.config.param.embed_storage)
+        self.paper_db.set_embed_storage(self.config.param.embed_storage)
+        # before the model, so that a background build already uses the options
+        self.profile_db.set_retriever_options(**self._retriever_options())
+        self.paper_db.set_retriever_options(**self._retriever_options())
+        # with reembed_in_background, loaded embeddings serve until the new ones are built
+        self.profile_db.set_retriever_model(
+            self.config.param.retriever_model, self.config.param.reembed_in_background
+        )
+        self.paper_db.set_retriever_model(
+            self.config.param.retriever_model, self.config.param.reembed_in_background
+        )
+        self.paper_db.set_match_mode(self.config.param.paper_match_mode)
+        self.paper_db.set_dedup_mode(
+            self.config.param.paper_dedup_mode, self.config.param.paper_dedup_threshold
+        )
+        self.profile_db.set_mmr_candidate_num(self.config.param.mmr_candidate_num)
+        self.paper_db.set_mmr_candidate_num(self.config.param.mmr_candidate_num)
+        if self.config.param.embed_cache_dir is not None:
+            embed_cache = EmbedCache(
+                self.config.param.embed_cache_dir,
+                max_entries=self.config.param.embed_cache_size,
+                cache_token_ids=self.config.param.cache_token_ids,
+            )
+            self.profile_db.set_embed_cache(embed_cache)
+            self.paper_db.set_embed_cache(embed_cache)
+        if self.config.param.query_cache_size > 0:
+            # one cache for both databases, match queries repeat across them
+            query_cache = QueryEmbedCache(self.config.param.query_cache_size)
+            self.profile_db.set_query_cache(query_cache)
+            self.paper_db.set_query_cache(query_cache)
+        if self.config.param.embed_in_background:
+            # papers found mid-simulation get embedded off the critical path
+            wait_timeout = self.config.param.embed_wait_timeout
+            self.profile_db.set_embed_worker(True, wait_timeout)
+            self.paper_db.set_embed_worker(True, wait_timeout)
+
+    def _retriever_options(self) -> Dict[str, Any]:
+        return {
+            'quantize': self.config.param.retriever_quantize,
+            'num_threads': self.config.param.retriever_num_threads,
+            'compile_mode': self.config.param.retriever_compile,
+        }
+
+    def _warmup_retriever(self) -> None:
+        # load the retriever models in the background while the first envs run
+        for model_name in {
+            self.profile_db.retriever_model_name,
+            self.paper_db.retriever_model_name,
+        }:
+            warmup_retriever(model_name, background=True, **self._retriever_options())
 
     def set_envs(self) -> None:
         pass
@@ -0,0 +1,253 @@
+from abc import ABC, abstractmethod
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type
+
+import numpy as np
+from numpy.typing import NDArray
+
+# returns the vectors of the given rows
+RowGetter = Callable[[NDArray[np.int64]], NDArray[np.float32]]
+
+
+class ANNIndex(ABC):
+    """
+    Approximate nearest-neighbour index over the rows of an embedding matrix.
+    The index only stores row ids; vectors are always read from the matrix that
+    owns them, so building an index does not duplicate the embeddings. Searches
+    get a function that returns the given rows, since a matrix may keep them in
+    more than one segment.
+    """
+
+    index_type: str = ''
+
+    def __init__(self, exact_threshold: int = 10000) -> None:
+        # below this many candidate rows an exact scan is both faster and exact
+        self.exact_threshold = exact_threshold
+
+    @abstractmethod
+    def build(self, embeds: NDArray[np.float32]) -> None:
+        pass
+
+    @abstractmethod
+    def add(self, rows: NDArray[np.int64], embeds: NDArray[np.float32]) -> None:
+        pass
+
+    @abstractmethod
+    def remove(self, rows: NDArray[np.int64]) -> None:
+        pass
+
+    @abstractmethod
+    def move(self, src_row: int, dst_row: int) -> None:
+        pass
+
+    @abstractmethod
+    def search(
+        self,
+        get_rows: RowGetter,
+        queries: NDArray[np.float32],
+        num: int,
+        candidate_rows: Optional[NDArray[np.int64]] = None,
+    ) -> List[List[Tuple[int, float]]]:
+        pass
+
+    @abstractmethod
+    def state_dict(self) -> Dict[str, NDArray[Any]]:
+        pass
+
+    @classmethod
+    @abstractmethod
+    def from_state_dict(
+        cls, state: Dict[str, NDArray[Any]], row_map: NDArray[np.int64], size: int
+    ) -> 'ANNIndex':
+        """
+        Restores an index whose saved row i now lives at row_map[i] (-1 if it
+        has been deleted since) in a matrix of the given size.
+        """
+
+
+class IVFIndex(ANNIndex):
+    """
+    Inverted-file index: rows are bucketed by their nearest k-means centroid and
+    a query only scans the rows of its nprobe closest buckets. Raising nprobe
+    trades latency for recall; nprobe == nlist is an exhaustive scan.
+    """
+
+    index_type = 'ivf'
+
+    def __init__(
+        self,
+        nlist: Optional[int] = None,
+        nprobe: int = 8,
+        kmeans_iters: int = 10,
+        train_size_per_list: int = 64,
+        exact_threshold: int = 10000,
+        seed: int = 0,
+    ) -> None:
+        super().__init__(exact_threshold)
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.kmeans_iters = kmeans_iters
+        self.train_size_per_list = train_size_per_list
+        self.seed = seed
+        self.centroids: Optional[NDArray[np.float32]] = None
+        self.assign = np.full(0, -1, dtype=np.int64)
+        self.lists: List[NDArray[np.int64]] = []
+
+    def _nearest_centroids(self, embeds: NDArray[np.float32]) -> NDArray[np.int64]:
+        assert self.centroids is not None
+        assign = np.empty(len(embeds), dtype=np.int64)
+        for start in range(0, len(embeds), 65536):
+            scores = embeds[start : start + 65536] @ self.centroids.T
+            assign[start : start + 65536] = scores.argmax(axis=1)
+        return assign
+
+    def _train(self, embeds: NDArray[np.float32], nlist: int) -> NDArray[np.float32]:
+        rng = np.random.default_rng(self.seed)
+        train_size = min(len(embeds), nlist * self.train_size_per_list)
+        sample = embeds[np.sort(rng.choice(len(embeds), train_size, replace=False))]
+        centroids: NDArray[np.float32] = sample[
+            rng.choice(len(sample), nlist, replace=False)
+        ].astype(np.float32)
+        for _ in range(self.kmeans_iters):
+            self.centroids = centroids
+            assign = self._nearest_centroids(sample)
+            order = np.argsort(assign, kind='stable')
+            lists, starts = np.unique(assign[order], return_index=True)
+            centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+            centroids[lists] = np.add.reduceat(sample[order], starts, axis=0)
+            # spherical k-means: centroids live on the unit sphere like the rows
+            centroids /= np.maximum(
+                np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12
+            )
+        return centroids
+
+    def _set_lists(self) -> None:
+        order = np.argsort(self.assign, kind='stable')
+        bounds = np.searchsorted(self.assign[order], np.arange(len(self.lists) + 1))
+        self.lists = [
+            order[bounds[i] : bounds[i + 1]].astype(np.int64)
+            for i in range(len(self.lists))
+        ]
+
+    def build(self, embeds: NDArray[np.float32]) -> None:
+        nlist = self.nlist or max(1, int(round(np.sqrt(len(embeds)))))
+        nlist = min(nlist, len(embeds))
+        self.nlist = nlist
+        self.centroids = self._train(embeds, nlist)
+        self.assign = self._nearest_centroids(embeds)
+        self.lists = [np.empty(0, dtype=np.int64)] * nlist
+        self._set_lists()
+
+    def add(self, rows: NDArray[np.int64], embeds: NDArray[np.float32]) -> None:
+        rows = np.asarray(rows, dtype=np.int64)
+        if len(rows) == 0:
+            return
+        if rows.max() >= len(self.assign):
+            capacity = max(int(rows.max()) + 1, 2 * len(self.assign))
+            assign = np.full(capacity, -1, dtype=np.int64)
+            assign[: len(self.assign)] = self.assign
+            self.assign = assign
+        lists = self._nearest_centroids(embeds)
+        self.assign[rows] = lists
+        order = np.argsort(lists, kind='stable')
+        unique_lists, starts = np.unique(lists[order], return_index=True)
+        for list_id, list_rows in zip(unique_lists, np.split(rows[order], starts[1:])):
+            self.lists[list_id] = np.concatenate([self.lists[list_id], list_rows])
+
+    def remove(self, rows: NDArray[np.int64]) -> None:
+        for row in np.asarray(rows, dtype=np.int64):
+            list_id = self.assign[row]
+            self.lists[list_id] = self.lists[list_id][self.lists[list_id] != row]
+            self.assign[row] = -1
+
+    def move(self, src_row: int, dst_row: int) -> None:
+        list_id = self.assign[src_row]
+        list_rows = self.lists[list_id]
+        list_rows[list_rows == src_row] = dst_row
+        self.assign[dst_row] = list_id
+        self.assign[src_row] = -1
+
+    def search(
+        self,
+        get_rows: RowGetter,
+        queries: NDArray[np.float32],
+        num: int,
+        candidate_rows: Optional[NDArray[np.int64]] = None,
+        nprobe: Optional[int] = None,
+    ) -> List[List[Tuple[int, float]]]:
+        assert self.centroids is not None
+        nprobe = min(nprobe or self.nprobe, len(self.lists))
+        centroid_scores = queries @ self.centroids.T
+        probes = np.argpartition(-centroid_scores, nprobe - 1, axis=1)[:, :nprobe]
+        mask: Optional[NDArray[np.bool_]] = None
+        if candidate_rows is not None:
+            mask = np.zeros(len(self.assign), dtype=bool)
+            mask[candidate_rows] = True
+
+        results: List[List[Tuple[int, float]]] = []
+        for query, probe in zip(queries, probes):
+            rows = np.concatenate([self.lists[list_id] for list_id in probe])
+            if mask is not None:
+                rows = rows[mask[rows]]
+            k = min(num, len(rows))
+            if k == 0:
+                results.append([])
+                continue
+            scores = get_rows(rows) @ query
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top], kind='stable')]
+            results.append(
+                [(int(row), float(score)) for row, score in zip(rows[top], scores[top])]
+            )
+        return results
+
+    def state_dict(self) -> Dict[str, NDArray[Any]]:
+        assert self.centroids is not None
+        return {
+            'centroids': self.centroids,
+            'assign': self.assign,
+            'params': np.array(
+                [
+                    self.nprobe,
+                    self.kmeans_iters,
+                    self.train_size_per_list,
+                    self.exact_threshold,
+                    self.seed,
+                ]
+            ),
+        }
+
+    @classmethod
+    def from_state_dict(
+        cls, state: Dict[str, NDArray[Any]], row_map: NDArray[np.int64], size: int
+    ) -> 'IVFIndex':
+        nprobe, kmeans_iters, train_size_per_list, exact_threshold, seed = (
+            int(param) for param in state['params']
+        )
+        index = cls(
+            nlist=len(state['centroids']),
+            nprobe=nprobe,
+            kmeans_iters=kmeans_iters,
+            train_size_per_list=train_size_per_list,
+            exact_threshold=exact_threshold,
+            seed=seed,
+        )
+        index.centroids = state['centroids'].astype(np.float32)
+        index.assign = np.full(size, -1, dtype=np.int64)
+        saved_assign = state['assign'][: len(row_map)]
+        kept = (row_map >= 0) & (saved_assign >= 0)
+        index.assign[row_map[kept]] = saved_assign[kept]
+        index.lists = [np.empty(0, dtype=np.int64)] * len(index.centroids)
+        index._set_lists()
+        return index
+
+
+ANN_INDEXES: Dict[str, Type[ANNIndex]] = {IVFIndex.index_type: IVFIndex}
+
+
+def load_ann_index(
+    state: Dict[str, Any], row_map: NDArray[np.int64], size: int
+) -> ANNIndex:
+    index_type = str(state['index_type'])
+    if index_type not in ANN_INDEXES:
+        raise ValueError(f'Unknown ANN index type: {index_type}')
+    return ANN_INDEXES[index_type].from_state_dict(state, row_map, size)
@@ -0,0 +1,160 @@
+import math
+import re
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from numpy.typing import NDArray
+
+
+def tokenize(text: str) -> List[str]:
+    return re.findall(r'\w+', text.lower())
+
+
+class BM25Index:
+    """
+    Incrementally maintained BM25 inverted index. Postings are appended as
+    documents arrive and deleted documents are tombstoned, so adds and removes
+    never rebuild the index; postings are compacted once half of the documents
+    are dead. Scoring accumulates the postings of the query terms with numpy.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75) -> None:
+        self.k1 = k1
+        self.b = b
+        self.doc_pks: List[Optional[str]] = []
+        self.doc_ids: Dict[str, int] = {}
+        self.doc_lens: List[int] = []
+        self.doc_terms: List[Tuple[str, ...]] = []
+        self.total_len = 0
+        self.postings: Dict[str, Tuple[List[int], List[int]]] = {}
+        self.doc_freqs: Counter[str] = Counter()
+        self._arrays: Dict[str, Tuple[NDArray[np.int64], NDArray[np.float32]]] = {}
+        # BM25 weights of every posting of a term, valid until the corpus changes
+        self._term_scores: Dict[str, NDArray[np.float32]] = {}
+        self._doc_lens: Optional[NDArray[np.float32]] = None
+        self._alive: Optional[NDArray[np.bool_]] = None
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    def __contains__(self, pk: object) -> bool:
+        return pk in self.doc_ids
+
+    def add(self, pk: str, text: str) -> None:
+        self.remove(pk)
+        term_freqs = Counter(tokenize(text))
+        doc_id = len(self.doc_pks)
+        self.doc_pks.append(pk)
+        self.doc_ids[pk] = doc_id
+        doc_len = sum(term_freqs.values())
+        self.doc_lens.append(doc_len)
+        self.doc_terms.append(tuple(term_freqs))
+        self.total_len += doc_len
+        for term, freq in term_freqs.items():
+            doc_ids, freqs = self.postings.setdefault(term, ([], []))
+            doc_ids.append(doc_id)
+            freqs.append(freq)
+            self.doc_freqs[term] += 1
+            self._arrays.pop(term, None)
+        self._term_scores = {}
+        self._doc_lens = None
+        self._alive = None
+
+    def remove(self, pk: str) -> None:
+        doc_id = self.doc_ids.pop(pk, None)
+        if doc_id is None:
+            return
+        self.doc_pks[doc_id] = None
+        self.total_len -= self.doc_lens[doc_id]
+        for term in self.doc_terms[doc_id]:
+            self.doc_freqs[term] -= 1
+        self.doc_terms[doc_id] = ()
+        self._term_scores = {}
+        self._alive = None
+        if len(self.doc_pks) > 1024 and len(self.doc_ids) < len(self.doc_pks) // 2:
+            self._compact()
+
+    def _compact(self) -> None:
+        new_ids = np.full(len(self.doc_pks), -1, dtype=np.int64)
+        alive = [doc_id for doc_id, pk in enumerate(self.doc_pks) if pk is not None]
+        new_ids[alive] = np.arange(len(alive))
+        self.doc_pks = [self.doc_pks[doc_id] for doc_id in alive]
+        self.doc_lens = [self.doc_lens[doc_id] for doc_id in alive]
+        self.doc_terms = [self.doc_terms[doc_id] for doc_id in alive]
+        self.doc_ids = {pk: i for i, pk in enumerate(self.doc_pks) if pk is not None}
+        postings: Dict[str, Tuple[List[int], List[int]]] = {}
+        for term, (doc_ids, freqs) in self.postings.items():
+            kept = [
+                (int(new_ids[doc_id]), freq)
+                for doc_id, freq in zip(doc_ids, freqs)
+                if new_ids[doc_id] >= 0
+            ]
+            if kept:
+                postings[term] = ([doc_id for doc_id, _ in kept], [f for _, f in kept])
+        self.postings = postings
+        self.doc_freqs = +self.doc_freqs
+        self._arrays = {}
+        self._term_scores = {}
+        self._doc_lens = None
+        self._alive = None
+
+    def _term_arrays(self, term: str) -> Tuple[NDArray[np.int64], NDArray[np.float32]]:
+        arrays = self._arrays.get(term)
+        if arrays is None:
+            doc_ids, freqs = self.postings[term]
+            arrays = (
+                np.array(doc_ids, dtype=np.int64),
+                np.array(freqs, dtype=np.float32),
+            )
+            self._arrays[term] = arrays
+        return arrays
+
+    def search(
+        self,
+        query: str,
+        num: int,
+        candidate_pks: Optional[Iterable[str]] = None,
+    ) -> List[Tuple[str, float]]:
+        terms = [term for term in set(tokenize(query)) if self.doc_freqs[term] > 0]
+        if not terms or num <= 0:
+            return []
+        if self._doc_lens is None:
+            self._doc_lens = np.array(self.doc_lens, dtype=np.float32)
+        if self._alive is None:
+            self._alive = np.array([pk is not None for pk in self.doc_pks])
+        doc_num = len(self.doc_ids)
+        avg_len = self.total_len / max(doc_num, 1)
+
+        scores = np.zeros(len(self.doc_pks), dtype=np.float32)
+        for term in terms:
+            doc_ids, freqs = self._term_arrays(term)
+            term_scores = self._term_scores.get(term)
+            if term_scores is None:
+                doc_freq = self.doc_freqs[term]
+                idf = math.log(1 + (doc_num - doc_freq + 0.5) / (doc_freq + 0.5))
+                norms = self.k1 * (
+                    1 - self.b + self.b * self._doc_lens[doc_ids] / max(avg_len, 1e-9)
+                )
+                term_scores = (idf * freqs * (self.k1 + 1) / (freqs + norms)).astype(
+                    np.float32
+                )
+                self._term_scores[term] = term_scores
+            # a document appears at most once in the postings of a term
+            scores[doc_ids] += term_scores
+        allowed = self._alive
+        if candidate_pks is not None:
+            allowed = np.zeros(len(self.doc_pks), dtype=bool)
+            allowed[
+                [self.doc_ids[pk] for pk in candidate_pks if pk in self.doc_ids]
+            ] = True
+            allowed &= self._alive
+        scores[~allowed] = 0
+
+        matched = np.flatnonzero(scores > 0)
+        if len(matched) > num:
+            matched = matched[np.argpartition(-scores[matched], num - 1)[:num]]
+        matched = matched[np.argsort(-scores[matched], kind='stable')]
+        return [
+            (str(self.doc_pks[doc_id]), float(scores[doc_id])) for doc_id in matched
+        ]
@@ -0,0 +1,210 @@
+import multiprocessing
+import os
+import time
+from functools import partial
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import torch
+
+from .embed_cache import EmbedCache
+from .logger import logger
+from .retriever import (
+    DEFAULT_RETRIEVER_MODEL,
+    BackendTokenizer,
+    EmbeddingBackend,
+    RetrieverModel,
+    RetrieverTokenizer,
+    get_embed_batch,
+    get_embed_model_key,
+    get_embed_settings,
+    get_embed_stats,
+    get_embedding_backend,
+    get_model_variant,
+    get_retriever,
+)
+
+# state of a pool worker, set once by _init_worker
+_worker_state: Dict[str, Any] = {}
+
+
+def _init_worker(
+    cache_dir: str,
+    max_entries: int,
+    cache_token_ids: bool,
+    model_name: str,
+    num_threads: int,
+    quantize: bool,
+    compile_mode: Optional[str],
+    backend: Optional[Tuple[BackendTokenizer, EmbeddingBackend]],
+) -> None:
+    # a worker owns its model and its cache connection for its whole lifetime
+    torch.set_num_threads(num_threads)
+    retriever_tokenizer: RetrieverTokenizer
+    retriever_model: RetrieverModel
+    if backend is not None:
+        # the parent's backend, with whatever it was fitted on
+        retriever_tokenizer, retriever_model = backend
+    else:
+        retriever_tokenizer, retriever_model = get_retriever(
+            model_name,
+            quantize=quantize,
+            num_threads=num_threads,
+            compile_mode=compile_mode,
+        )
+    _worker_state['embed_cache'] = EmbedCache(
+        cache_dir, max_entries=max_entries, cache_token_ids=cache_token_ids
+    )
+    _worker_state['retriever_tokenizer'] = retriever_tokenizer
+    _worker_state['retriever_model'] = retriever_model
+
+
+def _embed_chunk(
+    texts: List[str], batch_size: int, max_length: int
+) -> Tuple[int, int, float, float, float]:
+    embed_cache: EmbedCache = _worker_state['embed_cache']
+    misses = embed_cache.misses
+    embed_stats = get_embed_stats()
+    start_time = time.perf_counter()
+    get_embed_batch(
+        texts,
+        _worker_state['retriever_tokenizer'],
+        _worker_state['retriever_model'],
+        batch_size=batch_size,
+        max_length=max_length,
+        embed_cache=embed_cache,
+    )
+    seconds = time.perf_counter() - start_time
+    new_stats = get_embed_stats()
+    return (
+        os.getpid(),
+        embed_cache.misses - misses,
+        seconds,
+        new_stats['tokenize_seconds'] - embed_stats['tokenize_seconds'],
+        new_stats['model_seconds'] - embed_stats['model_seconds'],
+    )
+
+
+def bulk_embed(
+    texts: Sequence[str],
+    cache_dir: str,
+    model_name: str = DEFAULT_RETRIEVER_MODEL,
+    num_workers: Optional[int] = None,
+    num_threads: Optional[int] = None,
+    batch_size: int = 16,
+    max_length: int = 512,
+    chunk_size: int = 256,
+    max_entries: Optional[int] = None,
+    quantize: bool = False,
+    compile_mode: Optional[str] = None,
+    cache_token_ids: bool = False,
+) -> Dict[int, Dict[str, float]]:
+    """
+    Embeds texts across a pool of worker processes into the embedding cache at
+    cache_dir. Texts that are already cached are skipped, so an interrupted run
+    resumes where it stopped. A Hugging Face model is only loaded by the workers,
+    once each, and uses num_threads intra-op threads (by default the cores split
+    evenly between workers); this process picks the cache entries of its variant
+    from quantize alone. With cache_token_ids the token ids are stored in the
+    cache too, so a rerun with another model variant skips tokenization. Returns
+    the texts embedded, seconds spent (in total, tokenizing and in the model) and
+    throughput of every worker keyed by its pid.
+    """
+    texts = list(dict.fromkeys(texts))
+    # the cache must hold the whole corpus or the first chunks get evicted again
+    max_entries = max(max_entries or 100000, len(texts))
+    backend: Optional[Tuple[BackendTokenizer, EmbeddingBackend]] = None
+    variant = get_model_variant(quantize)
+    if get_embedding_backend(model_name) is not None:
+        # backends are cheap to get and small, so they are pickled to the workers
+        # as they are and a fitted one embeds with its own weights
+        retriever_tokenizer, retriever_model = get_retriever(model_name)
+        assert isinstance(retriever_tokenizer, BackendTokenizer)
+        assert isinstance(retriever_model, EmbeddingBackend)
+        backend = (retriever_tokenizer, retriever_model)
+        variant = retriever_model.variant
+    model_key = get_embed_model_key(model_name, variant)
+    settings = get_embed_settings(max_length)
+    embed_cache = EmbedCache(
+        cache_dir, max_entries=max_entries, cache_token_ids=cache_token_ids
+    )
+    cached = embed_cache.get_many(model_key, settings, texts)
+    embed_cache.close()
+    pending = [text for text, embed in zip(texts, cached) if embed is None]
+    logger.info(
+        f'Bulk embedding {len(pending)} texts, '
+        f'{len(texts) - len(pending)} already cached'
+    )
+    if not pending:
+        return {}
+
+    cpu_count = os.cpu_count() or 1
+    num_workers = max(1, min(num_workers or cpu_count, len(pending)))
+    num_threads = num_threads or max(1, cpu_count // num_workers)
+    chunks = [
+        pending[start : start + chunk_size]
+        for start in range(0, len(pending), chunk_size)
+    ]
+    stats: Dict[int, Dict[str, float]] = {}
+    start_time = time.perf_counter()
+    # spawn instead of fork: torch thread pools do not survive a fork
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(
+        num_workers,
+        initializer=_init_worker,
+        initargs=(
+            cache_dir,
+            max_entries,
+            cache_token_ids,
+            model_name,
+            num_threads,
+            quantize,
+            compile_mode,
+            backend,
+        ),
+    ) as pool:
+        for chunk_num, (
+            pid,
+            embedded,
+            seconds,
+            tokenize_seconds,
+            model_seconds,
+        ) in enumerate(
+            pool.imap_unordered(
+                partial(_embed_chunk, batch_size=batch_size, max_length=max_length),
+                chunks,
+            ),
+            1,
+        ):
+            worker_stats = stats.setdefault(
+                pid,
+                {
+                    'chunks': 0,
+                    'embedded': 0,
+                    'seconds': 0.0,
+                    'tokenize_seconds': 0.0,
+                    'model_seconds': 0.0,
+                },
+            )
+            worker_stats['chunks'] += 1
+            worker_stats['embedded'] += embedded
+            worker_stats['seconds'] += seconds
+            worker_stats['tokenize_seconds'] += tokenize_seconds
+            worker_stats['model_seconds'] += model_seconds
+            logger.info(
+                f'Embedded chunk {chunk_num}/{len(chunks)} '
+                f'({time.perf_counter() - start_time:.1f}s elapsed)'
+            )
+
+    for pid, worker_stats in stats.items():
+        worker_stats['texts_per_sec'] = (
+            worker_stats['embedded'] / worker_stats['seconds']
+            if worker_stats['seconds'] > 0
+            else 0.0
+        )
+        logger.info(
+            f'Worker {pid} embedded {int(worker_stats["embedded"])} texts at '
+            f'{worker_stats["texts_per_sec"]:.1f} texts/s '
+            f'({worker_stats["tokenize_seconds"]:.2f}s tokenizing, '
+            f'{worker_stats["model_seconds"]:.2f}s in the model)'
+        )
+    return stats
@@ -0,0 +1,128 @@
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Set
+
+from .logger import logger
+
+
+class EmbedBuild:
+    """
+    A new embedding set built on a background thread by build_fn. Records
+    added, changed or deleted while it runs are collected as stale, so that
+    they are embedded again before the new set is switched in. progress()
+    reports how far the build got; state is 'running', 'done', 'cancelled' or
+    'failed'.
+    """
+
+    def __init__(
+        self,
+        retriever_model_name: str,
+        embed_storage: str,
+        pks: List[str],
+        build_fn: Callable[['EmbedBuild'], None],
+        batch_size: int = 64,
+    ) -> None:
+        self.retriever_model_name = retriever_model_name
+        self.embed_storage = embed_storage
+        self.pks = pks
+        self.batch_size = batch_size
+        self.state = 'running'
+        self.error: Optional[str] = None
+        # embedding version of the DB once the set is switched in
+        self.version: Optional[int] = None
+        self.done = 0
+        self.start_time = time.perf_counter()
+        self.end_time: Optional[float] = None
+        self._stale_pks: Set[str] = set()
+        self._lock = threading.Lock()
+        self._finished = threading.Event()
+        self._build_fn = build_fn
+        self._thread = threading.Thread(
+            target=self._run, name='embed-build', daemon=True
+        )
+        self._thread.start()
+
+    @property
+    def running(self) -> bool:
+        return self.state == 'running'
+
+    @property
+    def cancelled(self) -> bool:
+        return self.state == 'cancelled'
+
+    def cancel(self) -> None:
+        """The current set stays; a batch in progress is finished and dropped."""
+        with self._lock:
+            if self.state == 'running':
+                self.state = 'cancelled'
+                self.end_time = time.perf_counter()
+        self._finished.set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Whether the build ended, successfully or not, within timeout seconds."""
+        return self._finished.wait(timeout)
+
+    def advance(self, num: int) -> None:
+        with self._lock:
+            before = self.done * 10 // max(len(self.pks), 1)
+            self.done += num
+            after = self.done * 10 // max(len(self.pks), 1)
+        if after > before:
+            logger.info(
+                f'Embedded {self.done}/{len(self.pks)} records with '
+                f"'{self.retriever_model_name}'"
+            )
+
+    def mark_stale(self, pk: str) -> None:
+        with self._lock:
+            if self.state == 'running':
+                self._stale_pks.add(pk)
+
+    def take_stale(self) -> Set[str]:
+        with self._lock:
+            stale_pks = self._stale_pks
+            self._stale_pks = set()
+        return stale_pks
+
+    def finish(self, version: int) -> None:
+        with self._lock:
+            self.version = version
+            self.state = 'done'
+            self.end_time = time.perf_counter()
+        self._finished.set()
+
+    def progress(self) -> Dict[str, Any]:
+        with self._lock:
+            elapsed = (self.end_time or time.perf_counter()) - self.start_time
+            rate = self.done / elapsed if elapsed > 0 else 0.0
+            eta = (
+                (len(self.pks) - self.done) / rate
+                if rate > 0 and self.state == 'running'
+                else None
+            )
+            return {
+                'state': self.state,
+                'retriever_model': self.retriever_model_name,
+                'embed_storage': self.embed_storage,
+                'version': self.version,
+                'done': self.done,
+                'total': len(self.pks),
+                'elapsed_s': elapsed,
+                'texts_per_s': rate,
+                'eta_s': eta,
+                'error': self.error,
+            }
+
+    def _run(self) -> None:
+        try:
+            self._build_fn(self)
+        except Exception as e:
+            # the current embedding set stays in use
+            logger.exception(
+                f"Building embeddings with '{self.retriever_model_name}' failed"
+            )
+            with self._lock:
+                self.state = 'failed'
+                self.error = repr(e)
+                self.end_time = time.perf_counter()
+        self._finished.set()
@@ -0,0 +1,261 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+
+from .logger import logger
+
+
+class EmbedCache:
+    """
+    On-disk embedding cache keyed by hash(model name, embedding settings, text).
+    Entries beyond max_entries are evicted in least-recently-used order, and all
+    entries of a model are dropped once it is used with different settings.
+    Quantized or fitted variants of a model are cached under their own model
+    key (see get_embed_model_key), so they do not invalidate each other.
+    With cache_token_ids, the token ids of every text are kept as well, keyed
+    by tokenizer instead of model, so they survive model and settings changes.
+    """
+
+    def __init__(
+        self, cache_dir: str, max_entries: int = 100000, cache_token_ids: bool = False
+    ) -> None:
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_path = os.path.join(cache_dir, 'embed_cache.sqlite')
+        self.max_entries = max_entries
+        self.cache_token_ids = cache_token_ids
+        self.hits = 0
+        self.misses = 0
+        self._settings: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            self.cache_path, timeout=30, check_same_thread=False
+        )
+        with self._lock, self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS embeds ('
+                'key TEXT PRIMARY KEY, model_name TEXT, embed BLOB, last_used INTEGER)'
+            )
+            self._conn.execute(
+                'CREATE INDEX IF NOT EXISTS embeds_last_used ON embeds (last_used)'
+            )
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS settings ('
+                'model_name TEXT PRIMARY KEY, settings TEXT)'
+            )
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS token_ids ('
+                'key TEXT PRIMARY KEY, ids BLOB, last_used INTEGER)'
+            )
+            self._conn.execute(
+                'CREATE INDEX IF NOT EXISTS token_ids_last_used '
+                'ON token_ids (last_used)'
+            )
+
+    @staticmethod
+    def make_key(model_name: str, settings: str, text: str) -> str:
+        return hashlib.sha256(
+            '\x00'.join([model_name, settings, text]).encode('utf-8')
+        ).hexdigest()
+
+    def _check_settings(self, model_name: str, settings: str) -> None:
+        if self._settings.get(model_name) == settings:
+            return
+        row = self._conn.execute(
+            'SELECT settings FROM settings WHERE model_name = ?', (model_name,)
+        ).fetchone()
+        if row is not None and row[0] != settings:
+            logger.info(
+                f"Embedding settings of '{model_name}' changed, "
+                'invalidating its cached embeddings'
+            )
+            self._conn.execute('DELETE FROM embeds WHERE model_name = ?', (model_name,))
+        self._conn.execute(
+            'INSERT OR REPLACE INTO settings (model_name, settings) VALUES (?, ?)',
+            (model_name, settings),
+        )
+        self._settings[model_name] = settings
+
+    def get_many(
+        self, model_name: str, settings: str, texts: Sequence[str]
+    ) -> List[Optional[torch.Tensor]]:
+        keys = [self.make_key(model_name, settings, text) for text in texts]
+        found: Dict[str, torch.Tensor] = {}
+        with self._lock, self._conn:
+            self._check_settings(model_name, settings)
+            for start in range(0, len(keys), 500):
+                chunk = keys[start : start + 500]
+                placeholders = ','.join('?' * len(chunk))
+                rows = self._conn.execute(
+                    f'SELECT key, embed FROM embeds WHERE key IN ({placeholders})',
+                    chunk,
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = torch.from_numpy(
+                        np.frombuffer(blob, dtype=np.float32).copy()
+                    )
+                self._conn.execute(
+                    f'UPDATE embeds SET last_used = ? WHERE key IN ({placeholders})',
+                    [time.time_ns(), *chunk],
+                )
+        embeds = [found.get(key) for key in keys]
+        hit_num = sum(embed is not None for embed in embeds)
+        self.hits += hit_num
+        self.misses += len(embeds) - hit_num
+        return embeds
+
+    def put_many(
+        self,
+        model_name: str,
+        settings: str,
+        texts: Sequence[str],
+        embeds: torch.Tensor,
+    ) -> None:
+        now = time.time_ns()
+        rows = [
+            (
+                self.make_key(model_name, settings, text),
+                model_name,
+                embed.detach().to(torch.float32).numpy().tobytes(),
+                now,
+            )
+            for text, embed in zip(texts, embeds)
+        ]
+        with self._lock, self._conn:
+            self._check_settings(model_name, settings)
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO embeds (key, model_name, embed, last_used) '
+                'VALUES (?, ?, ?, ?)',
+                rows,
+            )
+            self._evict()
+
+    def get_token_ids_many(
+        self, tokenizer_key: str, texts: Sequence[str]
+    ) -> List[Optional[List[int]]]:
+        keys = [self.make_key(tokenizer_key, '', text) for text in texts]
+        found: Dict[str, List[int]] = {}
+        with self._lock, self._conn:
+            for start in range(0, len(keys), 500):
+                chunk = keys[start : start + 500]
+                placeholders = ','.join('?' * len(chunk))
+                rows = self._conn.execute(
+                    f'SELECT key, ids FROM token_ids WHERE key IN ({placeholders})',
+                    chunk,
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.int32).tolist()
+                self._conn.execute(
+                    f'UPDATE token_ids SET last_used = ? WHERE key IN ({placeholders})',
+                    [time.time_ns(), *chunk],
+                )
+        return [found.get(key) for key in keys]
+
+    def put_token_ids_many(
+        self,
+        tokenizer_key: str,
+        texts: Sequence[str],
+        token_ids: Sequence[Sequence[int]],
+    ) -> None:
+        now = time.time_ns()
+        rows = [
+            (
+                self.make_key(tokenizer_key, '', text),
+                np.asarray(ids, dtype=np.int32).tobytes(),
+                now,
+            )
+            for text, ids in zip(texts, token_ids)
+        ]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO token_ids (key, ids, last_used) '
+                'VALUES (?, ?, ?)',
+                rows,
+            )
+            self._evict('token_ids')
+
+    def _evict(self, table: str = 'embeds') -> None:
+        (entry_num,) = self._conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()
+        if entry_num > self.max_entries:
+            self._conn.execute(
+                f'DELETE FROM {table} WHERE key IN '
+                f'(SELECT key FROM {table} ORDER BY last_used LIMIT ?)',
+                (entry_num - self.max_entries,),
+            )
+
+    def __len__(self) -> int:
+        with self._lock:
+            (entry_num,) = self._conn.execute('SELECT COUNT(*) FROM embeds').fetchone()
+        return int(entry_num)
+
+    def clear(self) -> None:
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM embeds')
+            self._conn.execute('DELETE FROM settings')
+            self._conn.execute('DELETE FROM token_ids')
+            self._settings.clear()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class QueryEmbedCache:
+    """
+    Bounded in-memory LRU of query embeddings keyed by (model name, embedding
+    settings, text), for query strings that get matched over and over. It has
+    the same get_many / put_many interface as EmbedCache.
+    """
+
+    def __init__(self, max_entries: int = 1024) -> None:
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[Tuple[str, str, str], torch.Tensor] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(
+        self, model_name: str, settings: str, texts: Sequence[str]
+    ) -> List[Optional[torch.Tensor]]:
+        embeds: List[Optional[torch.Tensor]] = []
+        with self._lock:
+            for text in texts:
+                key = (model_name, settings, text)
+                embed = self._entries.get(key)
+                if embed is not None:
+                    self._entries.move_to_end(key)
+                embeds.append(embed)
+            hit_num = sum(embed is not None for embed in embeds)
+            self.hits += hit_num
+            self.misses += len(embeds) - hit_num
+        return embeds
+
+    def put_many(
+        self,
+        model_name: str,
+        settings: str,
+        texts: Sequence[str],
+        embeds: torch.Tensor,
+    ) -> None:
+        with self._lock:
+            for text, embed in zip(texts, embeds):
+                key = (model_name, settings, text)
+                self._entries[key] = embed.detach().to(torch.float32).clone()
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,677 @@
+import io
+import tempfile
+import threading
+from typing import (
+    Any,
+    Dict,
+    Hashable,
+    Iterable,
+    Iterator,
+    List,
+    MutableMapping,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
+
+import numpy as np
+import torch
+from numpy.typing import NDArray
+
+from .ann_index import ANNIndex, load_ann_index
+
+EMBED_STORAGES = ('float32', 'float16', 'int8')
+
+
+def int8_mm(a: torch.Tensor, b: torch.Tensor) -> torch.Tensor:
+    """a @ b.t() for int8 inputs, accumulated in int32 where torch supports it."""
+    try:
+        return torch._int_mm(a, b.t())
+    except (AttributeError, RuntimeError):
+        return a.to(torch.float32) @ b.to(torch.float32).t()
+
+
+class EmbedMatrix(MutableMapping[str, torch.Tensor]):
+    """
+    Growable, contiguous matrix of L2-normalized embeddings with a pk <-> row
+    index. It behaves like the Dict[str, torch.Tensor] it replaces, while queries
+    are scored with a single matmul into a preallocated score buffer, or through
+    an optional ANN index that is kept in sync with every insert and delete.
+
+    With float16 or int8 storage the exact scan reads compact codes instead and
+    only the top rescore_factor * num candidates are rescored in float32. The
+    float32 rows are then touched for rescoring only, so they are kept in a
+    file rather than on the heap and most of them never leave the disk.
+
+    Filter columns hold one integer-coded value per row, so that equality
+    conditions turn into a boolean mask that is applied to the score buffer.
+
+    Rows wrapped from a memory-mapped file form a read-only base: inserts go to a
+    delta after it, and replaced or deleted base rows are only retired, so
+    the mapping is never copied. Rewriting the file merges the two again.
+    """
+
+    def __init__(self, initial_capacity: int = 1024) -> None:
+        self.initial_capacity = initial_capacity
+        # physical rows [0, len(base)) are mapped, the rest live in the matrix
+        self.base: Optional[torch.Tensor] = None
+        self.matrix: Optional[torch.Tensor] = None
+        # set when the delta rows live in an unlinked temporary file, the matrix
+        # then only carries their shape
+        self.spill_file: Optional[io.BufferedRandom] = None
+        self.dead_rows: Set[int] = set()
+        self.pks: List[str] = []
+        self.rows: Dict[str, int] = {}
+        self.index: Optional[ANNIndex] = None
+        self.storage = 'float32'
+        self.rescore_factor = 4
+        self.codes: Optional[torch.Tensor] = None
+        self.code_scales: Optional[torch.Tensor] = None
+        # column name -> per-row value codes (-1 if unset) and value -> code
+        self.columns: Dict[str, torch.Tensor] = {}
+        self.column_codes: Dict[str, Dict[Hashable, int]] = {}
+        self._scores: Optional[torch.Tensor] = None
+        self._lock = threading.RLock()
+
+    @classmethod
+    def from_normalized(cls, pks: List[str], matrix: torch.Tensor) -> 'EmbedMatrix':
+        """
+        Wraps rows that are already L2-normalized without copying them, e.g. a
+        memory-mapped embedding file. They are never written; later inserts are
+        appended to a growable matrix.
+        """
+        if len(set(pks)) != len(pks) or len(pks) != matrix.shape[0]:
+            raise ValueError('Expected one row per unique pk')
+        embed_matrix = cls()
+        if len(pks) > 0:
+            embed_matrix.base = matrix
+            embed_matrix.pks = list(pks)
+            embed_matrix.rows = {pk: row for row, pk in enumerate(pks)}
+        return embed_matrix
+
+    @property
+    def dim(self) -> Optional[int]:
+        if self.base is not None:
+            return self.base.shape[1]
+        return None if self.matrix is None else self.matrix.shape[1]
+
+    @property
+    def base_size(self) -> int:
+        return 0 if self.base is None else self.base.shape[0]
+
+    @property
+    def capacity(self) -> int:
+        return self.base_size + (0 if self.matrix is None else self.matrix.shape[0])
+
+    def embeds(self) -> torch.Tensor:
+        """The live rows in iteration order, a view unless rows were retired."""
+        if self.base is None and self.spill_file is None:
+            assert self.matrix is not None
+            return self.matrix[: len(self.pks)]
+        if len(self.pks) == self.base_size and not self.dead_rows:
+            assert self.base is not None
+            return self.base
+        return self._gather(self._live_rows())
+
+    def blocks(
+        self, block_size: int = 65536
+    ) -> Iterator[Tuple[List[str], torch.Tensor]]:
+        """The live rows in iteration order, block_size physical rows at a time."""
+        with self._lock:
+            for start in range(0, len(self.pks), block_size):
+                rows = torch.arange(start, min(len(self.pks), start + block_size))
+                if self.dead_rows:
+                    rows = rows[self._live_mask()[rows]]
+                yield [self.pks[row] for row in rows.tolist()], self._gather(rows)
+
+    def _gather(self, rows: torch.Tensor) -> torch.Tensor:
+        # copies physical rows out of the mapped base and the delta
+        if self.base is None:
+            return self._read_rows(rows)
+        if self.matrix is None:
+            return self.base[rows]
+        in_base = rows < self.base_size
+        gathered = torch.empty((len(rows), self.base.shape[1]), dtype=torch.float32)
+        gathered[in_base] = self.base[rows[in_base]]
+        gathered[~in_base] = self._read_rows(rows[~in_base] - self.base_size)
+        return gathered
+
+    def _gather_numpy(self, rows: NDArray[np.int64]) -> NDArray[np.float32]:
+        gathered: NDArray[np.float32] = self._gather(torch.from_numpy(rows)).numpy()
+        return gathered
+
+    def _live_mask(self) -> torch.Tensor:
+        mask = torch.ones(len(self.pks), dtype=torch.bool)
+        if self.dead_rows:
+            mask[list(self.dead_rows)] = False
+        return mask
+
+    def _live_rows(self) -> torch.Tensor:
+        if not self.dead_rows:
+            return torch.arange(len(self.pks))
+        return self._live_mask().nonzero().squeeze(1)
+
+    @staticmethod
+    def normalize(embeds: torch.Tensor) -> torch.Tensor:
+        embeds = embeds.detach().to(torch.float32).reshape(embeds.shape[0], -1)
+        norms = embeds.norm(p=2, dim=1, keepdim=True)
+        # vectors that are already unit length are kept bit-identical so that a
+        # save/load round trip does not drift
+        needs_norm = (norms - 1).abs() > 1e-6
+        return torch.where(needs_norm, embeds / norms.clamp(min=1e-12), embeds)
+
+    @staticmethod
+    def quantize(
+        normalized: torch.Tensor, storage: str
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        if storage == 'float16':
+            return normalized.to(torch.float16), None
+        # int8 with one scale per vector, so that a few large components of one
+        # row do not cost precision on every other row
+        scales = normalized.abs().amax(dim=1).clamp(min=1e-12) / 127
+        codes = torch.round(normalized / scales[:, None]).clamp(-127, 127)
+        return codes.to(torch.int8), scales
+
+    def set_storage(self, storage: str, rescore_factor: int = 4) -> None:
+        if storage not in EMBED_STORAGES:
+            raise ValueError(f'Unsupported embedding storage: {storage}')
+        with self._lock:
+            self.storage = storage
+            self.rescore_factor = rescore_factor
+            self.codes = None
+            self.code_scales = None
+            spill = storage != 'float32'
+            if self.matrix is not None and (self.spill_file is not None) != spill:
+                self._resize(self.matrix.shape[0])
+            if storage != 'float32' and self.dim is not None:
+                self._reserve_codes()
+                assert self.codes is not None
+                for start in range(0, len(self.pks), 65536):
+                    rows = torch.arange(start, min(len(self.pks), start + 65536))
+                    self._write_codes(rows, self._gather(rows))
+
+    def memory_usage(self) -> Dict[str, int]:
+        """
+        Bytes allocated on the heap for float32 rows and for the codes used for
+        scanning, and bytes of float32 rows that are read from a file instead,
+        either mapped or spilled.
+        """
+        usage = {'float32': 0, 'codes': 0, 'file': 0}
+        if self.base is not None:
+            usage['file'] += self.base.numel() * 4
+        if self.matrix is not None:
+            key = 'float32' if self.spill_file is None else 'file'
+            usage[key] += self.matrix.numel() * 4
+        for codes in (self.codes, self.code_scales):
+            if codes is not None:
+                usage['codes'] += codes.numel() * codes.element_size()
+        return usage
+
+    def _reserve_codes(self) -> None:
+        assert self.dim is not None
+        if self.codes is not None and self.codes.shape[0] >= self.capacity:
+            return
+        codes = torch.empty(
+            (self.capacity, self.dim),
+            dtype=torch.float16 if self.storage == 'float16' else torch.int8,
+        )
+        code_scales = (
+            torch.empty(self.capacity, dtype=torch.float32)
+            if self.storage == 'int8'
+            else None
+        )
+        if self.codes is not None:
+            codes[: len(self.pks)] = self.codes[: len(self.pks)]
+        if self.code_scales is not None and code_scales is not None:
+            code_scales[: len(self.pks)] = self.code_scales[: len(self.pks)]
+        self.codes = codes
+        self.code_scales = code_scales
+
+    def _write_codes(self, rows: torch.Tensor, normalized: torch.Tensor) -> None:
+        assert self.codes is not None
+        codes, scales = self.quantize(normalized, self.storage)
+        self.codes[rows] = codes
+        if self.code_scales is not None and scales is not None:
+            self.code_scales[rows] = scales
+
+    @staticmethod
+    def _column_key(value: Any) -> Hashable:
+        # list-valued fields such as Profile.domain compare as a whole
+        return tuple(value) if isinstance(value, list) else value
+
+    def set_columns(
+        self, pks: Sequence[str], columns: Dict[str, Sequence[Any]]
+    ) -> None:
+        """Sets the filter column values of rows that are already stored."""
+        with self._lock:
+            rows = torch.tensor([self.rows[pk] for pk in pks], dtype=torch.long)
+            for name, values in columns.items():
+                codes = self.column_codes.setdefault(name, {})
+                column = self.columns.get(name)
+                if column is None or column.shape[0] < self.capacity:
+                    grown = torch.full((self.capacity,), -1, dtype=torch.int32)
+                    if column is not None:
+                        grown[: len(self.pks)] = column[: len(self.pks)]
+                    column = self.columns[name] = grown
+                column[rows] = torch.tensor(
+                    [
+                        codes.setdefault(self._column_key(value), len(codes))
+                        for value in values
+                    ],
+                    dtype=torch.int32,
+                )
+
+    def has_columns(self, names: Iterable[str]) -> bool:
+        return all(name in self.columns for name in names)
+
+    def mask(self, conditions: Dict[str, Any]) -> torch.Tensor:
+        """Rows whose filter columns equal all the given values."""
+        with self._lock:
+            mask = torch.ones(len(self.pks), dtype=torch.bool)
+            for name, value in conditions.items():
+                if name not in self.columns:
+                    raise ValueError(f'No filter column: {name}')
+                code = self.column_codes[name].get(self._column_key(value))
+                if code is None:
+                    return torch.zeros(len(self.pks), dtype=torch.bool)
+                mask &= self.columns[name][: len(self.pks)] == code
+            return mask
+
+    def _allocate(self, capacity: int, dim: int) -> None:
+        if self.storage == 'float32':
+            self.matrix = torch.empty((capacity, dim), dtype=torch.float32)
+            self.spill_file = None
+            return
+        # float32 rows that are only read for rescoring live in a file, rather
+        # than on the heap
+        self.spill_file = tempfile.TemporaryFile()
+        self.matrix = torch.empty((capacity, dim), dtype=torch.float32, device='meta')
+
+    def _resize(self, capacity: int) -> None:
+        # moves the delta into a new matrix, on the heap or spilled by storage
+        assert self.matrix is not None
+        matrix, spill_file = self.matrix, self.spill_file
+        self._allocate(capacity, matrix.shape[1])
+        used = len(self.pks) - self.base_size
+        for start in range(0, used, 65536):
+            end = min(used, start + 65536)
+            if spill_file is None:
+                rows = matrix[start:end]
+            else:
+                spill_file.seek(start * matrix.shape[1] * 4)
+                rows = torch.empty((end - start, matrix.shape[1]), dtype=torch.float32)
+                spill_file.readinto(rows.numpy().data)
+            self._write_rows(torch.arange(start, end), rows)
+
+    @staticmethod
+    def _row_runs(rows: torch.Tensor) -> Iterator[Tuple[int, int]]:
+        # (start, end) positions of the runs of consecutive rows
+        row_array = rows.numpy()
+        starts = np.flatnonzero(np.diff(row_array, prepend=-2) != 1)
+        return zip(starts.tolist(), np.append(starts[1:], len(row_array)).tolist())
+
+    def _read_rows(self, rows: torch.Tensor) -> torch.Tensor:
+        # rows are indices into the delta
+        assert self.matrix is not None
+        if self.spill_file is None:
+            return self.matrix[rows]
+        # read with one call per run of rows; faulting them in through a mapping
+        # would map whole page cache folios around every row into this process
+        dim = self.matrix.shape[1]
+        read = torch.empty((len(rows), dim), dtype=torch.float32)
+        for start, end in self._row_runs(rows):
+            self.spill_file.seek(int(rows[start]) * dim * 4)
+            self.spill_file.readinto(read[start:end].numpy().data)
+        return read
+
+    def _write_rows(self, rows: torch.Tensor, normalized: torch.Tensor) -> None:
+        # rows are indices into the delta
+        assert self.matrix is not None
+        if self.spill_file is None:
+            self.matrix[rows] = normalized
+            return
+        dim = self.matrix.shape[1]
+        values = np.ascontiguousarray(normalized.numpy(), dtype=np.float32)
+        for start, end in self._row_runs(rows):
+            self.spill_file.seek(int(rows[start]) * dim * 4)
+            self.spill_file.write(values[start:end].data)
+        self.spill_file.flush()
+
+    def _reserve(self, size: int, dim: int) -> None:
+        if self.dim is not None and dim != self.dim:
+            raise ValueError(f'Embedding dimension {dim} does not match {self.dim}')
+        # only the delta grows, the mapped base is left as it is
+        delta_size = size - self.base_size
+        if self.matrix is None:
+            self._allocate(max(self.initial_capacity, delta_size), dim)
+        elif delta_size > self.matrix.shape[0]:
+            self._resize(max(delta_size, 2 * self.matrix.shape[0]))
+            self._scores = None
+        for name, column in self.columns.items():
+            if column.shape[0] < self.capacity:
+                grown = torch.full((self.capacity,), -1, dtype=torch.int32)
+                grown[: len(self.pks)] = column[: len(self.pks)]
+                self.columns[name] = grown
+        if self.storage != 'float32':
+            self._reserve_codes()
+
+    def add_many(self, pks: Iterable[str], embeds: torch.Tensor) -> None:
+        pks = list(pks)
+        if len(pks) == 0:
+            return
+        normalized = self.normalize(embeds)
+        if len(set(pks)) != len(pks):
+            # the last embedding of a repeated pk wins, as with dict.update
+            last = {pk: i for i, pk in enumerate(pks)}
+            pks = list(last)
+            normalized = normalized[list(last.values())]
+        with self._lock:
+            base_size = self.base_size
+            # new pks and replaced base rows both take a new row in the delta
+            new_num = sum(self.rows.get(pk, -1) < base_size for pk in pks)
+            self._reserve(len(self.pks) + new_num, normalized.shape[1])
+            assert self.matrix is not None
+            rows = []
+            replaced_rows = []
+            for pk in pks:
+                row = self.rows.get(pk)
+                if row is not None:
+                    replaced_rows.append(row)
+                if row is None or row < base_size:
+                    new_row = len(self.pks)
+                    self.rows[pk] = new_row
+                    self.pks.append(pk)
+                    if row is not None:
+                        for column in self.columns.values():
+                            column[new_row] = column[row]
+                        self._retire(row)
+                    row = new_row
+                rows.append(row)
+            row_index = torch.tensor(rows, dtype=torch.long)
+            self._write_rows(row_index - base_size, normalized)
+            if self.codes is not None:
+                self._write_codes(row_index, normalized)
+            if self.index is not None:
+                self.index.remove(np.array(replaced_rows, dtype=np.int64))
+                self.index.add(np.array(rows, dtype=np.int64), normalized.numpy())
+
+    def __setitem__(self, pk: str, embed: torch.Tensor) -> None:
+        self.add_many([pk], embed.reshape(1, -1))
+
+    def __getitem__(self, pk: str) -> torch.Tensor:
+        with self._lock:
+            row = self.rows[pk]
+            return self._gather(torch.tensor([row]))
+
+    def _retire(self, row: int) -> None:
+        # a mapped row is never written, it is skipped from now on instead
+        self.dead_rows.add(row)
+        self.pks[row] = ''
+        for column in self.columns.values():
+            column[row] = -1
+
+    def __delitem__(self, pk: str) -> None:
+        with self._lock:
+            row = self.rows.pop(pk)
+            if self.index is not None:
+                self.index.remove(np.array([row], dtype=np.int64))
+            if row < self.base_size:
+                self._retire(row)
+                return
+            last_pk = self.pks.pop()
+            for column in self.columns.values():
+                column[row] = column[len(self.pks)]
+                column[len(self.pks)] = -1
+            # keep rows contiguous by moving the last row into the freed slot
+            if last_pk != pk:
+                assert self.matrix is not None
+                base_size = self.base_size
+                last = len(self.pks) - base_size
+                self._write_rows(
+                    torch.tensor([row - base_size]),
+                    self._read_rows(torch.tensor([last])),
+                )
+                if self.codes is not None:
+                    self.codes[row] = self.codes[len(self.pks)]
+                if self.code_scales is not None:
+                    self.code_scales[row] = self.code_scales[len(self.pks)]
+                self.pks[row] = last_pk
+                self.rows[last_pk] = row
+                if self.index is not None:
+                    self.index.move(len(self.pks), row)
+
+    def __contains__(self, pk: object) -> bool:
+        return pk in self.rows
+
+    def __iter__(self) -> Iterator[str]:
+        if not self.dead_rows:
+            return iter(list(self.pks))
+        return iter(
+            [pk for row, pk in enumerate(self.pks) if row not in self.dead_rows]
+        )
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def clear(self) -> None:
+        with self._lock:
+            self.base = None
+            self.matrix = None
+            self.spill_file = None
+            self.dead_rows = set()
+            self.pks = []
+            self.rows = {}
+            self.index = None
+            self.codes = None
+            self.code_scales = None
+            self.columns = {}
+            self.column_codes = {}
+            self._scores = None
+
+    def build_index(self, index: ANNIndex) -> None:
+        with self._lock:
+            if len(self.rows) == 0:
+                # the index is trained on the rows, there is nothing to train on
+                raise ValueError('Cannot build an index over an empty matrix')
+            if self.base is None:
+                index.build(self.embeds().numpy())
+            else:
+                # trained on the mapped rows as they are, the delta is added
+                index.build(self.base.numpy())
+                delta_rows = np.arange(self.base_size, len(self.pks), dtype=np.int64)
+                if len(delta_rows) > 0:
+                    index.add(delta_rows, self._gather_numpy(delta_rows))
+                index.remove(np.array(sorted(self.dead_rows), dtype=np.int64))
+            self.index = index
+
+    def drop_index(self) -> None:
+        with self._lock:
+            self.index = None
+
+    def save_index(self, save_path: str) -> None:
+        with self._lock:
+            if self.index is None:
+                raise ValueError('No index has been built')
+            with open(save_path, 'wb') as f:
+                np.savez(
+                    f,
+                    pks=np.array(self.pks, dtype=str),
+                    index_type=np.array(self.index.index_type),
+                    **self.index.state_dict(),
+                )
+
+    def load_index(self, load_path: str) -> None:
+        with np.load(load_path) as f:
+            state = {key: f[key] for key in f.files}
+        with self._lock:
+            # rows are matched by pk, so the index survives reordering, and
+            # records added after it was saved are inserted incrementally
+            row_map = np.array(
+                [self.rows.get(pk, -1) for pk in state.pop('pks').tolist()],
+                dtype=np.int64,
+            )
+            index = load_ann_index(state, row_map, len(self.pks))
+            missing = np.setdiff1d(
+                self._live_rows().numpy(), row_map[row_map >= 0], assume_unique=True
+            )
+            if len(missing) > 0:
+                index.add(missing, self._gather_numpy(missing))
+            self.index = index
+
+    def search(
+        self,
+        query_embeds: torch.Tensor,
+        num: int,
+        candidate_pks: Optional[Iterable[str]] = None,
+        exact: bool = False,
+        conditions: Optional[Dict[str, Any]] = None,
+        **search_params: Any,
+    ) -> List[List[Tuple[str, float]]]:
+        query_embeds = self.normalize(query_embeds)
+        with self._lock:
+            if len(self.rows) == 0:
+                return [[] for _ in range(query_embeds.shape[0])]
+            candidate_rows: Optional[torch.Tensor] = None
+            if candidate_pks is not None:
+                candidate_rows = torch.tensor(
+                    [self.rows[pk] for pk in candidate_pks if pk in self.rows],
+                    dtype=torch.long,
+                )
+            mask: Optional[torch.Tensor] = None
+            if conditions:
+                mask = self.mask(conditions)
+                if candidate_rows is not None:
+                    candidate_mask = torch.zeros_like(mask)
+                    candidate_mask[candidate_rows] = True
+                    mask &= candidate_mask
+                    candidate_rows = None
+            if mask is not None:
+                candidate_num = int(mask.sum())
+            elif candidate_rows is not None:
+                candidate_num = len(candidate_rows)
+            else:
+                candidate_num = len(self.rows)
+            if (
+                exact
+                or self.index is None
+                or candidate_num <= self.index.exact_threshold
+            ):
+                return self._search_exact(query_embeds, num, candidate_rows, mask)
+
+            if mask is not None:
+                candidate_rows = mask.nonzero().squeeze(1)
+            results = self.index.search(
+                self._gather_numpy,
+                query_embeds.numpy(),
+                num,
+                None if candidate_rows is None else candidate_rows.numpy(),
+                **search_params,
+            )
+            matches = [
+                [(self.pks[row], score) for row, score in result] for result in results
+            ]
+            # fall back to an exact scan when the probed buckets ran short
+            short = [
+                i
+                for i, result in enumerate(results)
+                if len(result) < min(num, candidate_num)
+            ]
+            if short:
+                exact_matches = self._search_exact(
+                    query_embeds[short], num, candidate_rows
+                )
+                for i, match in zip(short, exact_matches):
+                    matches[i] = match
+            return matches
+
+    def _search_exact(
+        self,
+        query_embeds: torch.Tensor,
+        num: int,
+        candidate_rows: Optional[torch.Tensor] = None,
+        mask: Optional[torch.Tensor] = None,
+    ) -> List[List[Tuple[str, float]]]:
+        size = len(self.pks)
+        query_num = query_embeds.shape[0]
+        if candidate_rows is not None and len(candidate_rows) * 4 < size:
+            # few candidates: score their float32 rows instead of the whole matrix
+            scores = query_embeds @ self._gather(candidate_rows).t()
+            top_scores, top_index = torch.topk(
+                scores, min(num, len(candidate_rows)), dim=1
+            )
+            return [
+                [(self.pks[row], score) for row, score in zip(rows, row_scores)]
+                for rows, row_scores in zip(
+                    candidate_rows[top_index].tolist(), top_scores.tolist()
+                )
+            ]
+        if self._scores is None or self._scores.numel() < query_num * size:
+            self._scores = torch.empty(query_num * self.capacity, dtype=torch.float32)
+        scores = self._scores[: query_num * size].view(query_num, size)
+        if self.codes is not None:
+            self._score_codes(query_embeds, scores)
+        elif self.base is None:
+            assert self.matrix is not None
+            torch.mm(query_embeds, self.matrix[:size].t(), out=scores)
+        else:
+            base_size = self.base_size
+            scores[:, :base_size] = query_embeds @ self.base.t()
+            if self.matrix is not None and size > base_size:
+                scores[:, base_size:] = (
+                    query_embeds @ self.matrix[: size - base_size].t()
+                )
+        if candidate_rows is None and mask is None and self.dead_rows:
+            mask = self._live_mask()
+
+        if candidate_rows is not None:
+            scores = scores.index_select(1, candidate_rows)
+        candidate_num = scores.shape[1]
+        if mask is not None:
+            # masked rows can never be selected since top-k stops at the mask size
+            scores.masked_fill_(~mask, float('-inf'))
+            candidate_num = int(mask.sum())
+        if self.codes is None:
+            top_scores, top_index = torch.topk(scores, min(num, candidate_num), dim=1)
+        else:
+            top_index = torch.topk(
+                scores, min(num * self.rescore_factor, candidate_num), dim=1
+            ).indices
+        if candidate_rows is not None:
+            top_index = candidate_rows[top_index]
+        if self.codes is not None:
+            top_scores, top_index = self._rescore(query_embeds, top_index, num)
+        return [
+            [(self.pks[row], score) for row, score in zip(rows, row_scores)]
+            for rows, row_scores in zip(top_index.tolist(), top_scores.tolist())
+        ]
+
+    def _score_codes(self, query_embeds: torch.Tensor, scores: torch.Tensor) -> None:
+        assert self.codes is not None
+        query_codes, query_scales = self.quantize(query_embeds, self.storage)
+        for start in range(0, scores.shape[1], 65536):
+            end = min(scores.shape[1], start + 65536)
+            if query_scales is None:
+                scores[:, start:end] = query_codes @ self.codes[start:end].t()
+            else:
+                assert self.code_scales is not None
+                scores[:, start:end] = (
+                    int8_mm(query_codes, self.codes[start:end])
+                    * query_scales[:, None]
+                    * self.code_scales[start:end]
+                )
+
+    def _rescore(
+        self, query_embeds: torch.Tensor, candidate_index: torch.Tensor, num: int
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        if candidate_index.shape[1] == 0:
+            return torch.empty(candidate_index.shape), candidate_index
+        # only the shortlisted float32 rows are read
+        candidates = self._gather(candidate_index.flatten()).view(
+            *candidate_index.shape, -1
+        )
+        exact_scores = torch.bmm(candidates, query_embeds.unsqueeze(2)).squeeze(2)
+        top_scores, order = torch.topk(
+            exact_scores, min(num, exact_scores.shape[1]), dim=1
+        )
+        return top_scores, candidate_index.gather(1, order)
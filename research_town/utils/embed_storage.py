@@ -0,0 +1,285 @@
+import json
+import mmap
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+from numpy.typing import NDArray
+
+EMBED_DATA_SUFFIX = '.embeds.bin'
+EMBED_INDEX_SUFFIX = '.embeds.json'
+
+
+def embed_file_exists(path_prefix: str) -> bool:
+    return os.path.exists(path_prefix + EMBED_INDEX_SUFFIX) and os.path.exists(
+        path_prefix + EMBED_DATA_SUFFIX
+    )
+
+
+def save_embed_file(
+    path_prefix: str, pks: List[str], embeds: NDArray[np.float32]
+) -> None:
+    """
+    Writes the rows as one raw row-major float32 file plus a JSON index with the
+    pk of every row. Both files are written to temporary names and renamed, so a
+    process that still maps the previous version keeps reading consistent data.
+    """
+    embeds = np.ascontiguousarray(embeds, dtype=np.float32)
+    if len(pks) != len(embeds):
+        raise ValueError(f'Got {len(pks)} pks for {len(embeds)} embeddings')
+    data_path = path_prefix + EMBED_DATA_SUFFIX
+    index_path = path_prefix + EMBED_INDEX_SUFFIX
+    with open(data_path + '.tmp', 'wb') as f:
+        embeds.tofile(f)
+    with open(index_path + '.tmp', 'w') as f:
+        json.dump(
+            {
+                'dtype': 'float32',
+                'dim': int(embeds.shape[1]) if embeds.ndim == 2 else 0,
+                'pks': pks,
+            },
+            f,
+        )
+    os.replace(data_path + '.tmp', data_path)
+    os.replace(index_path + '.tmp', index_path)
+
+
+def write_embed_file(
+    path_prefix: str, blocks: Iterable[Tuple[List[str], NDArray[np.float32]]]
+) -> List[str]:
+    """
+    Writes the blocks one after the other, so that only one of them is in memory
+    at a time, and renames the files into place like save_embed_file once the
+    last one is written. Returns the pks of the new file.
+    """
+    pks: List[str] = []
+    dim = 0
+    data_path = path_prefix + EMBED_DATA_SUFFIX
+    index_path = path_prefix + EMBED_INDEX_SUFFIX
+    try:
+        with open(data_path + '.tmp', 'wb') as f:
+            for block_pks, embeds in blocks:
+                if len(block_pks) != len(embeds):
+                    raise ValueError(
+                        f'Got {len(block_pks)} pks for {len(embeds)} embeddings'
+                    )
+                if not block_pks:
+                    continue
+                if dim and embeds.shape[1] != dim:
+                    raise ValueError(
+                        f'Embedding dimension {embeds.shape[1]} does not match {dim}'
+                    )
+                dim = int(embeds.shape[1])
+                np.ascontiguousarray(embeds, dtype=np.float32).tofile(f)
+                pks.extend(block_pks)
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump({'dtype': 'float32', 'dim': dim, 'pks': pks}, f)
+    except BaseException:
+        for path in (data_path + '.tmp', index_path + '.tmp'):
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+    os.replace(data_path + '.tmp', data_path)
+    os.replace(index_path + '.tmp', index_path)
+    return pks
+
+
+def remove_embed_file(path_prefix: str) -> None:
+    for path in (path_prefix + EMBED_DATA_SUFFIX, path_prefix + EMBED_INDEX_SUFFIX):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def load_embed_index(path_prefix: str) -> Tuple[List[str], int, str]:
+    with open(path_prefix + EMBED_INDEX_SUFFIX, 'r') as f:
+        index = json.load(f)
+    return index['pks'], int(index['dim']), str(index['dtype'])
+
+
+def load_embed_file(path_prefix: str) -> Tuple[List[str], NDArray[np.float32]]:
+    """
+    Maps the raw file copy-on-write: loading is O(1), pages are read lazily and
+    shared between processes, and in-place updates stay private to the process.
+    """
+    pks, dim, dtype = load_embed_index(path_prefix)
+    if len(pks) == 0:
+        return pks, np.empty((0, dim), dtype=np.float32)
+    embeds: NDArray[np.float32] = np.memmap(
+        path_prefix + EMBED_DATA_SUFFIX,
+        dtype=np.dtype(dtype),
+        mode='c',
+        shape=(len(pks), dim),
+    )
+    return pks, embeds
+
+
+def read_embed_rows(path_prefix: str, dim: int, rows: List[int]) -> NDArray[np.float32]:
+    """Copies the given rows out of the file, reading only their pages."""
+    if not rows:
+        return np.empty((0, dim), dtype=np.float32)
+    embeds = np.memmap(path_prefix + EMBED_DATA_SUFFIX, dtype=np.float32, mode='r')
+    selected = np.array(embeds.reshape(-1, dim)[rows], dtype=np.float32)
+    del embeds
+    return selected
+
+
+def _merge_topk(
+    best: Tuple[NDArray[np.float32], NDArray[np.int64]],
+    scores: NDArray[np.float32],
+    rows: NDArray[np.int64],
+    num: int,
+) -> Tuple[NDArray[np.float32], NDArray[np.int64]]:
+    merged_scores = np.concatenate([best[0], scores], axis=1)
+    merged_rows = np.concatenate([best[1], rows], axis=1)
+    if merged_scores.shape[1] > num:
+        top = np.argpartition(-merged_scores, num - 1, axis=1)[:, :num]
+        merged_scores = np.take_along_axis(merged_scores, top, axis=1)
+        merged_rows = np.take_along_axis(merged_rows, top, axis=1)
+    return merged_scores, merged_rows
+
+
+def _search_block(
+    data_path: str,
+    start: int,
+    end: int,
+    dim: int,
+    queries: NDArray[np.float32],
+    num: int,
+    row_mask: Optional[NDArray[np.bool_]],
+) -> Tuple[NDArray[np.float32], NDArray[np.int64]]:
+    # every block gets its own short-lived mapping, so neither resident memory
+    # nor address space grow with the size of the file
+    offset = start * dim * 4
+    map_offset = offset - offset % mmap.ALLOCATIONGRANULARITY
+    with open(data_path, 'rb') as f:
+        with mmap.mmap(
+            f.fileno(),
+            end * dim * 4 - map_offset,
+            offset=map_offset,
+            access=mmap.ACCESS_READ,
+        ) as mapped:
+            block = np.frombuffer(
+                mapped,
+                dtype=np.float32,
+                count=(end - start) * dim,
+                offset=offset - map_offset,
+            ).reshape(end - start, dim)
+            if row_mask is None:
+                rows = np.arange(start, end)
+                scores = queries @ block.T
+            else:
+                # only the selected rows are read and scored
+                rows = start + np.flatnonzero(row_mask[start:end])
+                scores = queries @ block[rows - start].T
+            del block
+    return _merge_topk(
+        (
+            np.empty((len(queries), 0), dtype=np.float32),
+            np.empty((len(queries), 0), dtype=np.int64),
+        ),
+        scores,
+        np.broadcast_to(rows, scores.shape),
+        num,
+    )
+
+
+def search_embed_file(
+    path_prefix: str,
+    dim: int,
+    query_embeds: NDArray[np.float32],
+    num: int,
+    row_mask: Optional[NDArray[np.bool_]] = None,
+    block_size: int = 16384,
+    num_threads: Optional[int] = None,
+) -> List[List[Tuple[int, float]]]:
+    """
+    Exact top-k over an embedding file of any size. Blocks of block_size rows
+    are scored by a thread pool and merged into a running top-k, so peak memory
+    is about num_threads blocks. Queries must be L2-normalized and rows where
+    row_mask is False are skipped, blocks without selected rows are not read at
+    all. Returns (row, score) pairs.
+    """
+    data_path = path_prefix + EMBED_DATA_SUFFIX
+    row_num = os.path.getsize(data_path) // (dim * 4) if dim else 0
+    queries = np.ascontiguousarray(query_embeds, dtype=np.float32)
+    best: Tuple[NDArray[np.float32], NDArray[np.int64]] = (
+        np.empty((len(queries), 0), dtype=np.float32),
+        np.empty((len(queries), 0), dtype=np.int64),
+    )
+    blocks = [
+        (start, min(start + block_size, row_num))
+        for start in range(0, row_num, block_size)
+        if row_mask is None or row_mask[start : start + block_size].any()
+    ]
+    if num > 0 and blocks:
+        with ThreadPoolExecutor(num_threads or os.cpu_count() or 1) as executor:
+            futures = [
+                executor.submit(
+                    _search_block, data_path, start, end, dim, queries, num, row_mask
+                )
+                for start, end in blocks
+            ]
+            for future in as_completed(futures):
+                best = _merge_topk(best, *future.result(), num)
+    order = np.argsort(-best[0], axis=1, kind='stable')
+    best_scores = np.take_along_axis(best[0], order, axis=1)
+    best_rows = np.take_along_axis(best[1], order, axis=1)
+    return [
+        [(int(row), float(score)) for row, score in zip(rows, scores)]
+        for rows, scores in zip(best_rows, best_scores)
+    ]
+
+
+def rewrite_embed_file(
+    src_prefix: Optional[str],
+    dst_prefix: str,
+    keep_rows: Optional[NDArray[np.bool_]],
+    extra_pks: List[str],
+    extra_embeds: NDArray[np.float32],
+    block_size: int = 16384,
+) -> List[str]:
+    """
+    Streams the kept rows of src (if any) followed by the extra rows into dst,
+    one block at a time. src and dst may be the same file. Returns the pks of
+    the new file.
+    """
+    pks: List[str] = []
+    dim = int(extra_embeds.shape[1]) if extra_embeds.ndim == 2 else 0
+    data_path = dst_prefix + EMBED_DATA_SUFFIX
+    with open(data_path + '.tmp', 'wb') as out:
+        if src_prefix is not None:
+            src_pks, dim, _ = load_embed_index(src_prefix)
+            src_embeds: NDArray[np.float32] = (
+                np.memmap(
+                    src_prefix + EMBED_DATA_SUFFIX,
+                    dtype=np.float32,
+                    mode='r',
+                    shape=(len(src_pks), dim),
+                )
+                if src_pks
+                else np.empty((0, dim), dtype=np.float32)
+            )
+            for start in range(0, len(src_pks), block_size):
+                end = min(start + block_size, len(src_pks))
+                kept = (
+                    np.arange(start, end)
+                    if keep_rows is None
+                    else start + np.flatnonzero(keep_rows[start:end])
+                )
+                np.ascontiguousarray(src_embeds[kept]).tofile(out)
+                pks.extend(src_pks[row] for row in kept)
+            del src_embeds
+        if extra_pks:
+            if dim and extra_embeds.shape[1] != dim:
+                raise ValueError(
+                    f'Embedding dimension {extra_embeds.shape[1]} does not match {dim}'
+                )
+            np.ascontiguousarray(extra_embeds, dtype=np.float32).tofile(out)
+            pks.extend(extra_pks)
+    index_path = dst_prefix + EMBED_INDEX_SUFFIX
+    with open(index_path + '.tmp', 'w') as f:
+        json.dump({'dtype': 'float32', 'dim': dim, 'pks': pks}, f)
+    os.replace(data_path + '.tmp', data_path)
+    os.replace(index_path + '.tmp', index_path)
+    return pks
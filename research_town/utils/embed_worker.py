@@ -0,0 +1,115 @@
+import queue
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+import torch
+
+from .logger import logger
+
+
+class EmbedWorker:
+    """
+    Embeds texts on a background thread as soon as they are submitted. Jobs
+    queued while a batch runs are drained into the next batch, so a burst of
+    adds costs a few batched forward passes instead of one per record.
+    on_embedded receives the pks, texts and embeddings of every batch; a pk
+    submitted again with another text stays pending until the newest text is
+    done.
+    """
+
+    def __init__(
+        self,
+        embed_fn: Callable[[List[str]], torch.Tensor],
+        on_embedded: Callable[[List[str], List[str], torch.Tensor], None],
+        batch_size: int = 32,
+    ) -> None:
+        self.embed_fn = embed_fn
+        self.on_embedded = on_embedded
+        self.batch_size = batch_size
+        self.jobs: 'queue.Queue[Optional[Tuple[str, str]]]' = queue.Queue()
+        # pk -> newest submitted text, until its embedding is handed over
+        self.pending: Dict[str, str] = {}
+        self._done = threading.Condition()
+        self._thread = threading.Thread(
+            target=self._run, name='embed-worker', daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, pk: str, text: str) -> None:
+        with self._done:
+            self.pending[pk] = text
+        self.jobs.put((pk, text))
+
+    def pending_pks(self) -> Set[str]:
+        with self._done:
+            return set(self.pending)
+
+    def wait(
+        self, pks: Optional[Iterable[str]] = None, timeout: Optional[float] = None
+    ) -> bool:
+        """
+        Waits until the given pks (all pks by default) are embedded or timeout
+        seconds passed. Returns whether nothing of them is pending any more.
+        """
+        wanted = None if pks is None else set(pks)
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        def is_done() -> bool:
+            if wanted is None:
+                return not self.pending
+            return wanted.isdisjoint(self.pending)
+
+        with self._done:
+            while not is_done():
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._done.wait(remaining)
+            return True
+
+    def stop(self) -> None:
+        """Finishes the batch in progress and stops; queued jobs are dropped."""
+        with self._done:
+            self.pending.clear()
+            self._done.notify_all()
+        self.jobs.put(None)
+        self._thread.join()
+
+    def _run(self) -> None:
+        while True:
+            job = self.jobs.get()
+            batch = []
+            while job is not None:
+                batch.append(job)
+                if len(batch) == self.batch_size:
+                    break
+                try:
+                    job = self.jobs.get_nowait()
+                except queue.Empty:
+                    break
+            with self._done:
+                # skip jobs that were resubmitted with a newer text or dropped
+                batch = list(
+                    {
+                        pk: text for pk, text in batch if self.pending.get(pk) == text
+                    }.items()
+                )
+            if batch:
+                self._embed(batch)
+            if job is None:
+                return
+
+    def _embed(self, batch: List[Tuple[str, str]]) -> None:
+        pks = [pk for pk, _ in batch]
+        texts = [text for _, text in batch]
+        try:
+            self.on_embedded(pks, texts, self.embed_fn(texts))
+        except Exception:
+            # the records stay dirty and get embedded by the next search instead
+            logger.exception(f'Background embedding of {len(pks)} records failed')
+        with self._done:
+            for pk, text in batch:
+                if self.pending.get(pk) == text:
+                    del self.pending[pk]
+            self._done.notify_all()
@@ -0,0 +1,123 @@
+import re
+import zlib
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+from numpy.typing import NDArray
+
+# smallest prime above 2**32, so that every 32-bit shingle hash is a residue
+MINHASH_PRIME = 4294967311
+SHINGLE_SIZE = 3
+
+
+def get_shingles(text: str, size: int = SHINGLE_SIZE) -> NDArray[np.uint64]:
+    """
+    32-bit hashes of the distinct word size-grams of the lowercased text, so
+    that case, punctuation and whitespace do not tell two texts apart. Texts
+    shorter than size words give a single shingle.
+    """
+    words = re.findall(r'\w+', text.lower())
+    if not words:
+        return np.empty(0, dtype=np.uint64)
+    hashes = np.array(
+        [zlib.crc32(word.encode('utf-8')) for word in words], dtype=np.uint64
+    )
+    count = max(len(words) - size + 1, 1)
+    shingles = np.zeros(count, dtype=np.uint64)
+    for offset in range(min(size, len(words))):
+        # polynomial combination of the word hashes, kept to 32 bits
+        shingles = (shingles * np.uint64(1000003) + hashes[offset : offset + count]) & (
+            np.uint64(0xFFFFFFFF)
+        )
+    return np.unique(shingles)
+
+
+class MinHashLSH:
+    """
+    MinHash signatures of texts, bucketed by bands of num_perm // bands rows
+    each. Texts sharing a band bucket are candidates, and only candidates
+    whose estimated Jaccard similarity of their shingles reaches threshold
+    count as near-duplicates, so a lookup costs one signature and a few
+    bucket probes instead of a pass over every stored text.
+    """
+
+    def __init__(
+        self,
+        num_perm: int = 128,
+        bands: int = 16,
+        threshold: float = 0.8,
+        seed: int = 1,
+    ) -> None:
+        if num_perm % bands != 0:
+            raise ValueError(f'num_perm {num_perm} is not a multiple of bands {bands}')
+        if not 0 < threshold <= 1:
+            raise ValueError(f'Expected 0 < threshold <= 1, got {threshold}')
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.threshold = threshold
+        rng = np.random.default_rng(seed)
+        # below 2**31, so that a * x + b stays within 64 bits
+        self.a = rng.integers(1, 2**31, size=(num_perm, 1), dtype=np.uint64)
+        self.b = rng.integers(0, 2**31, size=(num_perm, 1), dtype=np.uint64)
+        self.signatures: Dict[str, NDArray[np.uint64]] = {}
+        self.buckets: List[Dict[bytes, Set[str]]] = [{} for _ in range(bands)]
+
+    def __len__(self) -> int:
+        return len(self.signatures)
+
+    def __contains__(self, pk: object) -> bool:
+        return pk in self.signatures
+
+    def signature(self, text: str) -> Optional[NDArray[np.uint64]]:
+        """None for texts without any word, which match nothing."""
+        shingles = get_shingles(text)
+        if len(shingles) == 0:
+            return None
+        permuted = (self.a * shingles[None, :] + self.b) % np.uint64(MINHASH_PRIME)
+        result: NDArray[np.uint64] = permuted.min(axis=1)
+        return result
+
+    def add(self, pk: str, text: str) -> None:
+        self.remove(pk)
+        signature = self.signature(text)
+        if signature is None:
+            return
+        self.signatures[pk] = signature
+        for band, key in enumerate(self._band_keys(signature)):
+            self.buckets[band].setdefault(key, set()).add(pk)
+
+    def remove(self, pk: str) -> None:
+        signature = self.signatures.pop(pk, None)
+        if signature is None:
+            return
+        for band, key in enumerate(self._band_keys(signature)):
+            bucket = self.buckets[band][key]
+            bucket.discard(pk)
+            if not bucket:
+                del self.buckets[band][key]
+
+    def query(self, text: str) -> List[Tuple[str, float]]:
+        """Stored pks similar to text by at least threshold, most similar first."""
+        signature = self.signature(text)
+        if signature is None:
+            return []
+        candidates: Set[str] = set()
+        for band, key in enumerate(self._band_keys(signature)):
+            candidates.update(self.buckets[band].get(key, ()))
+        matches = []
+        for pk in candidates:
+            similarity = float(np.mean(self.signatures[pk] == signature))
+            if similarity >= self.threshold:
+                matches.append((pk, similarity))
+        return sorted(matches, key=lambda item: (-item[1], item[0]))
+
+    def find_duplicate(self, text: str) -> Optional[Tuple[str, float]]:
+        matches = self.query(text)
+        return matches[0] if matches else None
+
+    def _band_keys(self, signature: NDArray[np.uint64]) -> List[bytes]:
+        return [
+            signature[band * self.rows : (band + 1) * self.rows].tobytes()
+            for band in range(self.bands)
+        ]
@@ -0,0 +1,56 @@
+from typing import List
+
+import torch
+
+
+def mmr_rerank(
+    query_embeds: torch.Tensor,
+    candidate_embeds: torch.Tensor,
+    candidate_mask: torch.Tensor,
+    num: int,
+    mmr_lambda: float = 0.5,
+) -> List[List[int]]:
+    """
+    Maximal marginal relevance over the candidates of every query: each step
+    picks the candidate maximizing
+        mmr_lambda * sim(query, c) - (1 - mmr_lambda) * max sim(c, picked),
+    so mmr_lambda=1 keeps the relevance order and lower values trade relevance
+    for diversity. query_embeds is (Q, D), candidate_embeds (Q, M, D) and
+    candidate_mask (Q, M) marks real candidates. All pairwise similarities come
+    from one batched matmul and every step updates all queries at once.
+    Returns the picked candidate positions of every query.
+    """
+    if not 0 <= mmr_lambda <= 1:
+        raise ValueError(f'Expected 0 <= mmr_lambda <= 1, got {mmr_lambda}')
+    query_num, candidate_num = candidate_mask.shape
+    if query_num == 0 or candidate_num == 0:
+        return [[] for _ in range(query_num)]
+    queries = torch.nn.functional.normalize(query_embeds.to(torch.float32), dim=-1)
+    candidates = torch.nn.functional.normalize(
+        candidate_embeds.to(torch.float32), dim=-1
+    )
+    relevance = torch.bmm(candidates, queries.unsqueeze(2)).squeeze(2)
+    similarity = torch.bmm(candidates, candidates.transpose(1, 2))
+
+    available = candidate_mask.clone()
+    redundancy = torch.zeros(query_num, candidate_num)
+    query_index = torch.arange(query_num)
+    picks = []
+    for step in range(min(num, candidate_num)):
+        scores = mmr_lambda * relevance - (1 - mmr_lambda) * redundancy
+        scores[~available] = float('-inf')
+        pick = scores.argmax(dim=1)
+        # queries that ran out of candidates pick nothing
+        picked = available[query_index, pick]
+        picks.append(torch.where(picked, pick, -1))
+        available[query_index, pick] = False
+        pick_similarity = similarity[query_index, :, pick]
+        redundancy = (
+            pick_similarity if step == 0 else torch.maximum(redundancy, pick_similarity)
+        )
+    if not picks:
+        return [[] for _ in range(query_num)]
+    return [
+        [position for position in row if position >= 0]
+        for row in torch.stack(picks, 1).tolist()
+    ]
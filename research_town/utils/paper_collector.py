@@ -1,6 +1,7 @@
 import re
 import time
 from io import BytesIO
+from urllib.parse import urlsplit
 
 import arxiv
 import requests
@@ -12,6 +13,33 @@ from tqdm import tqdm
 
 from ..data.data import Paper
 
+ARXIV_ID_PATTERN = (
+    r'(\d{4}\.\d{4,5}|[a-z][a-z\-]*(?:\.[a-z\-]+)?/\d{7})(?:v\d+)?(?:\.pdf)?'
+)
+
+
+def get_paper_key(url: Optional[str]) -> Optional[str]:
+    """
+    Natural key of a paper: 'arxiv:<id>' for arXiv abs, pdf and html URLs and
+    bare arXiv ids, so that all versions of a paper share a key, and the URL
+    with its host lowercased and without scheme, query and trailing slash
+    otherwise.
+    """
+    if not url or not url.strip():
+        return None
+    url = url.strip()
+    match = re.fullmatch(f'(?:arxiv:)?{ARXIV_ID_PATTERN}', url, re.IGNORECASE)
+    if match is not None:
+        return f'arxiv:{match.group(1).lower()}'
+    parts = urlsplit(url if '//' in url else f'//{url}')
+    host = parts.netloc.lower().removeprefix('www.')
+    match = re.fullmatch(
+        f'/(?:abs|pdf|html)/{ARXIV_ID_PATTERN}/?', parts.path, re.IGNORECASE
+    )
+    if host.endswith('arxiv.org') and match is not None:
+        return f'arxiv:{match.group(1).lower()}'
+    return f'url:{host}{parts.path.rstrip("/")}'
+
 
 def perform_arxiv_search(
     search: arxiv.Search,
@@ -0,0 +1,157 @@
+import hashlib
+import json
+import re
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import torch
+
+from .embed_matrix import EmbedMatrix
+
+
+class Passage(NamedTuple):
+    section: str
+    start: int
+    end: int
+    score: float
+    text: str = ''
+
+
+def chunk_text(text: str, window: int = 128, stride: int = 96) -> List[Tuple[int, int]]:
+    """
+    Character offsets of windows of `window` words that start every `stride`
+    words, so that consecutive windows overlap by window - stride words.
+    """
+    words = [match.span() for match in re.finditer(r'\S+', text)]
+    spans: List[Tuple[int, int]] = []
+    for start in range(0, len(words), stride):
+        chunk = words[start : start + window]
+        spans.append((chunk[0][0], chunk[-1][1]))
+        if start + window >= len(words):
+            break
+    return spans
+
+
+class PassageIndex:
+    """
+    Embeddings of overlapping passages of paper sections. A paper is scored by
+    its best passage (max-sim), and matches carry the offsets of the passages
+    that scored highest so that prompts can quote them instead of whole papers.
+    """
+
+    def __init__(self, window: int = 128, stride: int = 96) -> None:
+        if not 0 < stride <= window:
+            raise ValueError('Expected 0 < stride <= window')
+        self.window = window
+        self.stride = stride
+        self.passage_embed = EmbedMatrix()
+        # passage pk -> (paper pk, section, start, end)
+        self.passages: Dict[str, Tuple[str, str, int, int]] = {}
+        self.paper_passages: Dict[str, List[str]] = {}
+        self.fingerprints: Dict[str, str] = {}
+        self._row_papers: Optional[torch.Tensor] = None
+        self._paper_pks: List[str] = []
+
+    @staticmethod
+    def fingerprint(sections: Dict[str, str]) -> str:
+        return hashlib.sha256(
+            json.dumps(sections, sort_keys=True).encode('utf-8')
+        ).hexdigest()
+
+    def needs_update(self, paper_pk: str, sections: Dict[str, str]) -> bool:
+        return self.fingerprints.get(paper_pk) != self.fingerprint(sections)
+
+    def chunk(self, sections: Dict[str, str]) -> List[Tuple[str, int, int]]:
+        return [
+            (section, start, end)
+            for section, text in sections.items()
+            for start, end in chunk_text(text, self.window, self.stride)
+        ]
+
+    def add(
+        self,
+        paper_pk: str,
+        sections: Dict[str, str],
+        passages: Sequence[Tuple[str, int, int]],
+        embeds: torch.Tensor,
+    ) -> None:
+        self.remove(paper_pk)
+        passage_pks = [
+            f'{paper_pk}:{section}:{start}' for section, start, _ in passages
+        ]
+        self.passage_embed.add_many(passage_pks, embeds)
+        for passage_pk, (section, start, end) in zip(passage_pks, passages):
+            self.passages[passage_pk] = (paper_pk, section, start, end)
+        if passage_pks:
+            self.paper_passages[paper_pk] = passage_pks
+        self.fingerprints[paper_pk] = self.fingerprint(sections)
+        self._row_papers = None
+
+    def remove(self, paper_pk: str) -> None:
+        for passage_pk in self.paper_passages.pop(paper_pk, []):
+            del self.passages[passage_pk]
+            del self.passage_embed[passage_pk]
+        self.fingerprints.pop(paper_pk, None)
+        self._row_papers = None
+
+    def _get_row_papers(self) -> torch.Tensor:
+        if self._row_papers is None:
+            self._paper_pks = list(self.paper_passages)
+            paper_ids = {paper_pk: i for i, paper_pk in enumerate(self._paper_pks)}
+            self._row_papers = torch.tensor(
+                [paper_ids[self.passages[pk][0]] for pk in self.passage_embed.pks],
+                dtype=torch.long,
+            )
+        return self._row_papers
+
+    def search(
+        self,
+        query_embeds: torch.Tensor,
+        num: int,
+        candidate_paper_pks: Optional[Sequence[str]] = None,
+        passages_per_paper: int = 1,
+    ) -> List[List[Tuple[str, float, List[Passage]]]]:
+        query_embeds = EmbedMatrix.normalize(query_embeds)
+        query_num = query_embeds.shape[0]
+        if len(self.passage_embed) == 0:
+            return [[] for _ in range(query_num)]
+        row_papers = self._get_row_papers()
+        scores = query_embeds @ self.passage_embed.embeds().t()
+        # max-sim: a paper scores as its best passage
+        paper_scores = torch.full((query_num, len(self._paper_pks)), float('-inf'))
+        paper_scores.scatter_reduce_(
+            1, row_papers.expand(query_num, -1), scores, reduce='amax'
+        )
+        candidate_num = len(self._paper_pks)
+        if candidate_paper_pks is not None:
+            candidate_mask = torch.zeros(len(self._paper_pks), dtype=torch.bool)
+            candidate_pks = set(candidate_paper_pks)
+            for i, paper_pk in enumerate(self._paper_pks):
+                candidate_mask[i] = paper_pk in candidate_pks
+            paper_scores[:, ~candidate_mask] = float('-inf')
+            candidate_num = int(candidate_mask.sum())
+        top_scores, top_papers = torch.topk(
+            paper_scores, min(num, candidate_num), dim=1
+        )
+
+        results: List[List[Tuple[str, float, List[Passage]]]] = []
+        for query_scores, papers, paper_score_row in zip(
+            scores, top_papers.tolist(), top_scores.tolist()
+        ):
+            result = []
+            for paper_id, paper_score in zip(papers, paper_score_row):
+                paper_pk = self._paper_pks[paper_id]
+                passage_pks = self.paper_passages[paper_pk]
+                rows = torch.tensor(
+                    [self.passage_embed.rows[pk] for pk in passage_pks],
+                    dtype=torch.long,
+                )
+                passage_scores, order = torch.topk(
+                    query_scores[rows], min(passages_per_paper, len(rows))
+                )
+                passages = []
+                for i, score in zip(order.tolist(), passage_scores.tolist()):
+                    _, section, start, end = self.passages[passage_pks[i]]
+                    passages.append(Passage(section, start, end, score))
+                result.append((paper_pk, paper_score, passages))
+            results.append(result)
+        return results
@@ -1,26 +1,565 @@
-from typing import List
+import hashlib
+import os
+import re
+import resource
+import threading
+import time
+import warnings
+import zlib
+from abc import ABC, abstractmethod
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union, cast
 
+import numpy as np
 import torch
-from transformers import BertModel, BertTokenizer
+from transformers import (
+    AutoTokenizer,
+    BertModel,
+    BertTokenizer,
+    PreTrainedTokenizerFast,
+)
+
+from .embed_cache import EmbedCache, QueryEmbedCache
+from .logger import logger
+
+DEFAULT_RETRIEVER_MODEL = 'facebook/contriever'
+HASHING_BACKEND = 'hashing'
+# bump whenever pooling changes so that cached embeddings get invalidated
+POOLING = 'masked_mean_v1'
+
+COMPILE_MODES = ('trace', 'compile')
+PARITY_TEXTS = [
+    'Graph neural networks for molecular property prediction.',
+    'We study scaling laws of large language models trained on code.',
+]
+
+
+class FastRetrieverModel(torch.nn.Module):
+    """
+    CPU inference wrapper around a retriever model: linear layers dynamically
+    quantized to int8 and the forward pass optionally traced with torch.jit or
+    compiled with torch.compile. Tracing happens on the first batch.
+    """
+
+    def __init__(
+        self,
+        retriever_model: BertModel,
+        quantize: bool = True,
+        compile_mode: Optional[str] = None,
+    ) -> None:
+        super().__init__()
+        if compile_mode is not None and compile_mode not in COMPILE_MODES:
+            raise ValueError(f'Unsupported compile mode: {compile_mode}')
+        self.config = retriever_model.config
+        self.variant = get_model_variant(quantize)
+        self.compile_mode = compile_mode
+        model: Callable[..., Any] = retriever_model
+        if quantize:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                model = torch.ao.quantization.quantize_dynamic(  # type: ignore[no-untyped-call]
+                    model, {torch.nn.Linear}, dtype=torch.qint8
+                )
+        if compile_mode == 'compile':
+            model = torch.compile(model, dynamic=True)
+        self.model = model
+        self._traced: Optional[torch.jit.ScriptModule] = None
+
+    def forward(
+        self, input_ids: torch.Tensor, attention_mask: torch.Tensor
+    ) -> Dict[str, torch.Tensor]:
+        if self.compile_mode == 'trace':
+            if self._traced is None:
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore')
+                    self._traced = torch.jit.trace(  # type: ignore[no-untyped-call]
+                        self.model,
+                        (input_ids, attention_mask),
+                        strict=False,
+                        check_trace=False,
+                    )
+            output = self._traced(input_ids, attention_mask)
+        else:
+            output = self.model(input_ids=input_ids, attention_mask=attention_mask)
+        return {'last_hidden_state': output['last_hidden_state']}
+
+
+class BackendConfig:
+    def __init__(self, name_or_path: str, hidden_size: int) -> None:
+        self.name_or_path = name_or_path
+        self.hidden_size = hidden_size
+
+
+class BackendTokenizer(ABC):
+    """
+    Tokenizer side of a model-free embedding backend, called like a Hugging
+    Face tokenizer so that tokenize_batch and the token cache work unchanged.
+    """
+
+    pad_token_id = 0
+
+    def __init__(self, name_or_path: str, vocab_size: int) -> None:
+        self.name_or_path = name_or_path
+        self.vocab_size = vocab_size
+
+    def __len__(self) -> int:
+        return self.vocab_size
+
+    def __call__(
+        self, texts: List[str], truncation: bool = True, max_length: int = 512
+    ) -> Dict[str, List[List[int]]]:
+        return {
+            'input_ids': [
+                self.encode(text, max_length if truncation else None) for text in texts
+            ]
+        }
+
+    @abstractmethod
+    def encode(self, text: str, max_length: Optional[int] = None) -> List[int]:
+        pass
+
+
+class EmbeddingBackend(ABC):
+    """
+    Model side of a model-free embedding backend: turns the token ids of its
+    tokenizer into one vector per text. get_embed_batch calls it in place of
+    a transformer forward pass, so caching and statistics apply as usual.
+    """
+
+    variant = 'fp32'
+
+    def __init__(self, name_or_path: str, hidden_size: int) -> None:
+        self.config = BackendConfig(name_or_path, hidden_size)
+
+    @abstractmethod
+    def embed_token_ids(self, input_ids: List[List[int]]) -> torch.Tensor:
+        pass
+
+
+class HashingTokenizer(BackendTokenizer):
+    """
+    Hashes lowercased words and word bigrams into num_features signed buckets.
+    The lowest bit of an id is the sign, so colliding features tend to cancel
+    out instead of piling up. crc32 keeps ids stable across processes.
+    """
+
+    def __init__(self, name_or_path: str, num_features: int) -> None:
+        super().__init__(name_or_path, 2 * num_features)
+        self.num_features = num_features
+
+    def encode(self, text: str, max_length: Optional[int] = None) -> List[int]:
+        words = re.findall(r'\w+', text.lower())[:max_length]
+        features = words + [f'{a} {b}' for a, b in zip(words, words[1:])]
+        return [
+            zlib.crc32(feature.encode('utf-8')) % self.vocab_size
+            for feature in features
+        ]
+
+
+class HashingBackend(EmbeddingBackend):
+    """
+    TF-IDF over hashed features, computed with numpy. It needs no download
+    and starts instantly. Without fit() every bucket has idf 1. fit()
+    estimates the idf from a corpus and changes the variant, so embeddings
+    cached under the old weights are not reused.
+    """
+
+    def __init__(self, tokenizer: HashingTokenizer) -> None:
+        super().__init__(tokenizer.name_or_path, tokenizer.num_features)
+        self.tokenizer = tokenizer
+        self.idf = np.ones(tokenizer.num_features, dtype=np.float32)
+        self.variant = 'tf'
+
+    def fit(self, texts: List[str], max_length: int = 512) -> None:
+        num_features = self.tokenizer.num_features
+        doc_freqs = np.zeros(num_features, dtype=np.int64)
+        for ids in self.tokenizer(texts, max_length=max_length)['input_ids']:
+            doc_freqs[np.unique(np.array(ids, dtype=np.int64) >> 1)] += 1
+        self.idf = (np.log((1 + len(texts)) / (1 + doc_freqs)) + 1).astype(np.float32)
+        digest = hashlib.sha1(self.idf.tobytes()).hexdigest()[:12]
+        self.variant = f'tfidf-{digest}'
+
+    def embed_token_ids(
+        self, input_ids: List[List[int]], chunk_size: int = 1024
+    ) -> torch.Tensor:
+        num_features = self.tokenizer.num_features
+        embeds = np.empty((len(input_ids), num_features), dtype=np.float32)
+        for start in range(0, len(input_ids), chunk_size):
+            chunk = input_ids[start : start + chunk_size]
+            lengths = np.array([len(ids) for ids in chunk], dtype=np.int64)
+            ids = np.fromiter(
+                (i for row in chunk for i in row),
+                dtype=np.int64,
+                count=int(lengths.sum()),
+            )
+            rows = np.repeat(np.arange(len(chunk)), lengths)
+            counts = np.bincount(
+                rows * num_features + (ids >> 1),
+                weights=1.0 - 2.0 * (ids & 1),
+                minlength=len(chunk) * num_features,
+            ).reshape(len(chunk), num_features)
+            # sublinear term frequency
+            weights = np.sign(counts) * np.log1p(np.abs(counts)) * self.idf
+            norms = np.linalg.norm(weights, axis=1, keepdims=True)
+            embeds[start : start + len(chunk)] = weights / np.maximum(norms, 1e-12)
+        return torch.from_numpy(embeds)
+
+
+def get_hashing_backend(model_name: str) -> Tuple[HashingTokenizer, HashingBackend]:
+    # 'hashing' or 'hashing:<num_features>'
+    _, _, num_features = model_name.partition(':')
+    tokenizer = HashingTokenizer(model_name, int(num_features or 1024))
+    return tokenizer, HashingBackend(tokenizer)
+
+
+RetrieverModel = Union[BertModel, FastRetrieverModel, EmbeddingBackend]
+RetrieverTokenizer = Union[BertTokenizer, PreTrainedTokenizerFast, BackendTokenizer]
+
+_embedding_backends: Dict[
+    str, Callable[[str], Tuple[BackendTokenizer, EmbeddingBackend]]
+] = {HASHING_BACKEND: get_hashing_backend}
+
+_retriever_registry: Dict[str, Tuple[RetrieverTokenizer, RetrieverModel]] = {}
+_retriever_stats: Dict[str, Dict[str, float]] = {}
+_retriever_lock = threading.RLock()
+# time spent in tokenization and in the model, summed over all embedding calls
+_embed_stats: Dict[str, float] = {
+    'texts': 0,
+    'tokens': 0,
+    'cached_token_texts': 0,
+    'tokenize_seconds': 0.0,
+    'model_seconds': 0.0,
+}
+_embed_stats_lock = threading.Lock()
+
+
+def _get_rss_mb() -> float:
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError, IndexError):
+        # peak instead of current resident memory where /proc is unavailable
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def register_embedding_backend(
+    name: str, factory: Callable[[str], Tuple[BackendTokenizer, EmbeddingBackend]]
+) -> None:
+    """
+    Makes get_retriever build model names '<name>' and '<name>:<options>' with
+    factory instead of loading a Hugging Face model.
+    """
+    with _retriever_lock:
+        _embedding_backends[name] = factory
+
+
+def get_embedding_backend(
+    model_name: str,
+) -> Optional[Callable[[str], Tuple[BackendTokenizer, EmbeddingBackend]]]:
+    return _embedding_backends.get(model_name.partition(':')[0])
+
+
+def get_retriever_key(
+    model_name: str, quantize: bool = False, compile_mode: Optional[str] = None
+) -> str:
+    options = [
+        option for option in ['int8' if quantize else None, compile_mode] if option
+    ]
+    return f'{model_name}[{",".join(options)}]' if options else model_name
+
+
+def get_retriever(
+    model_name: str = DEFAULT_RETRIEVER_MODEL,
+    quantize: bool = False,
+    num_threads: Optional[int] = None,
+    compile_mode: Optional[str] = None,
+) -> Tuple[RetrieverTokenizer, RetrieverModel]:
+    if num_threads is not None:
+        # intra-op threads are a process-wide setting in torch
+        torch.set_num_threads(num_threads)
+    backend = get_embedding_backend(model_name)
+    if backend is not None:
+        # backends run no transformer, so quantize and compile_mode do not apply
+        with _retriever_lock:
+            if model_name not in _retriever_registry:
+                start_time = time.perf_counter()
+                _retriever_registry[model_name] = backend(model_name)
+                _retriever_stats[model_name] = {
+                    'load_time': time.perf_counter() - start_time,
+                    'rss_mb': 0.0,
+                }
+            return _retriever_registry[model_name]
+    key = get_retriever_key(model_name, quantize, compile_mode)
+    with _retriever_lock:
+        if key != model_name and key not in _retriever_registry:
+            retriever_tokenizer, retriever_model = get_retriever(model_name)
+            assert isinstance(retriever_model, BertModel)
+            start_time = time.perf_counter()
+            fast_model = FastRetrieverModel(retriever_model, quantize, compile_mode)
+            parity = check_retriever_parity(
+                PARITY_TEXTS, retriever_tokenizer, retriever_model, fast_model
+            )
+            _retriever_registry[key] = (retriever_tokenizer, fast_model)
+            _retriever_stats[key] = {
+                'load_time': time.perf_counter() - start_time,
+                'rss_mb': 0.0,
+                'min_cosine': parity['min_cosine'],
+            }
+            logger.info(
+                f"Prepared retriever '{key}', min cosine to fp32 "
+                f'{parity["min_cosine"]:.5f}'
+            )
+        if model_name not in _retriever_registry:
+            rss_before = _get_rss_mb()
+            start_time = time.perf_counter()
+            # the Rust tokenizer encodes a whole batch at once
+            retriever_tokenizer = cast(
+                RetrieverTokenizer,
+                AutoTokenizer.from_pretrained(model_name, use_fast=True),
+            )
+            retriever_model = BertModel.from_pretrained(model_name)
+            _retriever_registry[model_name] = (retriever_tokenizer, retriever_model)
+            _retriever_stats[model_name] = {
+                'load_time': time.perf_counter() - start_time,
+                'rss_mb': _get_rss_mb() - rss_before,
+            }
+            logger.info(
+                f"Loaded retriever '{model_name}' in "
+                f'{_retriever_stats[model_name]["load_time"]:.2f}s, '
+                f'resident memory +{_retriever_stats[model_name]["rss_mb"]:.1f} MB'
+            )
+        return _retriever_registry[key]
+
+
+def check_retriever_parity(
+    instructions: List[str],
+    retriever_tokenizer: RetrieverTokenizer,
+    reference_model: RetrieverModel,
+    retriever_model: RetrieverModel,
+    batch_size: int = 16,
+) -> Dict[str, float]:
+    reference = get_embed_batch(
+        instructions, retriever_tokenizer, reference_model, batch_size
+    )
+    embeds = get_embed_batch(
+        instructions, retriever_tokenizer, retriever_model, batch_size
+    )
+    cosine = torch.nn.functional.cosine_similarity(reference, embeds, dim=1)
+    return {'min_cosine': cosine.min().item(), 'mean_cosine': cosine.mean().item()}
+
+
+def get_retriever_stats() -> Dict[str, Dict[str, float]]:
+    with _retriever_lock:
+        return {name: dict(stats) for name, stats in _retriever_stats.items()}
+
+
+def get_embed_stats() -> Dict[str, float]:
+    with _embed_stats_lock:
+        return dict(_embed_stats)
+
+
+def reset_embed_stats() -> None:
+    with _embed_stats_lock:
+        for name in _embed_stats:
+            _embed_stats[name] = 0
+
+
+def warmup_retriever(
+    model_name: str = DEFAULT_RETRIEVER_MODEL,
+    background: bool = True,
+    quantize: bool = False,
+    num_threads: Optional[int] = None,
+    compile_mode: Optional[str] = None,
+) -> Optional[threading.Thread]:
+    args = (model_name, quantize, num_threads, compile_mode)
+    if not background:
+        get_retriever(*args)
+        return None
+    thread = threading.Thread(
+        target=get_retriever,
+        args=args,
+        name=f'warmup-{model_name}',
+        daemon=True,
+    )
+    thread.start()
+    return thread
 
 
 def get_embed(
     instructions: List[str],
-    retriever_tokenizer: BertTokenizer = BertTokenizer.from_pretrained(
-        'facebook/contriever'
-    ),
-    retriever_model: BertModel = BertModel.from_pretrained('facebook/contriever'),
+    retriever_tokenizer: Optional[RetrieverTokenizer] = None,
+    retriever_model: Optional[RetrieverModel] = None,
+    batch_size: int = 16,
+    max_length: int = 512,
+    embed_cache: Optional[EmbedCache] = None,
 ) -> List[torch.Tensor]:
-    encoded_input_all = [
-        retriever_tokenizer(text, return_tensors='pt', truncation=True, max_length=512)
-        for text in instructions
-    ]
-    with torch.no_grad():
-        emb_list = []
-        for inter in encoded_input_all:
-            emb = retriever_model(**inter)
-            emb_list.append(emb['last_hidden_state'].mean(1))
-    return emb_list
+    if retriever_tokenizer is None or retriever_model is None:
+        retriever_tokenizer, retriever_model = get_retriever()
+    embeds = get_embed_batch(
+        instructions,
+        retriever_tokenizer=retriever_tokenizer,
+        retriever_model=retriever_model,
+        batch_size=batch_size,
+        max_length=max_length,
+        embed_cache=embed_cache,
+    )
+    # clone so that every returned tensor owns its storage and pickles on its own
+    return [embed.unsqueeze(0).clone() for embed in embeds]
+
+
+def get_embed_settings(max_length: int = 512) -> str:
+    return f'max_length={max_length};pooling={POOLING}'
+
+
+def get_model_variant(quantize: bool = False) -> str:
+    # the variant of a Hugging Face model; compiling does not change its vectors
+    return 'dynamic_int8' if quantize else 'fp32'
+
+
+def get_embed_model_key(model_name: str, variant: str = 'fp32') -> str:
+    # quantized or fitted variants produce other vectors, but are cached next to
+    # the plain model instead of invalidating its entries
+    return model_name if variant == 'fp32' else f'{model_name}[{variant}]'
+
+
+def get_tokenizer_key(retriever_tokenizer: RetrieverTokenizer, max_length: int) -> str:
+    return (
+        f'{retriever_tokenizer.name_or_path};vocab={len(retriever_tokenizer)};'
+        f'max_length={max_length}'
+    )
+
+
+def tokenize_batch(
+    instructions: List[str],
+    retriever_tokenizer: RetrieverTokenizer,
+    max_length: int = 512,
+    token_cache: Optional[EmbedCache] = None,
+) -> List[List[int]]:
+    """
+    Token ids of every instruction, encoded as one batch. With a token cache,
+    ids stored by an earlier run are reused, so that embedding a corpus again
+    with another model variant skips tokenization.
+    """
+    start_time = time.perf_counter()
+    token_ids: List[Optional[List[int]]] = [None] * len(instructions)
+    tokenizer_key = get_tokenizer_key(retriever_tokenizer, max_length)
+    if token_cache is not None:
+        token_ids = token_cache.get_token_ids_many(tokenizer_key, instructions)
+    missing = [i for i, ids in enumerate(token_ids) if ids is None]
+    if missing:
+        encoded = retriever_tokenizer(
+            [instructions[i] for i in missing], truncation=True, max_length=max_length
+        )['input_ids']
+        for i, ids in zip(missing, encoded):
+            token_ids[i] = list(ids)
+        if token_cache is not None:
+            token_cache.put_token_ids_many(
+                tokenizer_key, [instructions[i] for i in missing], encoded
+            )
+    input_ids = [ids for ids in token_ids if ids is not None]
+    with _embed_stats_lock:
+        _embed_stats['cached_token_texts'] += len(instructions) - len(missing)
+        _embed_stats['tokens'] += sum(len(ids) for ids in input_ids)
+        _embed_stats['tokenize_seconds'] += time.perf_counter() - start_time
+    return input_ids
+
+
+def get_embed_batch(
+    instructions: List[str],
+    retriever_tokenizer: RetrieverTokenizer,
+    retriever_model: RetrieverModel,
+    batch_size: int = 16,
+    max_length: int = 512,
+    embed_cache: Optional[Union[EmbedCache, QueryEmbedCache]] = None,
+    token_cache: Optional[EmbedCache] = None,
+) -> torch.Tensor:
+    if len(instructions) == 0:
+        return torch.empty((0, retriever_model.config.hidden_size))
+    if (
+        token_cache is None
+        and isinstance(embed_cache, EmbedCache)
+        and embed_cache.cache_token_ids
+    ):
+        token_cache = embed_cache
+
+    if embed_cache is not None:
+        model_name = get_embed_model_key(
+            str(retriever_model.config.name_or_path),
+            getattr(retriever_model, 'variant', 'fp32'),
+        )
+        settings = get_embed_settings(max_length)
+        cached = embed_cache.get_many(model_name, settings, instructions)
+        missing = [i for i, embed in enumerate(cached) if embed is None]
+        if missing:
+            missing_embeds = get_embed_batch(
+                [instructions[i] for i in missing],
+                retriever_tokenizer=retriever_tokenizer,
+                retriever_model=retriever_model,
+                batch_size=batch_size,
+                max_length=max_length,
+                token_cache=token_cache,
+            )
+            embed_cache.put_many(
+                model_name,
+                settings,
+                [instructions[i] for i in missing],
+                missing_embeds,
+            )
+            for i, embed in zip(missing, missing_embeds):
+                cached[i] = embed
+        return torch.stack([embed for embed in cached if embed is not None], 0)
+
+    input_ids = tokenize_batch(
+        list(instructions), retriever_tokenizer, max_length, token_cache
+    )
+    start_time = time.perf_counter()
+    if isinstance(retriever_model, EmbeddingBackend):
+        backend_embeds = retriever_model.embed_token_ids(input_ids)
+        with _embed_stats_lock:
+            _embed_stats['texts'] += len(input_ids)
+            _embed_stats['model_seconds'] += time.perf_counter() - start_time
+        return backend_embeds
+    # bucket texts of similar length together so that padding stays small
+    order = sorted(range(len(input_ids)), key=lambda i: len(input_ids[i]))
+
+    embeds: List[torch.Tensor] = [torch.empty(0)] * len(input_ids)
+    with torch.inference_mode():
+        for start in range(0, len(order), batch_size):
+            batch_index = order[start : start + batch_size]
+            batch_input_ids, attention_mask = pad_input_ids(
+                [input_ids[i] for i in batch_index],
+                pad_token_id=retriever_tokenizer.pad_token_id,
+            )
+            output = retriever_model(
+                input_ids=batch_input_ids, attention_mask=attention_mask
+            )
+            pooled = mean_pooling(output['last_hidden_state'], attention_mask)
+            for i, embed in zip(batch_index, pooled):
+                embeds[i] = embed
+    with _embed_stats_lock:
+        _embed_stats['texts'] += len(input_ids)
+        _embed_stats['model_seconds'] += time.perf_counter() - start_time
+    return torch.stack(embeds, 0)
+
+
+def pad_input_ids(
+    input_ids: List[List[int]], pad_token_id: int
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    max_len = max(len(ids) for ids in input_ids)
+    padded = torch.full((len(input_ids), max_len), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(input_ids), max_len), dtype=torch.long)
+    for row, ids in enumerate(input_ids):
+        padded[row, : len(ids)] = torch.tensor(ids, dtype=torch.long)
+        attention_mask[row, : len(ids)] = 1
+    return padded, attention_mask
+
+
+def mean_pooling(
+    last_hidden_state: torch.Tensor, attention_mask: torch.Tensor
+) -> torch.Tensor:
+    mask = attention_mask.unsqueeze(-1).to(last_hidden_state.dtype)
+    summed = (last_hidden_state * mask).sum(1)
+    return summed / mask.sum(1).clamp(min=1e-9)
 
 
 def rank_topk(
@@ -0,0 +1,46 @@
+from bisect import bisect_left, insort
+from typing import Dict, List, Optional, Tuple
+
+
+class TimestampIndex:
+    """
+    (timestamp, pk) pairs kept sorted, so that the records inside a time range
+    are found by binary search instead of a scan. Records without a timestamp
+    are not indexed and never fall inside a range.
+    """
+
+    def __init__(self) -> None:
+        self.entries: List[Tuple[int, str]] = []
+        self.timestamps: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, pk: object) -> bool:
+        return pk in self.timestamps
+
+    def add(self, pk: str, timestamp: Optional[int]) -> None:
+        self.remove(pk)
+        if timestamp is None:
+            return
+        insort(self.entries, (timestamp, pk))
+        self.timestamps[pk] = timestamp
+
+    def remove(self, pk: str) -> None:
+        timestamp = self.timestamps.pop(pk, None)
+        if timestamp is None:
+            return
+        del self.entries[bisect_left(self.entries, (timestamp, pk))]
+
+    def range(
+        self, before: Optional[int] = None, after: Optional[int] = None
+    ) -> List[str]:
+        """Pks with after < timestamp < before, in timestamp order."""
+        start = 0
+        end = len(self.entries)
+        if after is not None:
+            # every pk sorts above the empty string, so this skips timestamp == after
+            start = bisect_left(self.entries, (after + 1, ''))
+        if before is not None:
+            end = bisect_left(self.entries, (before, ''))
+        return [pk for _, pk in self.entries[start:end]]
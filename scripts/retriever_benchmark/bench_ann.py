@@ -0,0 +1,60 @@
+import argparse
+import time
+
+from utils import make_matrix, make_sampler
+
+from research_town.utils.ann_index import IVFIndex
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=1000000)
+    parser.add_argument('--dim', type=int, default=768)
+    parser.add_argument('--intrinsic_dim', type=int, default=32)
+    parser.add_argument('--noise', type=float, default=0.1)
+    parser.add_argument('--nlist', type=int, default=None)
+    parser.add_argument('--nprobes', type=int, nargs='+', default=[1, 4, 16, 64])
+    parser.add_argument('--num_queries', type=int, default=100)
+    parser.add_argument('--num', type=int, default=10)
+    args = parser.parse_args()
+
+    sample = make_sampler(args.dim, args.intrinsic_dim, args.noise)
+    start = time.perf_counter()
+    matrix = make_matrix(args.size, sample)
+    print(f'generated {args.size} x {args.dim} in {time.perf_counter() - start:.1f}s')
+    queries = sample(args.num_queries)
+
+    # exact scan; ranks identically to rank_topk, which would need two more
+    # copies of the corpus for torch.cat and normalize at this size
+    start = time.perf_counter()
+    exact = [matrix.search(query[None], args.num, exact=True)[0] for query in queries]
+    exact_ms = (time.perf_counter() - start) / args.num_queries * 1000
+    print(f'exact: recall@{args.num} 1.000, {exact_ms:.2f} ms/query')
+
+    start = time.perf_counter()
+    matrix.build_index(IVFIndex(nlist=args.nlist))
+    assert isinstance(matrix.index, IVFIndex)
+    print(
+        f'built IVF with nlist={matrix.index.nlist} '
+        f'in {time.perf_counter() - start:.1f}s'
+    )
+
+    for nprobe in args.nprobes:
+        start = time.perf_counter()
+        approx = [
+            matrix.search(query[None], args.num, nprobe=nprobe)[0] for query in queries
+        ]
+        approx_ms = (time.perf_counter() - start) / args.num_queries * 1000
+        hits = sum(
+            len({pk for pk, _ in a} & {pk for pk, _ in e})
+            for a, e in zip(approx, exact)
+        )
+        print(
+            f'nprobe={nprobe}: recall@{args.num} '
+            f'{hits / (args.num * args.num_queries):.3f}, {approx_ms:.2f} ms/query '
+            f'({exact_ms / approx_ms:.1f}x faster)'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+import argparse
+import os
+import tempfile
+import time
+
+import torch
+from utils import load_abstracts, load_retriever
+
+from research_town.utils.bulk_embed import bulk_embed
+from research_town.utils.retriever import get_embed_batch
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_name', type=str, default='facebook/contriever')
+    parser.add_argument('--num_texts', type=int, default=128)
+    parser.add_argument('--num_workers', type=int, nargs='+', default=[1, 2])
+    parser.add_argument('--chunk_size', type=int, default=32)
+    parser.add_argument('--offline', action='store_true')
+    args = parser.parse_args()
+
+    corpus = load_abstracts(args.num_texts)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        model_name = args.model_name
+        if args.offline:
+            # workers load the model by name, so save the offline one to disk
+            tokenizer, model = load_retriever(args.model_name, True, corpus)
+            model_name = os.path.join(temp_dir, 'model')
+            tokenizer.save_pretrained(model_name)
+            model.save_pretrained(model_name)
+        else:
+            tokenizer, model = load_retriever(args.model_name, False, corpus)
+
+        start = time.perf_counter()
+        get_embed_batch(corpus, tokenizer, model)
+        print(
+            f'in-process, {torch.get_num_threads()} threads: '
+            f'{len(corpus) / (time.perf_counter() - start):.2f} texts/sec'
+        )
+
+        for num_workers in args.num_workers:
+            cache_dir = os.path.join(temp_dir, f'cache_{num_workers}')
+            start = time.perf_counter()
+            stats = bulk_embed(
+                corpus,
+                cache_dir,
+                model_name=model_name,
+                num_workers=num_workers,
+                chunk_size=args.chunk_size,
+            )
+            elapsed = time.perf_counter() - start
+            print(
+                f'workers={num_workers}: {len(corpus) / elapsed:.2f} texts/sec '
+                f'end to end ({elapsed:.1f}s including worker startup)'
+            )
+            for pid, worker in sorted(stats.items()):
+                print(
+                    f'  worker {pid}: {int(worker["embedded"])} texts in '
+                    f'{worker["seconds"]:.1f}s, {worker["texts_per_sec"]:.2f} texts/sec'
+                )
+
+            # resuming a finished run only reads the cache
+            start = time.perf_counter()
+            bulk_embed(corpus, cache_dir, model_name=model_name)
+            print(f'  resume of a finished run: {time.perf_counter() - start:.2f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+import argparse
+import time
+from collections import Counter
+from typing import List, Set, Tuple
+
+import numpy as np
+from utils import load_abstracts
+
+from research_town.utils.bm25 import tokenize
+from research_town.utils.minhash import MinHashLSH, get_shingles
+
+
+def make_corpus(
+    size: int, doc_len: int, duplicate_rate: float, edit_rate: float
+) -> Tuple[List[str], Set[int]]:
+    # synthetic documents drawn from the word distribution of the real abstracts;
+    # a duplicate_rate share are copies of an earlier one with edit_rate of the
+    # words replaced, e.g. another version or source of the same paper
+    words = Counter(word for text in load_abstracts(10000) for word in tokenize(text))
+    vocab = list(words)
+    probs = np.array([words[word] for word in vocab], dtype=np.float64)
+    probs /= probs.sum()
+    rng = np.random.default_rng(0)
+    docs: List[str] = []
+    duplicates = set()
+    for i in range(size):
+        if docs and rng.random() < duplicate_rate:
+            doc = docs[rng.integers(len(docs))].split()
+            edits = rng.random(len(doc)) < edit_rate
+            doc = [
+                str(rng.choice(vocab, p=probs)) if edit else word
+                for word, edit in zip(doc, edits)
+            ]
+            docs.append(' '.join(doc).upper())
+            duplicates.add(i)
+        else:
+            docs.append(' '.join(rng.choice(vocab, doc_len, p=probs)))
+    return docs, duplicates
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--doc_len', type=int, default=150)
+    parser.add_argument('--duplicate_rate', type=float, default=0.1)
+    parser.add_argument('--edit_rate', type=float, default=0.02)
+    parser.add_argument('--threshold', type=float, default=0.8)
+    parser.add_argument('--num_perm', type=int, default=128)
+    parser.add_argument('--bands', type=int, default=16)
+    parser.add_argument('--exact_queries', type=int, default=100)
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        docs, duplicates = make_corpus(
+            size, args.doc_len, args.duplicate_rate, args.edit_rate
+        )
+        index = MinHashLSH(args.num_perm, args.bands, args.threshold)
+        found = set()
+        latencies = []
+        for i, doc in enumerate(docs):
+            start = time.perf_counter()
+            if index.find_duplicate(doc) is not None:
+                found.add(i)
+            else:
+                index.add(str(i), doc)
+            latencies.append(time.perf_counter() - start)
+        latencies.sort()
+        buckets = [len(pks) for band in index.buckets for pks in band.values()]
+
+        # exact Jaccard against every stored document, for the last inserts
+        shingles = [set(get_shingles(doc).tolist()) for doc in docs]
+        start = time.perf_counter()
+        for i in range(size - args.exact_queries, size):
+            for j in range(i):
+                len(shingles[i] & shingles[j]) / len(shingles[i] | shingles[j])
+        exact_ms = (time.perf_counter() - start) / args.exact_queries * 1000
+
+        print(
+            f'{size} docs: insert p50 {latencies[len(latencies) // 2] * 1000:.3f} ms, '
+            f'p99 {latencies[int(len(latencies) * 0.99)] * 1000:.3f} ms, '
+            f'largest bucket {max(buckets)}; exact scan {exact_ms:.1f} ms per insert; '
+            f'recall {len(found & duplicates) / max(len(duplicates), 1):.3f}, '
+            f'precision {len(found & duplicates) / max(len(found), 1):.3f}'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+from typing import Dict
+
+import torch
+from utils import read_rss_mb
+
+from research_town.dbs import PaperDB
+
+
+def load_and_search(load_path: str, embed_format: str) -> Dict[str, float]:
+    db = PaperDB()
+    rss_before = read_rss_mb()
+    start = time.perf_counter()
+    if embed_format == 'mmap':
+        db.load_from_mmap(load_path)
+    else:
+        db.load_from_pkl(load_path)
+    result = {'load_s': time.perf_counter() - start}
+    rss_loaded = read_rss_mb()
+    # one exact scan touches every row
+    db.data_embed.search(torch.randn(1, db.data_embed.dim or 0), 10)
+    rss_searched = read_rss_mb()
+    for name in ['RssAnon', 'RssFile']:
+        result[f'{name}_loaded_mb'] = rss_loaded[name] - rss_before[name]
+        result[f'{name}_searched_mb'] = rss_searched[name] - rss_before[name]
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=100000)
+    parser.add_argument('--dim', type=int, default=768)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        db = PaperDB()
+        db.data_embed.add_many(
+            [str(i) for i in range(args.size)], torch.randn(args.size, args.dim)
+        )
+        db.save_to_pkl(temp_dir)
+        db.save_to_mmap(temp_dir)
+        del db
+        for file_name in sorted(os.listdir(temp_dir)):
+            file_size = os.path.getsize(os.path.join(temp_dir, file_name))
+            print(f'{file_name}: {file_size / 2**20:.1f} MB')
+
+        # a fresh process per run, so neither format profits from the other's heap
+        context = multiprocessing.get_context('spawn')
+        for embed_format in ['pkl', 'mmap']:
+            with context.Pool(1) as pool:
+                result = pool.apply(load_and_search, (temp_dir, embed_format))
+            print(
+                f'{embed_format}: load {result["load_s"] * 1000:.1f} ms, '
+                f'after load anon +{result["RssAnon_loaded_mb"]:.0f} MB '
+                f'file +{result["RssFile_loaded_mb"]:.0f} MB, '
+                f'after search anon +{result["RssAnon_searched_mb"]:.0f} MB '
+                f'file +{result["RssFile_searched_mb"]:.0f} MB'
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+import argparse
+import time
+
+import torch
+from utils import load_abstracts, load_retriever
+
+from research_town.utils.retriever import (
+    FastRetrieverModel,
+    check_retriever_parity,
+    get_embed_batch,
+)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_name', type=str, default='facebook/contriever')
+    parser.add_argument('--num_texts', type=int, default=64)
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--num_threads', type=int, nargs='+', default=[1])
+    parser.add_argument(
+        '--modes',
+        type=str,
+        nargs='+',
+        default=['fp32', 'int8', 'fp32+trace', 'int8+trace', 'fp32+compile'],
+    )
+    parser.add_argument('--offline', action='store_true')
+    args = parser.parse_args()
+
+    corpus = load_abstracts(args.num_texts)
+    tokenizer, model = load_retriever(args.model_name, args.offline, corpus)
+
+    for num_threads in args.num_threads:
+        torch.set_num_threads(num_threads)
+        base_time = 0.0
+        for mode in args.modes:
+            precision, _, compile_mode = mode.partition('+')
+            retriever_model = (
+                model
+                if mode == 'fp32'
+                else FastRetrieverModel(
+                    model, precision == 'int8', compile_mode or None
+                )
+            )
+            # the first batch pays for tracing or compiling
+            start = time.perf_counter()
+            get_embed_batch(corpus[: args.batch_size], tokenizer, retriever_model)
+            warmup_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            get_embed_batch(corpus, tokenizer, retriever_model, args.batch_size)
+            elapsed = time.perf_counter() - start
+            base_time = base_time or elapsed
+            parity = check_retriever_parity(corpus, tokenizer, model, retriever_model)
+            print(
+                f'threads={num_threads} {mode}: '
+                f'{len(corpus) / elapsed:.2f} texts/sec '
+                f'(speedup {base_time / elapsed:.2f}x, first batch {warmup_time:.1f}s), '
+                f'cosine to fp32 min {parity["min_cosine"]:.5f} '
+                f'mean {parity["mean_cosine"]:.5f}'
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+import argparse
+import random
+import time
+from typing import Any, Callable, Dict, List
+
+import torch
+
+from research_town.data import Profile
+from research_town.utils.embed_matrix import EmbedMatrix
+
+
+def time_ms(fn: Callable[[], object], repeats: int) -> float:
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats * 1000
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--dim', type=int, default=768)
+    parser.add_argument('--num', type=int, default=10)
+    parser.add_argument('--repeats', type=int, default=20)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    random.seed(0)
+    for size in args.sizes:
+        profiles = {
+            str(i): Profile(
+                pk=str(i),
+                name=f'name {i}',
+                bio='',
+                is_reviewer_candidate=random.random() < 0.5,
+                domain=[random.choice(['nlp', 'cv', 'ml'])],
+            )
+            for i in range(size)
+        }
+        matrix = EmbedMatrix()
+        matrix.add_many(list(profiles), torch.randn(size, args.dim))
+        matrix.set_columns(
+            list(profiles),
+            {
+                'is_reviewer_candidate': [
+                    profile.is_reviewer_candidate for profile in profiles.values()
+                ],
+                'domain': [profile.domain for profile in profiles.values()],
+            },
+        )
+        query = torch.randn(1, args.dim)
+        conditions_list: List[Dict[str, Any]] = [
+            {'is_reviewer_candidate': True},
+            {'is_reviewer_candidate': True, 'domain': ['nlp']},
+        ]
+        for conditions in conditions_list:
+            # what ProfileDB.match did before: scan the records, then search the pks
+            scan_ms = time_ms(
+                lambda: matrix.search(
+                    query,
+                    args.num,
+                    [
+                        profile.pk
+                        for profile in profiles.values()
+                        if all(
+                            getattr(profile, key) == value
+                            for key, value in conditions.items()
+                        )
+                    ],
+                ),
+                args.repeats,
+            )
+            mask_ms = time_ms(
+                lambda: matrix.search(query, args.num, conditions=conditions),
+                args.repeats,
+            )
+            print(
+                f'{size} rows, {conditions}: scan + candidate pks {scan_ms:.2f} ms, '
+                f'mask {mask_ms:.2f} ms (speedup {scan_ms / mask_ms:.1f}x)'
+            )
+
+
+if __name__ == '__main__':
+    main()
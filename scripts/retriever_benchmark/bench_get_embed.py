@@ -0,0 +1,56 @@
+import argparse
+import time
+from typing import List
+
+import torch
+from transformers import BertModel, PreTrainedTokenizerFast
+from utils import load_abstracts, load_retriever
+
+from research_town.utils.retriever import get_embed
+
+
+def get_embed_loop(
+    instructions: List[str],
+    retriever_tokenizer: PreTrainedTokenizerFast,
+    retriever_model: BertModel,
+) -> List[torch.Tensor]:
+    # the previous one-forward-pass-per-text implementation, kept as the baseline
+    embeds = []
+    with torch.no_grad():
+        for text in instructions:
+            encoded_input = retriever_tokenizer(
+                text, return_tensors='pt', truncation=True, max_length=512
+            )
+            embeds.append(retriever_model(**encoded_input)['last_hidden_state'].mean(1))
+    return embeds
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_name', type=str, default='facebook/contriever')
+    parser.add_argument('--num_texts', type=int, default=128)
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[8, 32])
+    parser.add_argument('--offline', action='store_true')
+    args = parser.parse_args()
+
+    corpus = load_abstracts(args.num_texts)
+    tokenizer, model = load_retriever(args.model_name, args.offline, corpus)
+
+    start = time.perf_counter()
+    baseline = torch.cat(get_embed_loop(corpus, tokenizer, model), 0)
+    loop_time = time.perf_counter() - start
+    print(f'loop: {len(corpus) / loop_time:.2f} texts/sec')
+
+    for batch_size in args.batch_sizes:
+        start = time.perf_counter()
+        embeds = torch.cat(get_embed(corpus, tokenizer, model, batch_size), 0)
+        batch_time = time.perf_counter() - start
+        max_diff = (embeds - baseline).abs().max().item()
+        print(
+            f'batch_size={batch_size}: {len(corpus) / batch_time:.2f} texts/sec, '
+            f'speedup {loop_time / batch_time:.2f}x, max abs diff {max_diff:.2e}'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+import argparse
+import time
+from typing import Dict, List, Tuple
+
+import torch
+from utils import load_retriever, load_titles_and_abstracts
+
+from research_town.utils.embed_matrix import EmbedMatrix
+from research_town.utils.retriever import (
+    HashingBackend,
+    RetrieverModel,
+    RetrieverTokenizer,
+    get_embed_batch,
+    get_retriever,
+)
+
+
+def run_backend(
+    name: str,
+    retriever_tokenizer: RetrieverTokenizer,
+    retriever_model: RetrieverModel,
+    startup_s: float,
+    titles: List[str],
+    abstracts: List[str],
+    num: int,
+) -> Tuple[Dict[str, float], List[List[str]]]:
+    start = time.perf_counter()
+    corpus_embeds = get_embed_batch(abstracts, retriever_tokenizer, retriever_model)
+    corpus_s = time.perf_counter() - start
+    matrix = EmbedMatrix()
+    matrix.add_many([str(i) for i in range(len(abstracts))], corpus_embeds)
+
+    # one query at a time, like a match call inside an agent step
+    latencies = []
+    rankings = []
+    for title in titles:
+        start = time.perf_counter()
+        query_embeds = get_embed_batch([title], retriever_tokenizer, retriever_model)
+        result = matrix.search(query_embeds, num)[0]
+        latencies.append(time.perf_counter() - start)
+        rankings.append([pk for pk, _ in result])
+    latencies.sort()
+    # a title should retrieve the abstract of its own paper
+    hits = [
+        str(i) in ranking[:k] for k in [1, num] for i, ranking in enumerate(rankings)
+    ]
+    stats = {
+        'startup_s': startup_s,
+        'corpus_texts_per_s': len(abstracts) / corpus_s,
+        'query_p50_ms': latencies[len(latencies) // 2] * 1000,
+        'query_p99_ms': latencies[int(len(latencies) * 0.99)] * 1000,
+        'hit@1': sum(hits[: len(titles)]) / len(titles),
+        f'hit@{num}': sum(hits[len(titles) :]) / len(titles),
+    }
+    print(
+        f'{name}: startup {startup_s:.2f}s, corpus {stats["corpus_texts_per_s"]:.0f} '
+        f'texts/s, query p50 {stats["query_p50_ms"]:.2f} ms / p99 '
+        f'{stats["query_p99_ms"]:.2f} ms, title->abstract hit@1 '
+        f'{stats["hit@1"]:.3f}, hit@{num} {stats[f"hit@{num}"]:.3f}'
+    )
+    return stats, rankings
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_name', type=str, default='facebook/contriever')
+    parser.add_argument('--num_features', type=int, nargs='+', default=[1024, 4096])
+    parser.add_argument('--num_papers', type=int, default=1000)
+    parser.add_argument('--num', type=int, default=10)
+    parser.add_argument('--offline', action='store_true')
+    args = parser.parse_args()
+
+    papers = load_titles_and_abstracts(args.num_papers)
+    titles = [title for title, _ in papers]
+    abstracts = [abstract for _, abstract in papers]
+    torch.manual_seed(0)
+
+    start = time.perf_counter()
+    tokenizer, model = load_retriever(args.model_name, args.offline, abstracts)
+    _, reference = run_backend(
+        args.model_name + (' (random weights)' if args.offline else ''),
+        tokenizer,
+        model,
+        time.perf_counter() - start,
+        titles,
+        abstracts,
+        args.num,
+    )
+    for num_features in args.num_features:
+        for fit in [False, True]:
+            start = time.perf_counter()
+            hashing_tokenizer, hashing_model = get_retriever(f'hashing:{num_features}')
+            assert isinstance(hashing_model, HashingBackend)
+            if fit:
+                hashing_model.fit(abstracts)
+            startup_s = time.perf_counter() - start
+            _, rankings = run_backend(
+                f'hashing:{num_features} {"tf-idf" if fit else "tf"}',
+                hashing_tokenizer,
+                hashing_model,
+                startup_s,
+                titles,
+                abstracts,
+                args.num,
+            )
+            agreement = sum(
+                len(set(ranking) & set(reference_ranking)) / args.num
+                for ranking, reference_ranking in zip(rankings, reference)
+            ) / len(titles)
+            print(f'  top-{args.num} overlap with {args.model_name}: {agreement:.3f}')
+
+
+if __name__ == '__main__':
+    main()
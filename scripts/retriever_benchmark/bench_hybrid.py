@@ -0,0 +1,73 @@
+import argparse
+import time
+from collections import Counter
+from typing import Dict
+
+import numpy as np
+import torch
+from utils import load_abstracts
+
+from research_town.utils.bm25 import BM25Index, tokenize
+from research_town.utils.embed_matrix import EmbedMatrix
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--dim', type=int, default=768)
+    parser.add_argument('--doc_len', type=int, default=150)
+    parser.add_argument('--candidate_num', type=int, default=200)
+    parser.add_argument('--num', type=int, default=10)
+    parser.add_argument('--queries', type=int, default=20)
+    args = parser.parse_args()
+
+    # synthetic documents drawn from the word distribution of the real abstracts
+    words = Counter(word for text in load_abstracts(10000) for word in tokenize(text))
+    vocab = list(words)
+    probs = np.array([words[word] for word in vocab], dtype=np.float64)
+    probs /= probs.sum()
+    rng = np.random.default_rng(0)
+    torch.manual_seed(0)
+    for size in args.sizes:
+        docs = [' '.join(rng.choice(vocab, args.doc_len, p=probs)) for _ in range(size)]
+        pks = [str(i) for i in range(size)]
+        start = time.perf_counter()
+        index = BM25Index()
+        for pk, doc in zip(pks, docs):
+            index.add(pk, doc)
+        build_s = time.perf_counter() - start
+        matrix = EmbedMatrix()
+        matrix.add_many(pks, torch.randn(size, args.dim))
+
+        queries = [' '.join(doc.split()[:6]) for doc in docs[: args.queries]]
+        query_embeds = torch.randn(len(queries), args.dim)
+        start = time.perf_counter()
+        for i in range(len(queries)):
+            matrix.search(query_embeds[i : i + 1], args.num)
+        dense_ms = (time.perf_counter() - start) / len(queries) * 1000
+
+        lexical_ms = 0.0
+        start = time.perf_counter()
+        for i, query in enumerate(queries):
+            lexical_start = time.perf_counter()
+            lexical = index.search(query, args.candidate_num)
+            lexical_ms += time.perf_counter() - lexical_start
+            dense = matrix.search(
+                query_embeds[i : i + 1], len(lexical), [pk for pk, _ in lexical]
+            )[0]
+            fused: Dict[str, float] = {}
+            for ranking in [lexical, dense]:
+                for rank, (pk, _) in enumerate(ranking, 1):
+                    fused[pk] = fused.get(pk, 0.0) + 1 / (60 + rank)
+            sorted(fused.items(), key=lambda item: item[1], reverse=True)[: args.num]
+        hybrid_ms = (time.perf_counter() - start) / len(queries) * 1000
+        lexical_ms = lexical_ms / len(queries) * 1000
+        print(
+            f'{size} docs: BM25 build {build_s:.1f}s, dense scan {dense_ms:.2f} ms/query, '
+            f'hybrid {hybrid_ms:.2f} ms/query (BM25 {lexical_ms:.2f} ms, '
+            f'{args.candidate_num} dense candidates)'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+import argparse
+import time
+from typing import Callable, List
+
+import torch
+
+from research_town.utils.embed_matrix import EmbedMatrix
+from research_town.utils.retriever import rank_topk
+
+
+def time_ms(fn: Callable[[], object], repeats: int) -> float:
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats * 1000
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--dim', type=int, default=768)
+    parser.add_argument('--num', type=int, default=10)
+    parser.add_argument('--repeats', type=int, default=20)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    for size in args.sizes:
+        corpus = torch.randn(size, args.dim)
+        query = torch.randn(1, args.dim)
+        # the previous layout: one (1, dim) tensor per record in a dict
+        corpus_embed: List[torch.Tensor] = [embed.unsqueeze(0) for embed in corpus]
+        matrix = EmbedMatrix()
+        matrix.add_many([str(i) for i in range(size)], corpus)
+        half = [str(i) for i in range(0, size, 2)]
+
+        dict_ms = time_ms(
+            lambda: rank_topk([query], corpus_embed, args.num), args.repeats
+        )
+        matrix_ms = time_ms(lambda: matrix.search(query, args.num), args.repeats)
+        filtered_ms = time_ms(
+            lambda: matrix.search(query, args.num, half), args.repeats
+        )
+        print(
+            f'{size} rows: dict+rank_topk {dict_ms:.2f} ms, '
+            f'EmbedMatrix.search {matrix_ms:.2f} ms '
+            f'(speedup {dict_ms / matrix_ms:.1f}x), '
+            f'with {len(half)} candidates {filtered_ms:.2f} ms'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+import argparse
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from research_town.utils.embed_storage import (
+    EMBED_DATA_SUFFIX,
+    EMBED_INDEX_SUFFIX,
+    search_embed_file,
+)
+
+
+def read_memory_mb() -> Dict[str, float]:
+    memory = {}
+    with open('/proc/self/status', 'r') as f:
+        for line in f:
+            if line.startswith(('VmHWM:', 'VmRSS:')):
+                name, value, _ = line.split()
+                memory[name.rstrip(':')] = int(value) / 1024
+    return memory
+
+
+def write_corpus(prefix: str, rows: int, dim: int, chunk: int = 65536) -> None:
+    rng = np.random.default_rng(0)
+    with open(prefix + EMBED_DATA_SUFFIX, 'wb') as f:
+        for start in range(0, rows, chunk):
+            embeds = rng.standard_normal((min(chunk, rows - start), dim), np.float32)
+            embeds /= np.linalg.norm(embeds, axis=1, keepdims=True)
+            embeds.tofile(f)
+    with open(prefix + EMBED_INDEX_SUFFIX, 'w') as f:
+        json.dump(
+            {'dtype': 'float32', 'dim': dim, 'pks': [str(i) for i in range(rows)]}, f
+        )
+
+
+def run_search(
+    prefix: str,
+    rows: int,
+    dim: int,
+    num_queries: int,
+    num: int,
+    block_size: int,
+    num_threads: int,
+    mask_every: Optional[int],
+    whole_file: bool,
+) -> Dict[str, float]:
+    queries = np.random.default_rng(1).standard_normal((num_queries, dim), np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    row_mask = None if mask_every is None else np.arange(rows) % mask_every == 0
+    # reset the peak resident size, so that only the search is measured
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+    before = read_memory_mb()
+    start = time.perf_counter()
+    if whole_file:
+        # one mapping of the whole file: pages stay mapped until the end
+        embeds = np.memmap(
+            prefix + EMBED_DATA_SUFFIX, dtype=np.float32, mode='r', shape=(rows, dim)
+        )
+        best = np.full((num_queries, num), -np.inf, dtype=np.float32)
+        for block_start in range(0, rows, block_size):
+            scores = queries @ embeds[block_start : block_start + block_size].T
+            best = -np.sort(-np.concatenate([best, scores], axis=1), axis=1)[:, :num]
+        top_score = float(best[0, 0])
+    else:
+        results = search_embed_file(
+            prefix,
+            dim,
+            queries,
+            num,
+            row_mask=row_mask,
+            block_size=block_size,
+            num_threads=num_threads,
+        )
+        top_score = results[0][0][1]
+    seconds = time.perf_counter() - start
+    after = read_memory_mb()
+    return {
+        'seconds': seconds,
+        'peak_mb': after['VmHWM'] - before['VmRSS'],
+        'top_score': top_score,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=None)
+    parser.add_argument('--dim', type=int, default=768)
+    parser.add_argument('--ram_multiple', type=float, default=3.0)
+    parser.add_argument('--num_queries', type=int, default=8)
+    parser.add_argument('--num', type=int, default=10)
+    parser.add_argument('--block_sizes', type=int, nargs='+', default=[4096, 16384])
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--dir', type=str, default=None)
+    args = parser.parse_args()
+
+    total_mb = os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') / 2**20
+    rows = args.rows or int(args.ram_multiple * total_mb * 2**20 / (args.dim * 4))
+    with tempfile.TemporaryDirectory(dir=args.dir) as temp_dir:
+        prefix = os.path.join(temp_dir, 'corpus')
+        start = time.perf_counter()
+        write_corpus(prefix, rows, args.dim)
+        file_mb = os.path.getsize(prefix + EMBED_DATA_SUFFIX) / 2**20
+        print(
+            f'{rows} x {args.dim} rows, {file_mb / 1024:.1f} GB on disk, '
+            f'{file_mb / total_mb:.1f}x physical memory '
+            f'({time.perf_counter() - start:.0f}s to write)'
+        )
+
+        runs: List[Dict[str, object]] = [
+            {
+                'name': f'blocks={block_size} threads={threads}',
+                'block_size': block_size,
+                'num_threads': threads,
+                'mask_every': None,
+                'whole_file': False,
+            }
+            for block_size in args.block_sizes
+            for threads in args.threads
+        ]
+        runs += [
+            {
+                'name': 'condition on 1/2 of rows',
+                'block_size': args.block_sizes[-1],
+                'num_threads': args.threads[-1],
+                'mask_every': 2,
+                'whole_file': False,
+            },
+            {
+                'name': 'condition on 1/100 of rows',
+                'block_size': args.block_sizes[-1],
+                'num_threads': args.threads[-1],
+                'mask_every': 100,
+                'whole_file': False,
+            },
+            {
+                'name': 'single mmap of the file',
+                'block_size': args.block_sizes[-1],
+                'num_threads': 1,
+                'mask_every': None,
+                'whole_file': True,
+            },
+        ]
+        # a fresh process per run, so that peak memory is not inherited
+        context = multiprocessing.get_context('spawn')
+        for run in runs:
+            with context.Pool(1) as pool:
+                result = pool.apply(
+                    run_search,
+                    (
+                        prefix,
+                        rows,
+                        args.dim,
+                        args.num_queries,
+                        args.num,
+                        run['block_size'],
+                        run['num_threads'],
+                        run['mask_every'],
+                        run['whole_file'],
+                    ),
+                )
+            print(
+                f'{run["name"]}: {result["seconds"]:.1f}s for {args.num_queries} '
+                f'queries ({file_mb / 1024 / result["seconds"]:.2f} GB/s), '
+                f'peak memory +{result["peak_mb"]:.0f} MB, '
+                f'top score {result["top_score"]:.4f}'
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+from typing import Any, Dict, List
+
+import torch
+from utils import make_matrix, make_sampler, read_rss_mb
+
+from research_town.utils.embed_matrix import EmbedMatrix
+from research_town.utils.embed_storage import load_embed_file, save_embed_file
+
+
+def run_storage(
+    path_prefix: str,
+    storage: str,
+    rescore_factor: int,
+    queries: torch.Tensor,
+    num: int,
+) -> Dict[str, Any]:
+    pks, embeds = load_embed_file(path_prefix)
+    matrix = EmbedMatrix.from_normalized(pks, torch.from_numpy(embeds))
+    rss_before = read_rss_mb()
+    start = time.perf_counter()
+    matrix.set_storage(storage, rescore_factor)
+    build_s = time.perf_counter() - start
+    matrix.search(queries[:1], num)
+
+    results: List[List[str]] = []
+    start = time.perf_counter()
+    for query in queries:
+        results.append([pk for pk, _ in matrix.search(query[None], num)[0]])
+    query_ms = (time.perf_counter() - start) / len(queries) * 1000
+    rss_after = read_rss_mb()
+    usage = matrix.memory_usage()
+    return {
+        'results': results,
+        'query_ms': query_ms,
+        'build_s': build_s,
+        'scan_mb': (usage['codes'] or usage['file']) / 2**20,
+        'anon_mb': rss_after['RssAnon'] - rss_before['RssAnon'],
+        'file_mb': rss_after['RssFile'] - rss_before['RssFile'],
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=1000000)
+    parser.add_argument('--dim', type=int, default=768)
+    parser.add_argument('--num_queries', type=int, default=50)
+    parser.add_argument('--num', type=int, default=10)
+    parser.add_argument('--rescore_factors', type=int, nargs='+', default=[1, 4])
+    args = parser.parse_args()
+
+    sample = make_sampler(args.dim)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path_prefix = os.path.join(temp_dir, 'PaperDB')
+        matrix = make_matrix(args.size, sample)
+        save_embed_file(path_prefix, matrix.pks, matrix.embeds().numpy())
+        del matrix
+        queries = sample(args.num_queries)
+
+        # one fresh process per mode over the same memory-mapped float32 file
+        context = multiprocessing.get_context('spawn')
+        runs = [('float32', 1)] + [
+            (storage, rescore_factor)
+            for storage in ['float16', 'int8']
+            for rescore_factor in args.rescore_factors
+        ]
+        exact: List[List[str]] = []
+        for storage, rescore_factor in runs:
+            with context.Pool(1) as pool:
+                result = pool.apply(
+                    run_storage,
+                    (path_prefix, storage, rescore_factor, queries, args.num),
+                )
+            if storage == 'float32':
+                exact = result['results']
+            hits = sum(
+                len(set(approx) & set(truth))
+                for approx, truth in zip(result['results'], exact)
+            )
+            print(
+                f'{storage} rescore_factor={rescore_factor}: '
+                f'scanned {result["scan_mb"]:.0f} MB, '
+                f'RSS anon +{result["anon_mb"]:.0f} MB file +{result["file_mb"]:.0f} MB, '
+                f'codes built in {result["build_s"]:.1f}s, '
+                f'{result["query_ms"]:.1f} ms/query, '
+                f'recall@{args.num} {hits / (args.num * len(exact)):.3f}'
+            )
+
+
+if __name__ == '__main__':
+    main()
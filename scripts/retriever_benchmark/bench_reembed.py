@@ -0,0 +1,63 @@
+import argparse
+import time
+from typing import List
+
+from utils import load_abstracts
+
+from research_town.data import Paper
+from research_town.dbs import PaperDB
+
+
+def make_db(abstracts: List[str], model_name: str) -> PaperDB:
+    db = PaperDB(retriever_model_name=model_name)
+    for i, abstract in enumerate(abstracts):
+        db.add(Paper(title=f'Paper {i}', abstract=abstract))
+    db.transform_to_embed()
+    return db
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=20000)
+    parser.add_argument('--old_model', type=str, default='hashing:512')
+    parser.add_argument('--new_model', type=str, default='hashing:1024')
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--interval_s', type=float, default=0.05)
+    args = parser.parse_args()
+
+    texts = load_abstracts(10000)
+    abstracts = [texts[i % len(texts)] + f' {i}' for i in range(args.size)]
+    queries = [' '.join(text.split()[:8]) for text in texts[:50]]
+
+    # the old path: every record is embedded again by the first search
+    db = make_db(abstracts, args.old_model)
+    db.set_retriever_model(args.new_model)
+    start = time.perf_counter()
+    db.match(queries[0], num=10)
+    blocking_s = time.perf_counter() - start
+    print(f'blocking switch: first search after it took {blocking_s:.2f}s')
+
+    # the background path: searches are served by the old set meanwhile
+    db = make_db(abstracts, args.old_model)
+    build = db.start_reembed(args.new_model, batch_size=args.batch_size)
+    latencies: List[float] = []
+    while not build.wait(timeout=args.interval_s):
+        start = time.perf_counter()
+        db.match(queries[len(latencies) % len(queries)], num=10)
+        latencies.append(time.perf_counter() - start)
+    progress = build.progress()
+    start = time.perf_counter()
+    db.match(queries[0], num=10)
+    after_ms = (time.perf_counter() - start) * 1000
+    latencies.sort()
+    print(
+        f'background build: {progress["state"]} in {progress["elapsed_s"]:.2f}s '
+        f'({progress["texts_per_s"]:.0f} texts/s), {len(latencies)} searches '
+        f'meanwhile with p50 {latencies[len(latencies) // 2] * 1000:.2f} ms and '
+        f'max {latencies[-1] * 1000:.2f} ms, first search after the switch '
+        f'{after_ms:.2f} ms'
+    )
+
+
+if __name__ == '__main__':
+    main()
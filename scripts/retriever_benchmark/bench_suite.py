@@ -0,0 +1,340 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timezone
+from importlib import metadata
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+from bench_out_of_core import write_corpus
+from utils import load_abstracts, load_retriever, make_sampler
+
+from research_town.utils.embed_matrix import EmbedMatrix
+from research_town.utils.embed_storage import search_embed_file
+from research_town.utils.retriever import (
+    RetrieverModel,
+    RetrieverTokenizer,
+    get_embed_batch,
+    get_embedding_backend,
+    get_retriever,
+    rank_topk,
+    tokenize_batch,
+)
+
+STAGES = ('tokenize', 'encode', 'topk')
+STORAGES = ('float32', 'float16', 'int8', 'disk', 'rank_topk')
+# bytes per vector component kept in memory: the float32 rows, only the scan
+# codes when the rows are spilled to a file, or the rows plus the copy rank_topk
+# concatenates on every query
+STORAGE_BYTES = {'float32': 4, 'float16': 2, 'int8': 1, 'disk': 0, 'rank_topk': 8}
+
+
+def estimate_mb(case: Dict[str, Any]) -> float:
+    if case['stage'] != 'topk':
+        return 0.0
+    return float(case['size'] * case['dim'] * STORAGE_BYTES[case['storage']] / 2**20)
+
+
+def peak_rss_mb() -> float:
+    # every case runs in a fresh process, so the peak belongs to that case
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def summarize(latencies: List[float], items: int, seconds: float) -> Dict[str, float]:
+    ordered = sorted(latencies)
+    return {
+        'throughput': items / seconds,
+        'p50_ms': ordered[len(ordered) // 2] * 1000,
+        'p99_ms': ordered[min(int(len(ordered) * 0.99), len(ordered) - 1)] * 1000,
+        'calls': len(ordered),
+    }
+
+
+def load_backend(
+    backend: str, offline: bool, corpus: List[str]
+) -> Tuple[RetrieverTokenizer, RetrieverModel]:
+    if get_embedding_backend(backend) is not None:
+        return get_retriever(backend)
+    return load_retriever(backend, offline, corpus)
+
+
+def run_text_stage(
+    stage: str,
+    backend: str,
+    offline: bool,
+    batch_size: int,
+    budget_s: float,
+    max_texts: int,
+) -> Dict[str, float]:
+    texts = load_abstracts(max_texts)
+    retriever_tokenizer, retriever_model = load_backend(backend, offline, texts)
+    call: Callable[[List[str]], Any]
+    if stage == 'tokenize':
+
+        def call(batch: List[str]) -> Any:
+            return tokenize_batch(batch, retriever_tokenizer)
+
+    else:
+
+        def call(batch: List[str]) -> Any:
+            return get_embed_batch(
+                batch, retriever_tokenizer, retriever_model, batch_size=batch_size
+            )
+
+    call(texts[:batch_size])  # warm up
+    latencies: List[float] = []
+    done = 0
+    start = time.perf_counter()
+    # batches until the time budget is spent, cycling through the corpus
+    while done < max_texts and (
+        time.perf_counter() - start < budget_s or len(latencies) < 3
+    ):
+        offset = done % len(texts)
+        batch = (texts[offset:] + texts)[:batch_size]
+        batch_start = time.perf_counter()
+        call(batch)
+        latencies.append(time.perf_counter() - batch_start)
+        done += len(batch)
+    return summarize(latencies, done, time.perf_counter() - start)
+
+
+def run_topk_stage(
+    storage: str,
+    dim: int,
+    size: int,
+    num_queries: int,
+    num: int,
+    temp_dir: str,
+) -> Dict[str, float]:
+    sample = make_sampler(dim)
+    queries = sample(num_queries)
+    search: Callable[[torch.Tensor], Any]
+    if storage == 'disk':
+        # written in chunks, so that the peak is the one of the blockwise search
+        prefix = os.path.join(temp_dir, f'corpus_{dim}_{size}')
+        write_corpus(prefix, size, dim)
+        queries = EmbedMatrix.normalize(queries)
+
+        def search(query: torch.Tensor) -> Any:
+            return search_embed_file(prefix, dim, query.numpy(), num)
+
+    elif storage == 'rank_topk':
+        # the list of per-record tensors matched before EmbedMatrix
+        corpus = [embed.unsqueeze(0) for embed in sample(size)]
+
+        def search(query: torch.Tensor) -> Any:
+            return rank_topk([query], corpus, num)
+
+    else:
+        matrix = EmbedMatrix(initial_capacity=size)
+        matrix.set_storage(storage)
+        # added in small chunks, so that the peak is the matrix and not a chunk
+        for offset in range(0, size, 10000):
+            chunk_size = min(10000, size - offset)
+            matrix.add_many(
+                [str(i) for i in range(offset, offset + chunk_size)],
+                sample(chunk_size),
+            )
+
+        def search(query: torch.Tensor) -> Any:
+            return matrix.search(query, num)
+
+    search(queries[:1])  # warm up
+    latencies: List[float] = []
+    start = time.perf_counter()
+    for i in range(num_queries):
+        query_start = time.perf_counter()
+        search(queries[i : i + 1])
+        latencies.append(time.perf_counter() - query_start)
+    return summarize(latencies, num_queries, time.perf_counter() - start)
+
+
+def run_case(case: Dict[str, Any], args: Dict[str, Any]) -> Dict[str, Any]:
+    # what the interpreter and the imports take before the case starts
+    import_rss_mb = peak_rss_mb()
+    torch.manual_seed(0)
+    if args['num_threads'] is not None:
+        torch.set_num_threads(args['num_threads'])
+    if case['stage'] == 'topk':
+        result = run_topk_stage(
+            case['storage'],
+            case['dim'],
+            case['size'],
+            args['num_queries'],
+            args['num'],
+            args['temp_dir'],
+        )
+    else:
+        result = run_text_stage(
+            case['stage'],
+            case['backend'],
+            args['offline'],
+            args['batch_size'],
+            args['budget_s'],
+            args['max_texts'],
+        )
+    return {**result, 'peak_rss_mb': peak_rss_mb(), 'import_rss_mb': import_rss_mb}
+
+
+def get_dim(backend: str, offline: bool) -> int:
+    if get_embedding_backend(backend) is not None:
+        return int(get_retriever(backend)[1].config.hidden_size)
+    if offline:
+        return 768
+    from transformers import AutoConfig
+
+    return int(AutoConfig.from_pretrained(backend).hidden_size)
+
+
+def get_metadata() -> Dict[str, Any]:
+    try:
+        version = metadata.version('research-town')
+    except metadata.PackageNotFoundError:
+        version = None
+    try:
+        commit: Optional[str] = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'research_town': version,
+        'commit': commit,
+        'time': datetime.now(timezone.utc).isoformat(),
+        'python': sys.version.split()[0],
+        'torch': torch.__version__,
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def case_key(case: Dict[str, Any]) -> str:
+    return '/'.join(str(case[name]) for name in ['stage', 'backend', 'storage', 'size'])
+
+
+def compare(
+    results: List[Dict[str, Any]], baseline_path: str, max_slowdown: float
+) -> bool:
+    with open(baseline_path, 'r') as f:
+        baseline = {case_key(case): case for case in json.load(f)['results']}
+    ok = True
+    for case in results:
+        old = baseline.get(case_key(case))
+        if old is None or 'p50_ms' not in old or 'p50_ms' not in case:
+            continue
+        slowdown = case['p50_ms'] / max(old['p50_ms'], 1e-9)
+        regressed = slowdown > max_slowdown
+        ok = ok and not regressed
+        print(
+            f'{"REGRESSION " if regressed else ""}{case_key(case)}: p50 '
+            f'{old["p50_ms"]:.3f} -> {case["p50_ms"]:.3f} ms ({slowdown:.2f}x)'
+        )
+    return ok
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--backends', nargs='+', default=['facebook/contriever', 'hashing']
+    )
+    parser.add_argument('--storages', nargs='+', default=list(STORAGES))
+    parser.add_argument('--stages', nargs='+', default=list(STAGES))
+    parser.add_argument(
+        '--sizes', type=int, nargs='+', default=[1000, 10000, 100000, 1000000]
+    )
+    parser.add_argument('--rank_topk_max_size', type=int, default=100000)
+    parser.add_argument('--num_queries', type=int, default=100)
+    parser.add_argument('--num', type=int, default=10)
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--budget_s', type=float, default=10.0)
+    parser.add_argument('--max_texts', type=int, default=10000)
+    parser.add_argument('--num_threads', type=int, default=None)
+    # cases estimated above this are skipped: without swap they thrash for hours
+    parser.add_argument(
+        '--memory_limit_mb',
+        type=float,
+        default=0.6 * os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') / 2**20,
+    )
+    parser.add_argument('--offline', action='store_true')
+    parser.add_argument('--output', type=str, default='bench_results.json')
+    parser.add_argument('--baseline', type=str, default=None)
+    parser.add_argument('--max_slowdown', type=float, default=1.2)
+    args = parser.parse_args()
+
+    cases: List[Dict[str, Any]] = []
+    for backend in args.backends:
+        for stage in args.stages:
+            if stage != 'topk':
+                cases.append(
+                    {'stage': stage, 'backend': backend, 'storage': None, 'size': None}
+                )
+                continue
+            dim = get_dim(backend, args.offline)
+            for storage in args.storages:
+                for size in args.sizes:
+                    if storage == 'rank_topk' and size > args.rank_topk_max_size:
+                        continue
+                    cases.append(
+                        {
+                            'stage': stage,
+                            'backend': backend,
+                            'storage': storage,
+                            'size': size,
+                            'dim': dim,
+                        }
+                    )
+
+    results = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        run_args = {**vars(args), 'temp_dir': temp_dir}
+        for case in cases:
+            if estimate_mb(case) > args.memory_limit_mb:
+                results.append(
+                    {
+                        **case,
+                        'skipped': f'needs ~{estimate_mb(case):.0f} MB, more than '
+                        f'--memory_limit_mb {args.memory_limit_mb:.0f}',
+                    }
+                )
+                print(json.dumps(results[-1]), flush=True)
+                continue
+            # a fresh process per case, so that peak memory is not inherited
+            with ProcessPoolExecutor(
+                1, mp_context=multiprocessing.get_context('spawn')
+            ) as pool:
+                try:
+                    result = pool.submit(run_case, case, run_args).result()
+                except (BrokenProcessPool, MemoryError, RuntimeError) as e:
+                    # e.g. killed for running out of memory at the largest size
+                    result = {'error': repr(e)}
+            results.append({**case, **result})
+            print(json.dumps(results[-1]), flush=True)
+            for path in os.listdir(temp_dir):
+                os.remove(os.path.join(temp_dir, path))
+
+    with open(args.output, 'w') as f:
+        json.dump({'metadata': get_metadata(), 'results': results}, f, indent=2)
+    print(f'Wrote {len(results)} results to {args.output}')
+    if args.baseline is not None and not compare(
+        results, args.baseline, args.max_slowdown
+    ):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
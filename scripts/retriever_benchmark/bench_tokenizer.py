@@ -0,0 +1,78 @@
+import argparse
+import os
+import tempfile
+import time
+
+import transformers
+from utils import load_abstracts, load_retriever
+
+from research_town.utils.embed_cache import EmbedCache
+from research_town.utils.retriever import (
+    get_embed_batch,
+    get_embed_stats,
+    reset_embed_stats,
+    tokenize_batch,
+)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_name', type=str, default='facebook/contriever')
+    parser.add_argument('--num_texts', type=int, default=2000)
+    parser.add_argument('--num_embed_texts', type=int, default=64)
+    parser.add_argument('--offline', action='store_true')
+    args = parser.parse_args()
+
+    corpus = load_abstracts(args.num_texts)
+    tokenizer, model = load_retriever(args.model_name, args.offline, corpus)
+    # the pure-Python tokenizer is BertTokenizer before transformers 5
+    slow_class = getattr(
+        transformers, 'BertTokenizerLegacy', transformers.BertTokenizer
+    )
+    with tempfile.TemporaryDirectory() as temp_dir:
+        vocab = tokenizer.get_vocab()
+        vocab_file = os.path.join(temp_dir, 'vocab.txt')
+        with open(vocab_file, 'w') as f:
+            f.write('\n'.join(sorted(vocab, key=vocab.__getitem__)))
+        slow_tokenizer = slow_class(vocab_file)
+
+        start = time.perf_counter()
+        slow_ids = slow_tokenizer(corpus, truncation=True, max_length=512)['input_ids']
+        slow_time = time.perf_counter() - start
+        print(f'python tokenizer: {len(corpus) / slow_time:.0f} texts/sec')
+
+        start = time.perf_counter()
+        fast_ids = tokenize_batch(corpus, tokenizer)
+        fast_time = time.perf_counter() - start
+        print(
+            f'fast tokenizer: {len(corpus) / fast_time:.0f} texts/sec, '
+            f'speedup {slow_time / fast_time:.1f}x, '
+            f'same ids: {[list(ids) for ids in slow_ids] == fast_ids}'
+        )
+
+        cache = EmbedCache(os.path.join(temp_dir, 'cache'), cache_token_ids=True)
+        tokenize_batch(corpus, tokenizer, token_cache=cache)
+        start = time.perf_counter()
+        cached_ids = tokenize_batch(corpus, tokenizer, token_cache=cache)
+        cached_time = time.perf_counter() - start
+        print(
+            f'cached token ids: {len(corpus) / cached_time:.0f} texts/sec, '
+            f'speedup {slow_time / cached_time:.1f}x, '
+            f'same ids: {cached_ids == fast_ids}'
+        )
+        cache.close()
+
+    # where the time of an embedding call goes
+    for name, embed_tokenizer in [('python', slow_tokenizer), ('fast', tokenizer)]:
+        reset_embed_stats()
+        get_embed_batch(corpus[: args.num_embed_texts], embed_tokenizer, model)
+        stats = get_embed_stats()
+        print(
+            f'embedding {args.num_embed_texts} texts with the {name} tokenizer: '
+            f'{stats["tokenize_seconds"] * 1000:.1f} ms tokenizing, '
+            f'{stats["model_seconds"] * 1000:.0f} ms in the model'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+import glob
+import json
+import os
+import re
+import tempfile
+from collections import Counter
+from typing import Callable, Dict, List, Tuple, cast
+
+import torch
+from transformers import AutoTokenizer, BertConfig, BertModel, PreTrainedTokenizerFast
+
+from research_town.utils.embed_matrix import EmbedMatrix
+
+PAPER_DATA_DIR = os.path.join(
+    os.path.dirname(__file__), '..', '..', 'data', 'paper_data'
+)
+
+
+def load_abstracts(limit: int) -> List[str]:
+    abstracts: List[str] = []
+    for file_path in sorted(glob.glob(os.path.join(PAPER_DATA_DIR, '*.json'))):
+        with open(file_path, 'r') as f:
+            papers = json.load(f)
+        abstracts.extend(paper['abstract'] for paper in papers.values())
+    return abstracts[:limit]
+
+
+def load_titles_and_abstracts(limit: int) -> List[Tuple[str, str]]:
+    papers: List[Tuple[str, str]] = []
+    for file_path in sorted(glob.glob(os.path.join(PAPER_DATA_DIR, '*.json'))):
+        with open(file_path, 'r') as f:
+            papers.extend(
+                (paper['title'], paper['abstract']) for paper in json.load(f).values()
+            )
+    return papers[:limit]
+
+
+def load_retriever(
+    model_name: str, offline: bool, corpus: List[str]
+) -> Tuple[PreTrainedTokenizerFast, BertModel]:
+    if not offline:
+        return (
+            cast(
+                PreTrainedTokenizerFast,
+                AutoTokenizer.from_pretrained(model_name, use_fast=True),
+            ),
+            BertModel.from_pretrained(model_name),
+        )
+    # same architecture as contriever with random weights and a corpus vocabulary,
+    # so that timings are representative without downloading the checkpoint
+    words = Counter(
+        word for text in corpus for word in re.findall(r'\w+|[^\w\s]', text.lower())
+    )
+    vocab = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + [
+        word for word, _ in words.most_common(30000)
+    ]
+    with tempfile.TemporaryDirectory() as temp_dir:
+        vocab_file = os.path.join(temp_dir, 'vocab.txt')
+        with open(vocab_file, 'w') as f:
+            f.write('\n'.join(vocab))
+        with open(os.path.join(temp_dir, 'tokenizer_config.json'), 'w') as f:
+            json.dump({'tokenizer_class': 'BertTokenizer'}, f)
+        # the Rust tokenizer, as get_retriever loads it
+        tokenizer = cast(
+            PreTrainedTokenizerFast,
+            AutoTokenizer.from_pretrained(temp_dir, use_fast=True),
+        )
+    model = BertModel(BertConfig())  # type: ignore[no-untyped-call]
+    model.eval()  # type: ignore[no-untyped-call]
+    return tokenizer, model
+
+
+def read_rss_mb() -> Dict[str, float]:
+    rss = {}
+    with open('/proc/self/status', 'r') as f:
+        for line in f:
+            if line.startswith(('RssAnon:', 'RssFile:')):
+                name, value, _ = line.split()
+                rss[name.rstrip(':')] = int(value) / 1024
+    return rss
+
+
+def make_sampler(
+    dim: int, intrinsic_dim: int = 32, noise: float = 0.1, seed: int = 0
+) -> Callable[[int], torch.Tensor]:
+    # a random low-dimensional subspace plus noise: like real embeddings, the
+    # data has far fewer degrees of freedom than dimensions, while unlike
+    # well-separated clusters the neighbourhoods blend into each other
+    generator = torch.Generator().manual_seed(seed)
+    projection = torch.randn(intrinsic_dim, dim, generator=generator)
+
+    def sample(num: int) -> torch.Tensor:
+        latent = torch.randn(num, intrinsic_dim, generator=generator)
+        return latent @ projection + noise * torch.randn(num, dim, generator=generator)
+
+    return sample
+
+
+def make_matrix(size: int, sample: Callable[[int], torch.Tensor]) -> EmbedMatrix:
+    matrix = EmbedMatrix(initial_capacity=size)
+    for start in range(0, size, 100000):
+        chunk_size = min(100000, size - start)
+        matrix.add_many(
+            [str(i) for i in range(start, start + chunk_size)], sample(chunk_size)
+        )
+    return matrix
@@ -1,5 +1,6 @@
 from unittest.mock import MagicMock, patch
 
+from research_town.agents import AgentManager
 from research_town.agents.agent import Agent
 from research_town.data import Idea, Insight, MetaReview, Proposal, Rebuttal, Review
 from tests.constants.config_constants import example_config
@@ -12,7 +13,9 @@ from tests.constants.data_constants import (
     research_insight_A,
     research_insight_B,
     research_proposal_A,
+    research_proposal_B,
 )
+from tests.constants.db_constants import example_profile_db
 from tests.mocks.mocking_func import mock_prompting
 
 
@@ -163,3 +166,30 @@ def test_write_rebuttal(mock_model_prompting: MagicMock) -> None:
     if rebuttal.content is not None:
         assert len(rebuttal.content) > 0
     assert rebuttal.content == 'Rebuttal text1'
+
+
+def test_agent_manager_batch() -> None:
+    agent_manager = AgentManager(config=example_config, profile_db=example_profile_db)
+    proposals = [research_proposal_A, research_proposal_B]
+    reviewers = agent_manager.find_reviewers_batch(proposals)
+    chairs = agent_manager.find_chair_batch(proposals)
+    assert len(reviewers) == len(chairs) == 2
+    for proposal, proposal_reviewers, chair in zip(proposals, reviewers, chairs):
+        assert [agent.profile for agent in proposal_reviewers] == [
+            agent.profile for agent in agent_manager.find_reviewers(proposal)
+        ]
+        assert chair.profile == agent_manager.find_chair(proposal).profile
+        assert chair.role == 'chair'
+
+
+def test_agent_manager_mmr() -> None:
+    agent_manager = AgentManager(config=example_config, profile_db=example_profile_db)
+    proposal = research_proposal_A
+    # with mmr_lambda=1 the re-rank keeps the relevance order
+    assert {
+        agent.profile.pk for agent in agent_manager.find_reviewers(proposal, 1.0)
+    } == {agent.profile.pk for agent in agent_manager.find_reviewers(proposal)}
+    members = agent_manager.find_agents(
+        role='member', query=proposal.content, num=2, mmr_lambda=0.5
+    )
+    assert len({agent.profile.pk for agent in members}) == len(members) <= 2
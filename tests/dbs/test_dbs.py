@@ -1,6 +1,8 @@
 import json
+import os
 import pickle
 import shutil
+import threading
 from tempfile import TemporaryDirectory
 from unittest.mock import MagicMock, patch
 
@@ -16,8 +18,10 @@ from research_town.data import (
     ReviewWritingLog,
 )
 from research_town.dbs import LogDB, PaperDB, ProfileDB, ProgressDB
+from research_town.utils.embed_storage import embed_file_exists
+from research_town.utils.retriever import get_embed, get_embed_batch
 from tests.constants.config_constants import example_config
-from tests.mocks.mocking_func import mock_prompting
+from tests.mocks.mocking_func import mock_prompting, mock_retriever
 
 
 def test_LogDB_basic() -> None:
@@ -287,6 +291,30 @@ def test_paper_match() -> None:
     assert len(match_papers) == 2
 
 
+def test_match_many() -> None:
+    profile_db = ProfileDB()
+    for name, bio in [('A', 'Expert in NLP'), ('B', 'Graph learning'), ('C', 'AI')]:
+        profile_db.add(Profile(name=name, bio=bio))
+    queries = ['nlp expert', 'graph neural networks', 'vision']
+    matched = profile_db.match_many(queries, role='reviewer', num=2)
+    assert len(matched) == 3
+    for query, profiles in zip(queries, matched):
+        assert profiles == profile_db.match(query=query, role='reviewer', num=2)
+    assert profile_db.match_many([], role='reviewer') == []
+
+    # role flags are filter columns and follow updates
+    profile_db.update(matched[0][0].pk, {'is_reviewer_candidate': False})
+    assert matched[0][0] not in profile_db.match('nlp expert', role='reviewer', num=3)
+
+    paper_db = PaperDB()
+    for i, domain in enumerate(['nlp', 'graph', 'nlp']):
+        paper_db.add(Paper(title=f'paper {i}', abstract=f'{domain} paper'))
+    matched_papers = paper_db.match_many(queries, num=1, title='paper 1')
+    assert [[paper.title for paper in papers] for papers in matched_papers] == [
+        ['paper 1']
+    ] * 3
+
+
 def test_agent_file() -> None:
     db = ProfileDB()
     agent1 = Profile(name='John Doe', bio='Profile in AI', institute='AI Institute')
@@ -391,3 +419,549 @@ def test_pull_papers() -> None:
     assert db.data.keys()
     assert len(db.data.keys()) == 2
     assert db.data.values()
+
+
+def test_transform_to_embed_incremental() -> None:
+    retriever_tokenizer, retriever_model = mock_retriever()
+    db = PaperDB()
+    db.retriever_tokenizer, db.retriever_model = retriever_tokenizer, retriever_model
+    paper1 = Paper(title='Paper 1', abstract='a survey of machine learning')
+    paper2 = Paper(title='Paper 2', abstract='graph neural networks')
+    db.add(paper1)
+    db.add(paper2)
+
+    with patch(
+        'research_town.dbs.db_base.get_embed', wraps=get_embed
+    ) as mock_get_embed:
+        db.transform_to_embed()
+        assert sorted(mock_get_embed.call_args.args[0]) == [
+            'a survey of machine learning',
+            'graph neural networks',
+        ]
+        assert db.data_embed.keys() == {paper1.pk, paper2.pk}
+        embed1 = db.data_embed[paper1.pk]
+
+        # nothing changed, so nothing is embedded again
+        db.transform_to_embed()
+        db.update(paper1.pk, {'title': 'New title'})
+        db.transform_to_embed()
+        assert mock_get_embed.call_count == 1
+
+        # only new or changed records are embedded
+        paper3 = Paper(title='Paper 3', abstract='nlp')
+        db.add(paper3)
+        db.update(paper1.pk, {'abstract': 'expert in vision'})
+        db.transform_to_embed()
+        assert mock_get_embed.call_count == 2
+        assert sorted(mock_get_embed.call_args.args[0]) == ['expert in vision', 'nlp']
+        assert not torch.equal(db.data_embed[paper1.pk], embed1)
+
+        # match reuses the stored vectors
+        db.match(query='machine learning', num=2)
+        assert mock_get_embed.call_count == 2
+
+    db.delete(paper2.pk)
+    assert paper2.pk not in db.data_embed
+    assert db.data_embed.keys() == {paper1.pk, paper3.pk}
+
+
+def test_transform_to_embed_concurrent_change() -> None:
+    db = PaperDB()
+    db.retriever_tokenizer, db.retriever_model = mock_retriever()
+    paper1 = Paper(title='Paper 1', abstract='a survey of machine learning')
+    paper2 = Paper(title='Paper 2', abstract='graph neural networks')
+    paper3 = Paper(title='Paper 3', abstract='nlp')
+    for paper in [paper1, paper2, paper3]:
+        db.add(paper)
+
+    def embed_while_changing(texts: List[str], *args: Any, **kwargs: Any) -> Any:
+        # records change and get deleted while their batch is in the model
+        db.update(paper1.pk, {'abstract': 'expert in vision'})
+        db.delete(paper2.pk)
+        return get_embed(texts, *args, **kwargs)
+
+    with patch('research_town.dbs.db_base.get_embed', side_effect=embed_while_changing):
+        db.transform_to_embed()
+    # the outdated vector is dropped and the changed record stays dirty
+    assert db.data_embed.keys() == {paper3.pk}
+    assert db.dirty_pks == {paper1.pk}
+
+    db.transform_to_embed()
+    assert db.dirty_pks == set()
+    expected = get_embed(
+        ['expert in vision'], db.retriever_tokenizer, db.retriever_model
+    )[0]
+    assert torch.allclose(
+        db.data_embed[paper1.pk], torch.nn.functional.normalize(expected), atol=1e-5
+    )
+
+
+def test_load_from_json_over_embeds() -> None:
+    db = PaperDB()
+    db.retriever_tokenizer, db.retriever_model = mock_retriever()
+    paper1 = Paper(title='Paper 1', abstract='a survey of machine learning')
+    paper2 = Paper(title='Paper 2', abstract='graph neural networks')
+    db.add(paper1)
+    db.add(paper2)
+    with TemporaryDirectory() as temp_dir, TemporaryDirectory() as embed_dir:
+        db.save_to_json(temp_dir)
+        paper3 = Paper(title='Paper 3', abstract='nlp')
+        db.add(paper3)
+        db.update(paper1.pk, {'abstract': 'expert in vision'})
+        db.transform_to_embed()
+        db.save_to_json(embed_dir, with_embed=True)
+
+        # rows of records that are gone or whose text changed are dropped
+        db.load_from_json(temp_dir)
+        assert db.data_embed.keys() == {paper2.pk}
+        assert db.dirty_pks == {paper1.pk}
+        matched = db.match('a survey of machine learning', num=3)
+        assert {paper.pk for paper in matched} == {paper1.pk, paper2.pk}
+
+        # a pickle with extra records only fills in the loaded ones
+        db.load_from_pkl(embed_dir)
+        assert db.data_embed.keys() == {paper1.pk, paper2.pk}
+        assert len(db.match('nlp', num=3)) == 2
+
+    profile_db = ProfileDB()
+    profile_db.retriever_tokenizer, profile_db.retriever_model = mock_retriever()
+    profile1 = Profile(name='John Doe', bio='Profile in AI')
+    profile2 = Profile(name='Jane Smith', bio='Expert in NLP')
+    profile_db.add(profile1)
+    with TemporaryDirectory() as temp_dir:
+        profile_db.save_to_json(temp_dir)
+        profile_db.add(profile2)
+        profile_db.transform_to_embed()
+        profile_db.load_from_json(temp_dir)
+        matched_profiles = profile_db.match('Expert in NLP', role='reviewer', num=2)
+        assert [profile.pk for profile in matched_profiles] == [profile1.pk]
+
+
+def test_paper_mmap_file() -> None:
+    db = PaperDB()
+    db.retriever_tokenizer, db.retriever_model = mock_retriever()
+    db.add(Paper(title='Paper 1', abstract='a survey of machine learning'))
+    db.add(Paper(title='Paper 2', abstract='graph neural networks'))
+    db.transform_to_embed()
+
+    with TemporaryDirectory() as temp_dir:
+        # existing pickles are converted on the first mmap load
+        db.save_to_json(temp_dir, with_embed=True)
+        db_test = PaperDB()
+        db_test.set_embed_format('mmap')
+        db_test.load_from_json(temp_dir, with_embed=True)
+        assert os.path.exists(os.path.join(temp_dir, 'PaperDB.embeds.bin'))
+        assert db_test.data_embed.keys() == db.data_embed.keys()
+        for pk in db.data_embed:
+            assert torch.equal(db_test.data_embed[pk], db.data_embed[pk])
+        assert db_test.dirty_pks == set()
+
+        # mapped embeddings stay usable for updates and matching
+        db_test.retriever_tokenizer = db.retriever_tokenizer
+        db_test.retriever_model = db.retriever_model
+        db_test.add(Paper(title='Paper 3', abstract='nlp'))
+        assert len(db_test.match(query='nlp', num=3)) == 3
+
+        # mmap files are picked up even without setting the format
+        db_test.save_to_mmap(temp_dir)
+        # the saved file holds the new row too and is mapped in place
+        assert db_test.data_embed.base_size == len(db_test.data_embed) == 3
+        assert len(db_test.match(query='nlp', num=3)) == 3
+        db_reload = PaperDB()
+        db_reload.load_from_json(temp_dir, with_embed=True)
+        # the JSON was saved before Paper 3, so its row is left out
+        assert db_reload.data_embed.keys() == db.data_embed.keys()
+
+
+def test_paper_disk_file() -> None:
+    db = PaperDB()
+    db.retriever_tokenizer, db.retriever_model = mock_retriever()
+    for i, domain in enumerate(['ml', 'ml', 'nlp', 'nlp']):
+        db.add(Paper(title=f'Paper {i}', abstract=f'abstract {i}', domain=domain))
+    db.transform_to_embed()
+    expected = db.match_many(['abstract 2', 'abstract 0'], num=2, domain='nlp')
+
+    with TemporaryDirectory() as temp_dir:
+        db.save_to_json(temp_dir, with_embed=True)
+        db_test = PaperDB()
+        db_test.retriever_tokenizer = db.retriever_tokenizer
+        db_test.retriever_model = db.retriever_model
+        db_test.set_embed_format('disk', block_size=2)
+        db_test.load_from_json(temp_dir, with_embed=True)
+        # embeddings stay on disk and are searched blockwise
+        assert len(db_test.data_embed) == 0
+        assert db_test.dirty_pks == set()
+        results = db_test.match_many(['abstract 2', 'abstract 0'], num=2, domain='nlp')
+        assert [{paper.pk for paper in papers} for papers in results] == [
+            {paper.pk for paper in papers} for papers in expected
+        ]
+
+        # new, changed and deleted records are handled in memory until saved
+        paper = Paper(title='Paper 4', abstract='graph neural networks', domain='nlp')
+        db_test.add(paper)
+        deleted = db_test.get(title='Paper 2')[0]
+        db_test.delete(deleted.pk)
+        matched = db_test.match('graph neural networks', num=4, domain='nlp')
+        assert matched[0].pk == paper.pk
+        assert deleted.pk not in [paper.pk for paper in matched]
+        assert len(db_test.match('abstract', num=10)) == 4
+
+        # the file rows searches read are kept up to date, not rebuilt per query
+        assert not db_test.embed_file_mask[db_test.embed_file_rows[deleted.pk]]
+        changed = db_test.get(title='Paper 0')[0]
+        db_test.update(changed.pk, {'abstract': 'abstract 0 revised'})
+        assert not db_test.embed_file_mask[db_test.embed_file_rows[changed.pk]]
+        assert int(db_test.embed_file_mask.sum()) == 2
+        assert db_test.match('abstract 0 revised', num=1)[0].pk == changed.pk
+
+        db_test.save_to_json(temp_dir, with_embed=True)
+        assert len(db_test.data_embed) == 0
+        assert set(db_test.embed_file_pks) == set(db_test.data)
+        assert db_test.embed_file_mask.all()
+        assert db_test.match('graph neural networks', num=1)[0].pk == paper.pk
+
+
+@patch('research_town.dbs.db_paper.get_related_papers')
+def test_paper_upsert(mock_get_related_papers: MagicMock) -> None:
+    db = PaperDB()
+    db.retriever_tokenizer, db.retriever_model = mock_retriever()
+    paper = Paper(
+        title='Paper 1',
+        abstract='graph neural networks',
+        url='http://arxiv.org/abs/2401.00001v1',
+        citation_count=3,
+    )
+    assert db.upsert(paper) is paper
+
+    # a newer version of the same arXiv paper is merged into the stored one
+    newer = Paper(
+        title='Paper 1 (v2)',
+        abstract='graph neural networks',
+        url='https://arxiv.org/pdf/2401.00001v2',
+        keywords=['gnn'],
+    )
+    stored = db.upsert(newer)
+    assert stored.pk == paper.pk
+    assert len(db.data) == 1
+    assert stored.title == 'Paper 1 (v2)'
+    assert stored.keywords == ['gnn']
+    assert stored.citation_count == 3
+    assert db.get_by_key('arXiv:2401.00001') is stored
+
+    # repeated searches return the stored papers instead of adding copies
+    mock_get_related_papers.side_effect = lambda **kwargs: [
+        Paper(title='Paper 1', abstract='graph neural networks', url=paper.url),
+        Paper(title='Paper 2', abstract='nlp', url='https://example.com/paper/2/'),
+    ]
+    for _ in range(3):
+        papers = db.search_papers(num=2, query='graphs')
+        db.transform_to_embed()
+    assert len(db.data) == 2
+    assert len(db.data_embed) == 2
+    assert papers[0] is stored
+    assert db.get_by_key('https://example.com/paper/2') is papers[1]
+
+    db.delete(stored.pk)
+    assert db.get_by_key(paper.url) is None
+    assert db.upsert(paper) is paper
+
+
+def test_paper_dedup() -> None:
+    abstract = (
+        'We propose a graph neural network for molecular property prediction '
+        'that combines message passing with attention over substructures and '
+        'reaches state of the art results on several benchmarks.'
+    )
+    paper = Paper(title='Molecular GNNs', abstract=abstract, url='https://a.org/1')
+    # the same paper from another source, with a reworded sentence end
+    copy = Paper(
+        title='Molecular  GNNs',
+        abstract=abstract.replace('several benchmarks.', 'several benchmarks!'),
+        url='https://b.org/2',
+        keywords=['gnn'],
+        timestamp=100,
+    )
+    other = Paper(title='Language models', abstract='We train a large language model.')
+
+    db = PaperDB()
+    db.retriever_tokenizer, db.retriever_model = mock_retriever()
+    db.set_dedup_mode('merge')
+    db.add(paper)
+    assert db.upsert(copy) is paper
+    db.add(other)
+    assert list(db.data) == [paper.pk, other.pk]
+    assert db.duplicates == {copy.pk: paper.pk}
+    assert db.get_canonical(copy.pk) is paper
+    # missing fields are taken over, the abstract and URL stay
+    assert paper.keywords == ['gnn']
+    assert paper.timestamp == 100
+    assert paper.url == 'https://a.org/1'
+    db.transform_to_embed()
+    assert len(db.data_embed) == 2
+
+    db.set_dedup_mode('flag')
+    db.add(copy)
+    assert len(db.data) == 3
+    assert db.duplicates == {copy.pk: paper.pk}
+    # deleting the first paper of a group promotes its duplicate
+    db.delete(paper.pk)
+    assert db.duplicates == {}
+    assert db.dedup_index is not None and copy.pk in db.dedup_index
+
+    # a bulk load drops the duplicates stored before
+    with TemporaryDirectory() as temp_dir:
+        db.add(paper)
+        assert db.duplicates == {paper.pk: copy.pk}
+        db.save_to_json(temp_dir)
+        loaded_db = PaperDB()
+        loaded_db.set_dedup_mode('merge')
+        loaded_db.load_from_json(temp_dir)
+        assert list(loaded_db.data) == [other.pk, copy.pk]
+        assert loaded_db.duplicates == {paper.pk: copy.pk}
+
+
+def test_paper_time_range() -> None:
+    db = PaperDB()
+    db.retriever_tokenizer, db.retriever_model = mock_retriever()
+    papers = [
+        Paper(title=f'Paper {i}', abstract=f'graph networks {i}', timestamp=timestamp)
+        for i, timestamp in enumerate([300, 100, 200, None])
+    ]
+    for paper in papers:
+        db.add(paper)
+
+    assert db.get(before=300) == [papers[1], papers[2]]
+    assert db.get(after=100, title='Paper 0') == [papers[0]]
+    assert db.get(before=100) == []
+    assert len(db.get()) == 4
+
+    for match_mode in ['dense', 'hybrid']:
+        db.set_match_mode(match_mode)
+        matched = db.match('graph networks', num=4, before=300)
+        assert {paper.pk for paper in matched} == {papers[1].pk, papers[2].pk}
+        assert db.match_many(['graph networks'], num=2, before=100) == [[]]
+
+    db.update(papers[0].pk, {'timestamp': 50})
+    db.delete(papers[1].pk)
+    assert db.get(before=300) == [papers[0], papers[2]]
+
+    with TemporaryDirectory() as temp_dir:
+        db.save_to_json(temp_dir)
+        db_test = PaperDB()
+        db_test.load_from_json(temp_dir)
+        assert [paper.pk for paper in db_test.get(after=0)] == [
+            papers[0].pk,
+            papers[2].pk,
+        ]
+
+
+def test_paper_match_mmr() -> None:
+    db = PaperDB()
+    db.retriever_tokenizer, db.retriever_model = mock_retriever()
+    papers = [
+        Paper(title='Paper 0', abstract='graph neural networks'),
+        Paper(title='Paper 1', abstract='graph neural networks'),
+        Paper(title='Paper 2', abstract='a survey of graph vision'),
+    ]
+    for paper in papers:
+        db.add(paper)
+    duplicates = {papers[0].pk, papers[1].pk}
+
+    for match_mode in ['dense', 'hybrid']:
+        db.set_match_mode(match_mode)
+        assert {paper.pk for paper in db.match('graph neural networks', num=2)} == (
+            duplicates
+        )
+        assert {
+            paper.pk
+            for paper in db.match('graph neural networks', num=2, mmr_lambda=1.0)
+        } == duplicates
+        # the second copy adds nothing, so a diverse re-rank skips it
+        matched = db.match('graph neural networks', num=2, mmr_lambda=0.3)
+        assert matched[0].pk in duplicates
+        assert matched[1].pk == papers[2].pk
+
+    db.set_match_mode('dense')
+    with TemporaryDirectory() as temp_dir:
+        db.save_to_json(temp_dir, with_embed=True)
+        db_test = PaperDB()
+        db_test.retriever_tokenizer = db.retriever_tokenizer
+        db_test.retriever_model = db.retriever_model
+        db_test.set_embed_format('disk')
+        db_test.load_from_json(temp_dir, with_embed=True)
+        matched = db_test.match('graph neural networks', num=2, mmr_lambda=0.3)
+        assert matched[1].pk == papers[2].pk
+
+
+def test_paper_hashing_backend() -> None:
+    db = PaperDB()
+    db.retriever_tokenizer, db.retriever_model = mock_retriever()
+    papers = [
+        Paper(title='Paper 0', abstract='graph neural networks for molecules'),
+        Paper(title='Paper 1', abstract='a survey of vision transformers'),
+    ]
+    for paper in papers:
+        db.add(paper)
+    db.transform_to_embed()
+    assert db.data_embed.dim == 16
+
+    # another model drops the old vectors and embeds everything again
+    db.set_retriever_model('hashing:512')
+    assert len(db.data_embed) == 0
+    assert db.dirty_pks == {paper.pk for paper in papers}
+    assert db.match('neural networks for graphs', num=1)[0].pk == papers[0].pk
+    assert db.data_embed.dim == 512
+
+
+def test_paper_embed_worker() -> None:
+    db = PaperDB()
+    db.retriever_tokenizer, db.retriever_model = mock_retriever()
+    db.add(Paper(title='Paper 0', abstract='a survey of vision'))
+    db.transform_to_embed()
+
+    gate = threading.Event()
+    embed_texts = db._embed_texts
+
+    def gated_embed_texts(texts: List[str]) -> torch.Tensor:
+        gate.wait()
+        return embed_texts(texts)
+
+    setattr(db, '_embed_texts', gated_embed_texts)
+    db.set_embed_worker(True, wait_timeout=0)
+    paper = Paper(title='Paper 1', abstract='graph neural networks')
+    db.add(paper)
+    assert db.get_pending_pks() == {paper.pk}
+
+    # not embedded yet: the paper is still matched by its terms
+    matched = db.match('graph neural networks', num=2)
+    assert paper.pk in [match.pk for match in matched]
+    assert paper.pk not in db.data_embed
+
+    gate.set()
+    db.transform_to_embed()
+    assert paper.pk in db.data_embed
+    assert db.get_pending_pks() == set()
+    assert db.dirty_pks == set()
+    assert paper.pk in [match.pk for match in db.match('graph neural networks', 2)]
+    db.set_embed_worker(False)
+
+
+def test_paper_reembed() -> None:
+    db = PaperDB()
+    db.retriever_tokenizer, db.retriever_model = mock_retriever()
+    papers = [
+        Paper(title='Paper 0', abstract='graph neural networks'),
+        Paper(title='Paper 1', abstract='a survey of vision'),
+        Paper(title='Paper 2', abstract='language models'),
+    ]
+    for paper in papers:
+        db.add(paper)
+    db.transform_to_embed()
+    old_version = db.embed_version
+
+    gate = threading.Event()
+
+    def gated_get_embed_batch(*args: Any, **kwargs: Any) -> torch.Tensor:
+        if args[2] is not db.retriever_model:
+            gate.wait()
+        return get_embed_batch(*args, **kwargs)
+
+    with patch(
+        'research_town.dbs.db_base.get_embed_batch', side_effect=gated_get_embed_batch
+    ):
+        db.set_retriever_model('hashing', background=True)
+        build = db.embed_build
+        assert build is not None
+        # searches keep using the current embeddings during the build
+        assert db.match('graph neural networks')[0].pk == papers[0].pk
+        assert db.retriever_model_name != 'hashing'
+        progress = db.get_embed_progress()
+        assert progress is not None
+        assert (progress['state'], progress['done']) == ('running', 0)
+        added = Paper(title='Paper 3', abstract='graph neural networks again')
+        db.add(added)
+        db.update(papers[1].pk, {'abstract': 'reinforcement learning'})
+        db.delete(papers[2].pk)
+
+        gate.set()
+        assert build.wait(timeout=30)
+    progress = db.get_embed_progress()
+    assert progress is not None
+    assert progress['state'] == 'done'
+    assert progress['total'] == 3
+    assert db.retriever_model_name == 'hashing'
+    assert db.embed_version == progress['version'] > old_version
+    # changes made during the build are in the new set as well
+    assert set(db.data_embed) == {papers[0].pk, papers[1].pk, added.pk}
+    assert db.data_embed.dim == 1024
+    assert db.dirty_pks == set()
+    matched = db.match('reinforcement learning', num=1)
+    assert matched[0].pk == papers[1].pk
+
+
+def test_paper_reembed_disk() -> None:
+    papers = [
+        Paper(title='Paper 0', abstract='graph neural networks'),
+        Paper(title='Paper 1', abstract='a survey of vision'),
+        Paper(title='Paper 2', abstract='language models'),
+    ]
+    with TemporaryDirectory() as temp_dir:
+        db = PaperDB()
+        db.retriever_tokenizer, db.retriever_model = mock_retriever()
+        for paper in papers:
+            db.add(paper)
+        db.transform_to_embed()
+        db.save_to_json(temp_dir, with_embed=True)
+
+        db_test = PaperDB()
+        db_test.retriever_tokenizer = db.retriever_tokenizer
+        db_test.retriever_model = db.retriever_model
+        db_test.set_embed_format('disk', block_size=2)
+        db_test.load_from_json(temp_dir, with_embed=True)
+        embed_prefix = os.path.join(temp_dir, 'PaperDB')
+        assert db_test.embed_file == embed_prefix
+
+        gate = threading.Event()
+
+        def gated_get_embed_batch(*args: Any, **kwargs: Any) -> torch.Tensor:
+            if args[2] is not db_test.retriever_model:
+                gate.wait()
+            return get_embed_batch(*args, **kwargs)
+
+        with patch(
+            'research_town.dbs.db_base.get_embed_batch',
+            side_effect=gated_get_embed_batch,
+        ):
+            build = db_test.start_reembed('hashing', batch_size=2)
+            assert db_test.match('graph neural networks')[0].pk == papers[0].pk
+            added = Paper(title='Paper 3', abstract='graph neural networks again')
+            db_test.add(added)
+            db_test.update(papers[1].pk, {'abstract': 'reinforcement learning'})
+            db_test.delete(papers[2].pk)
+            gate.set()
+            assert build.wait(timeout=30)
+        assert build.state == 'done'
+        # the new set is written to a file next to the loaded one, which stays
+        assert db_test.embed_file == f'{embed_prefix}.v1'
+        assert embed_file_exists(embed_prefix)
+        assert db_test.embed_file_dim == 1024
+        # the deleted record was left out of the second block
+        assert db_test.embed_file_pks == [papers[0].pk, papers[1].pk]
+        # only the records changed during the build are held in memory
+        assert set(db_test.data_embed) == {papers[1].pk, added.pk}
+        assert db_test.dirty_pks == set()
+        matched = db_test.match('reinforcement learning', num=1)
+        assert matched[0].pk == papers[1].pk
+        assert {paper.pk for paper in db_test.match('graph', num=3)} == {
+            papers[0].pk,
+            papers[1].pk,
+            added.pk,
+        }
+
+        # a file written by a build is removed once another one replaces it
+        build = db_test.start_reembed('hashing:512')
+        assert build.wait(timeout=30)
+        assert db_test.embed_file == f'{embed_prefix}.v2'
+        assert not embed_file_exists(f'{embed_prefix}.v1')
+        assert db_test.embed_file_dim == 512
+        assert len(db_test.data_embed) == 0
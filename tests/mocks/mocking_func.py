@@ -1,5 +1,10 @@
-from beartype.typing import Any, Dict, List, Optional
+import os
+import tempfile
+
+import torch
+from beartype.typing import Any, Dict, List, Optional, Tuple
 from pydantic import BaseModel
+from transformers import BertConfig, BertModel, BertTokenizer
 
 from tests.constants.config_constants import example_config
 
@@ -118,3 +123,28 @@ def mock_api_call_success(*args: Any, **kwargs: Any) -> Optional[List[str]]:
 
 def mock_api_call_failure(*args: Any, **kwargs: Any) -> Optional[List[str]]:
     raise Exception('API call failed')
+
+
+def mock_retriever() -> Tuple[BertTokenizer, BertModel]:
+    # a tiny randomly initialized BERT that runs offline in a few milliseconds
+    vocab = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + [
+        'a', 'abstract', 'ai', 'data', 'expert', 'for', 'graph', 'in', 'is',
+        'learning', 'machine', 'networks', 'neural', 'nlp', 'of', 'paper',
+        'profile', 'researcher', 'survey', 'the', 'this', 'vision',
+    ]  # fmt: skip
+    with tempfile.TemporaryDirectory() as temp_dir:
+        vocab_file = os.path.join(temp_dir, 'vocab.txt')
+        with open(vocab_file, 'w') as f:
+            f.write('\n'.join(vocab))
+        tokenizer = BertTokenizer(vocab_file)
+    config = BertConfig(
+        vocab_size=len(vocab),
+        hidden_size=16,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        intermediate_size=32,
+    )
+    torch.manual_seed(0)
+    model = BertModel(config)  # type: ignore[no-untyped-call]
+    model.eval()  # type: ignore[no-untyped-call]
+    return tokenizer, model
@@ -0,0 +1,87 @@
+import os
+from tempfile import TemporaryDirectory
+
+import pytest
+import torch
+from beartype.typing import Any
+
+from research_town.utils.ann_index import IVFIndex
+from research_town.utils.embed_matrix import EmbedMatrix
+
+
+def make_matrix(size: int = 2000, dim: int = 16) -> EmbedMatrix:
+    torch.manual_seed(0)
+    centers = torch.randn(20, dim)
+    embeds = centers[torch.randint(0, 20, (size,))] + 0.3 * torch.randn(size, dim)
+    matrix = EmbedMatrix()
+    matrix.add_many([str(i) for i in range(size)], embeds)
+    return matrix
+
+
+def recall(matrix: EmbedMatrix, queries: torch.Tensor, **search_params: Any) -> float:
+    exact = matrix.search(queries, 10, exact=True)
+    approx = matrix.search(queries, 10, **search_params)
+    hits = sum(
+        len({pk for pk, _ in a} & {pk for pk, _ in e}) for a, e in zip(approx, exact)
+    )
+    return hits / (10 * len(queries))
+
+
+def test_ivf_index_search() -> None:
+    matrix = make_matrix()
+    queries = torch.randn(20, 16)
+    matrix.build_index(IVFIndex(nlist=32, nprobe=4, exact_threshold=0))
+    assert matrix.index is not None
+    assert recall(matrix, queries, nprobe=32) == 1.0
+    assert recall(matrix, queries) >= 0.8
+
+    # filtered searches only return candidates
+    candidates = [str(i) for i in range(0, 2000, 3)]
+    results = matrix.search(queries, 10, candidates, nprobe=32)
+    exact = matrix.search(queries, 10, candidates, exact=True)
+    assert [[pk for pk, _ in r] for r in results] == [
+        [pk for pk, _ in r] for r in exact
+    ]
+
+    # small candidate sets take the exact path
+    matrix.index.exact_threshold = 100
+    assert matrix.search(queries[:1], 10, ['1', '2']) == matrix.search(
+        queries[:1], 10, ['1', '2'], exact=True
+    )
+
+
+def test_ivf_index_incremental() -> None:
+    matrix = make_matrix()
+    queries = torch.randn(20, 16)
+    matrix.build_index(IVFIndex(nlist=32, exact_threshold=0))
+    assert matrix.index is not None
+
+    matrix.add_many(['new', '0'], torch.randn(2, 16))
+    for pk in ['5', '1999', 'new']:
+        del matrix[pk]
+    matrix['latest'] = queries[0]
+    index = matrix.index
+    assert isinstance(index, IVFIndex)
+    indexed_rows = sorted(row for rows in index.lists for row in rows.tolist())
+    assert indexed_rows == list(range(len(matrix)))
+    assert matrix.search(queries[:1], 1, nprobe=32)[0][0][0] == 'latest'
+    assert recall(matrix, queries, nprobe=32) == 1.0
+
+    with TemporaryDirectory() as temp_dir:
+        index_path = os.path.join(temp_dir, 'index.npz')
+        matrix.save_index(index_path)
+        del matrix['10']
+        matrix['later'] = queries[1]
+        restored = EmbedMatrix()
+        restored.add_many(list(matrix), torch.cat([matrix[pk] for pk in matrix], 0))
+        restored.load_index(index_path)
+    assert restored.index is not None
+    assert recall(restored, queries, nprobe=32) == 1.0
+    assert restored.search(queries[1:2], 1, nprobe=32)[0][0][0] == 'later'
+
+
+def test_ivf_index_empty() -> None:
+    matrix = EmbedMatrix()
+    with pytest.raises(ValueError):
+        matrix.build_index(IVFIndex())
+    assert matrix.index is None
@@ -0,0 +1,76 @@
+import pytest
+
+from research_town.data import Paper
+from research_town.dbs import PaperDB
+from research_town.utils.bm25 import BM25Index, tokenize
+from tests.mocks.mocking_func import mock_retriever
+
+
+def test_bm25_index() -> None:
+    assert tokenize('Graph-based GNNs, 2024!') == ['graph', 'based', 'gnns', '2024']
+    index = BM25Index()
+    index.add('a', 'graph neural networks for molecules')
+    index.add('b', 'large language models')
+    index.add('c', 'graph transformers and graph neural networks')
+    assert len(index) == 3
+
+    results = index.search('graph networks', 5)
+    # the document that repeats the rare term ranks first, 'b' does not match
+    assert [pk for pk, _ in results] == ['c', 'a']
+    assert results[0][1] > results[1][1] > 0
+    assert [pk for pk, _ in index.search('graph', 1)] == ['c']
+    assert [pk for pk, _ in index.search('graph', 5, candidate_pks=['a', 'b'])] == ['a']
+    assert index.search('unknown words', 5) == []
+
+    # updates and removals are reflected without a rebuild
+    index.add('b', 'graph language models')
+    index.remove('c')
+    assert 'c' not in index
+    assert {pk for pk, _ in index.search('graph', 5)} == {'a', 'b'}
+    assert index.search('transformers', 5) == []
+
+
+def test_bm25_index_compaction() -> None:
+    index = BM25Index()
+    for i in range(3000):
+        index.add(str(i), f'common term{i}')
+    for i in range(2000):
+        index.remove(str(i))
+    # more than half of the documents were dead, so postings were compacted
+    assert len(index.doc_pks) < 3000
+    assert len(index) == 1000
+    assert [pk for pk, _ in index.search('term2500', 5)] == ['2500']
+    assert len(index.search('common', 2000)) == 1000
+
+
+def test_paper_match_hybrid() -> None:
+    db = PaperDB()
+    db.retriever_tokenizer, db.retriever_model = mock_retriever()
+    with pytest.raises(ValueError):
+        db.set_match_mode('sparse')
+    db.set_match_mode('hybrid', candidate_num=2)
+    for title, abstract, domain in [
+        ('gnn', 'graph neural networks for data', 'ml'),
+        ('vision', 'machine learning in vision', 'cv'),
+        ('survey', 'a survey of graph learning', 'ml'),
+        ('nlp', 'nlp for the expert', 'nlp'),
+    ]:
+        db.add(Paper(title=title, abstract=abstract, domain=domain))
+
+    matched = db.match('graph networks', num=2)
+    assert {paper.title for paper in matched} == {'gnn', 'survey'}
+    assert [paper.title for paper in db.match('graph', num=2, domain='ml')] != []
+    assert all(
+        paper.domain == 'ml' for paper in db.match('graph vision', num=2, domain='ml')
+    )
+    # too few term matches fall back to a dense ranking of the whole corpus
+    assert len(db.match('transformers', num=3)) == 3
+
+    # the lexical index follows updates and deletes
+    vision = db.get(title='vision')[0]
+    db.update(vision.pk, {'abstract': 'graph networks in vision'})
+    db.delete(db.get(title='survey')[0].pk)
+    assert {paper.title for paper in db.match('graph networks', num=2)} == {
+        'gnn',
+        'vision',
+    }
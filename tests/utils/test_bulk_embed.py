@@ -0,0 +1,112 @@
+from tempfile import TemporaryDirectory
+
+import torch
+
+from research_town.data import Paper
+from research_town.dbs import PaperDB
+from research_town.utils.bulk_embed import bulk_embed
+from research_town.utils.embed_cache import EmbedCache
+from research_town.utils.retriever import (
+    FastRetrieverModel,
+    HashingBackend,
+    get_embed_batch,
+    get_embed_model_key,
+    get_embed_settings,
+    get_retriever,
+    get_retriever_key,
+    get_retriever_stats,
+)
+from tests.mocks.mocking_func import mock_retriever
+
+
+def test_bulk_embed() -> None:
+    texts = [f'graph neural networks for {word}' for word in ['ai', 'nlp', 'vision']]
+    texts += ['machine learning', 'data', 'the survey', 'graph']
+    with TemporaryDirectory() as model_dir, TemporaryDirectory() as cache_dir:
+        # workers are separate processes and load the model from disk
+        tokenizer, model = mock_retriever()
+        tokenizer.save_pretrained(model_dir)
+        model.save_pretrained(model_dir)
+
+        stats = bulk_embed(
+            texts[:4], cache_dir, model_name=model_dir, num_workers=2, chunk_size=1
+        )
+        assert sum(worker['embedded'] for worker in stats.values()) == 4
+        assert all(worker['texts_per_sec'] > 0 for worker in stats.values())
+        # only the workers load the model
+        assert model_dir not in get_retriever_stats()
+
+        # a resumed run only embeds what is not cached yet
+        stats = bulk_embed(
+            texts, cache_dir, model_name=model_dir, num_workers=2, chunk_size=2
+        )
+        assert sum(worker['embedded'] for worker in stats.values()) == 3
+        assert bulk_embed(texts, cache_dir, model_name=model_dir) == {}
+
+        retriever_tokenizer, retriever_model = get_retriever(model_dir)
+        embed_cache = EmbedCache(cache_dir)
+        cached = embed_cache.get_many(model_dir, get_embed_settings(), texts)
+        expected = get_embed_batch(texts, retriever_tokenizer, retriever_model)
+        for embed, expected_embed in zip(cached, expected):
+            assert embed is not None
+            assert torch.allclose(embed, expected_embed, atol=1e-5)
+
+        # a quantized run fills the entries of the variant the workers load
+        bulk_embed(texts[:1], cache_dir, model_name=model_dir, quantize=True)
+        assert get_retriever_key(model_dir, quantize=True) not in get_retriever_stats()
+        _, quantized_model = get_retriever(model_dir, quantize=True)
+        assert isinstance(quantized_model, FastRetrieverModel)
+        quantized_key = get_embed_model_key(model_dir, quantized_model.variant)
+        assert (
+            embed_cache.get_many(quantized_key, get_embed_settings(), texts[:1])[0]
+            is not None
+        )
+        embed_cache.close()
+
+        db = PaperDB(retriever_model_name=model_dir)
+        for i, text in enumerate(texts):
+            db.add(Paper(title=f'paper {i}', abstract=text))
+        db.bulk_embed(cache_dir, num_workers=1)
+        assert db.embed_cache is not None
+        assert db.embed_cache.misses == 0
+        assert len(db.data_embed) == len(texts)
+        assert db.match(query=texts[0], num=1)[0].abstract == texts[0]
+
+        # a DB caching elsewhere reads the run back instead of embedding again
+        with TemporaryDirectory() as other_dir:
+            other_cache = EmbedCache(other_dir)
+            db = PaperDB(retriever_model_name=model_dir)
+            db.set_embed_cache(other_cache)
+            for i, text in enumerate(texts):
+                db.add(Paper(title=f'paper {i}', abstract=text))
+            assert db.bulk_embed(cache_dir, num_workers=1) == {}
+            assert len(db.data_embed) == len(texts)
+            assert len(other_cache) == 0
+            other_cache.close()
+
+
+def test_bulk_embed_hashing() -> None:
+    texts = [f'graph neural networks for {word}' for word in ['ai', 'nlp', 'vision']]
+    texts += ['machine learning', 'data', 'the survey', 'graph']
+    with TemporaryDirectory() as cache_dir:
+        # workers embed with the idf fitted here, not with a fresh backend
+        retriever_tokenizer, retriever_model = get_retriever('hashing:64')
+        assert isinstance(retriever_model, HashingBackend)
+        retriever_model.fit(texts)
+        stats = bulk_embed(
+            texts, cache_dir, model_name='hashing:64', num_workers=2, chunk_size=2
+        )
+        assert sum(worker['embedded'] for worker in stats.values()) == len(texts)
+        assert bulk_embed(texts, cache_dir, model_name='hashing:64') == {}
+
+        embed_cache = EmbedCache(cache_dir)
+        cached = embed_cache.get_many(
+            get_embed_model_key('hashing:64', retriever_model.variant),
+            get_embed_settings(),
+            texts,
+        )
+        expected = get_embed_batch(texts, retriever_tokenizer, retriever_model)
+        for embed, expected_embed in zip(cached, expected):
+            assert embed is not None
+            assert torch.allclose(embed, expected_embed, atol=1e-6)
+        embed_cache.close()
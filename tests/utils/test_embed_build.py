@@ -0,0 +1,47 @@
+import threading
+
+from research_town.utils.embed_build import EmbedBuild
+
+
+def test_embed_build() -> None:
+    gate = threading.Event()
+
+    def build_fn(build: EmbedBuild) -> None:
+        for _ in build.pks:
+            gate.wait()
+            build.advance(1)
+        assert build.take_stale() == {'d'}
+        build.finish(version=2)
+
+    build = EmbedBuild('hashing', 'float32', ['a', 'b', 'c'], build_fn)
+    build.mark_stale('d')
+    assert not build.wait(timeout=0.05)
+    progress = build.progress()
+    assert progress['state'] == 'running'
+    assert (progress['done'], progress['total']) == (0, 3)
+
+    gate.set()
+    assert build.wait(timeout=10)
+    progress = build.progress()
+    assert progress['state'] == 'done'
+    assert progress['version'] == 2
+    assert progress['done'] == 3
+    assert progress['eta_s'] is None
+    # finished builds collect nothing
+    build.mark_stale('e')
+    assert build.take_stale() == set()
+
+
+def test_embed_build_failure() -> None:
+    def build_fn(build: EmbedBuild) -> None:
+        raise RuntimeError('model not found')
+
+    build = EmbedBuild('missing-model', 'float32', ['a'], build_fn)
+    assert build.wait(timeout=10)
+    assert build.progress()['state'] == 'failed'
+    assert 'model not found' in str(build.error)
+
+    build = EmbedBuild('hashing', 'float32', [], lambda build: None)
+    build.cancel()
+    assert build.cancelled
+    assert build.wait(timeout=10)
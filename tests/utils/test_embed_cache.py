@@ -0,0 +1,151 @@
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
+
+import torch
+from beartype.typing import List
+
+from research_town.data import Profile
+from research_town.dbs import ProfileDB
+from research_town.utils.embed_cache import EmbedCache, QueryEmbedCache
+from research_town.utils.retriever import (
+    FastRetrieverModel,
+    RetrieverModel,
+    get_embed_batch,
+)
+from tests.mocks.mocking_func import mock_retriever
+
+
+def test_embed_cache_basic() -> None:
+    with TemporaryDirectory() as temp_dir:
+        cache = EmbedCache(temp_dir, max_entries=2)
+        embeds = torch.tensor([[1.0, 2.0], [3.0, 4.0]])
+        cache.put_many('model', 'settings', ['text 1', 'text 2'], embeds)
+
+        result = cache.get_many('model', 'settings', ['text 1', 'text 3'])
+        assert result[0] is not None
+        assert torch.equal(result[0], embeds[0])
+        assert result[1] is None
+        assert cache.hits == 1
+        assert cache.misses == 1
+
+        # 'text 2' is now the least recently used entry and gets evicted
+        cache.put_many('model', 'settings', ['text 3'], torch.tensor([[5.0, 6.0]]))
+        assert len(cache) == 2
+        assert cache.get_many('model', 'settings', ['text 2']) == [None]
+
+        # entries survive reopening the cache
+        cache.close()
+        cache = EmbedCache(temp_dir, max_entries=2)
+        assert cache.get_many('model', 'settings', ['text 1'])[0] is not None
+
+        # changing the settings of a model invalidates its entries
+        assert cache.get_many('model', 'new settings', ['text 1']) == [None]
+        assert cache.get_many('model', 'settings', ['text 1']) == [None]
+        cache.close()
+
+
+def test_get_embed_batch_with_cache() -> None:
+    retriever_tokenizer, retriever_model = mock_retriever()
+    instructions = ['machine learning', 'graph neural networks']
+    with TemporaryDirectory() as temp_dir:
+        cache = EmbedCache(temp_dir)
+        expected = get_embed_batch(instructions, retriever_tokenizer, retriever_model)
+        cached = get_embed_batch(
+            instructions, retriever_tokenizer, retriever_model, embed_cache=cache
+        )
+        assert torch.allclose(cached, expected)
+
+        with patch.object(
+            retriever_model, 'forward', wraps=retriever_model.forward
+        ) as mock_forward:
+            result = get_embed_batch(
+                instructions + ['nlp'],
+                retriever_tokenizer,
+                retriever_model,
+                embed_cache=cache,
+            )
+            # only the uncached text runs through the model
+            assert mock_forward.call_count == 1
+            assert mock_forward.call_args.kwargs['input_ids'].shape[0] == 1
+        assert torch.allclose(result[:2], expected)
+        cache.close()
+
+
+def test_embed_cache_variants() -> None:
+    retriever_tokenizer, retriever_model = mock_retriever()
+    fast_model = FastRetrieverModel(retriever_model, quantize=True)
+    instructions = ['machine learning', 'graph neural networks']
+    with TemporaryDirectory() as temp_dir:
+        cache = EmbedCache(temp_dir)
+        get_embed_batch(
+            instructions, retriever_tokenizer, retriever_model, embed_cache=cache
+        )
+        get_embed_batch(
+            instructions, retriever_tokenizer, fast_model, embed_cache=cache
+        )
+        assert len(cache) == 4
+        # fp32 and int8 entries of the same model are kept side by side
+        models: List[RetrieverModel] = [retriever_model, fast_model]
+        for model in models:
+            hits = cache.hits
+            get_embed_batch(instructions, retriever_tokenizer, model, embed_cache=cache)
+            assert cache.hits == hits + 2
+        cache.close()
+
+
+def test_query_embed_cache() -> None:
+    cache = QueryEmbedCache(max_entries=2)
+    cache.put_many('model', 'settings', ['a', 'b'], torch.tensor([[1.0], [2.0]]))
+    assert cache.get_many('model', 'settings', ['a'])[0] is not None
+    # 'b' is now the least recently used entry and gets evicted
+    cache.put_many('model', 'settings', ['c'], torch.tensor([[3.0]]))
+    assert len(cache) == 2
+    assert cache.get_many('model', 'settings', ['b', 'c'])[0] is None
+    assert cache.get_many('other model', 'settings', ['a']) == [None]
+    assert (cache.hits, cache.misses) == (2, 2)
+
+    db = ProfileDB()
+    db.retriever_tokenizer, db.retriever_model = mock_retriever()
+    db.set_query_cache(cache)
+    db.add(Profile(name='A', bio='graph neural networks'))
+    db.add(Profile(name='B', bio='nlp expert'))
+    with patch.object(
+        db.retriever_model, 'forward', wraps=db.retriever_model.forward
+    ) as mock_forward:
+        first = db.match('machine learning', role='reviewer', num=2)
+        forward_num = mock_forward.call_count
+        hits = cache.hits
+        assert db.match('machine learning', role='reviewer', num=2) == first
+        # the repeated query is served from the cache
+        assert mock_forward.call_count == forward_num
+        assert cache.hits == hits + 1
+
+
+def test_embed_cache_token_ids() -> None:
+    retriever_tokenizer, retriever_model = mock_retriever()
+    instructions = ['machine learning', 'graph neural networks']
+    with TemporaryDirectory() as temp_dir:
+        cache = EmbedCache(temp_dir, max_entries=2, cache_token_ids=True)
+        cache.put_token_ids_many('tokenizer', ['text 1'], [[101, 7, 102]])
+        assert cache.get_token_ids_many('tokenizer', ['text 1', 'text 2']) == [
+            [101, 7, 102],
+            None,
+        ]
+        assert cache.get_token_ids_many('other', ['text 1']) == [None]
+        cache.clear()
+
+        expected = get_embed_batch(instructions, retriever_tokenizer, retriever_model)
+        get_embed_batch(
+            instructions, retriever_tokenizer, retriever_model, embed_cache=cache
+        )
+        # a quantized model misses the embeddings but reuses the token ids
+        fast_model = FastRetrieverModel(retriever_model, quantize=True)
+        with patch.object(
+            type(retriever_tokenizer), '__call__', side_effect=AssertionError
+        ):
+            result = get_embed_batch(
+                instructions, retriever_tokenizer, fast_model, embed_cache=cache
+            )
+        assert cache.misses == 4
+        assert torch.nn.functional.cosine_similarity(result, expected).min() > 0.99
+        cache.close()
@@ -0,0 +1,191 @@
+import pickle
+
+import pytest
+import torch
+
+from research_town.utils.ann_index import IVFIndex
+from research_town.utils.embed_matrix import EmbedMatrix
+
+
+def test_embed_matrix_mapping() -> None:
+    matrix = EmbedMatrix(initial_capacity=2)
+    matrix.add_many(['a', 'b', 'c'], torch.tensor([[3.0, 4.0], [0.0, 2.0], [1.0, 0.0]]))
+    assert len(matrix) == 3
+    assert matrix.capacity >= 3
+    assert torch.allclose(matrix['a'], torch.tensor([[0.6, 0.8]]))
+
+    # overwriting keeps the row, deleting moves the last row into the hole
+    matrix['b'] = torch.tensor([[2.0, 0.0]])
+    assert torch.equal(matrix['b'], torch.tensor([[1.0, 0.0]]))
+    del matrix['a']
+    assert list(matrix) == ['c', 'b']
+    assert 'a' not in matrix
+    assert torch.equal(matrix['c'], torch.tensor([[1.0, 0.0]]))
+
+    with pytest.raises(ValueError):
+        matrix.add_many(['d'], torch.ones(1, 3))
+
+    # unit vectors survive a save/load round trip unchanged
+    restored = EmbedMatrix()
+    saved = pickle.loads(pickle.dumps(dict(matrix.items())))
+    restored.add_many(saved.keys(), torch.cat(list(saved.values()), 0))
+    for pk in matrix:
+        assert torch.equal(matrix[pk], restored[pk])
+
+
+def test_embed_matrix_search() -> None:
+    matrix = EmbedMatrix()
+    assert matrix.search(torch.ones(1, 2), 3) == [[]]
+    matrix.add_many(
+        ['x', 'y', 'xy'], torch.tensor([[1.0, 0.0], [0.0, 1.0], [1.0, 1.0]])
+    )
+    results = matrix.search(torch.tensor([[2.0, 0.1], [0.0, 1.0]]), 2)
+    assert [pk for pk, _ in results[0]] == ['x', 'xy']
+    assert [pk for pk, _ in results[1]] == ['y', 'xy']
+    assert results[1][0][1] == pytest.approx(1.0)
+
+    # candidates restrict the search and num is clamped to their count
+    results = matrix.search(torch.tensor([[1.0, 0.0]]), 5, candidate_pks=['y', 'xy'])
+    assert [pk for pk, _ in results[0]] == ['xy', 'y']
+    assert matrix.search(torch.tensor([[1.0, 0.0]]), 5, candidate_pks=[]) == [[]]
+
+
+def test_embed_matrix_mapped_rows() -> None:
+    torch.manual_seed(0)
+    pks = [f'pk{i}' for i in range(200)]
+    base = EmbedMatrix.normalize(torch.randn(200, 16))
+    base_copy = base.clone()
+    matrix = EmbedMatrix.from_normalized(pks, base)
+    matrix.set_columns(pks, {'flag': [i % 2 == 0 for i in range(200)]})
+
+    # inserts, overwrites and deletes leave the mapped rows untouched
+    matrix.add_many(['new0', 'new1'], torch.randn(2, 16))
+    matrix['pk0'] = torch.randn(16)
+    del matrix['pk1']
+    del matrix['new0']
+    assert matrix.base is base
+    assert torch.equal(base, base_copy)
+    assert matrix.matrix is not None
+    assert matrix.matrix.shape[0] == matrix.initial_capacity
+    assert len(matrix) == 200
+    assert list(matrix)[:2] == ['pk2', 'pk3']
+    assert set(matrix) == set(pks[2:]) | {'pk0', 'new1'}
+    assert matrix.mask({'flag': True})[matrix.rows['pk0']]
+
+    # the mapped base and the delta are searched as one matrix
+    heap = EmbedMatrix()
+    heap.add_many(list(matrix), matrix.embeds())
+    queries = torch.randn(4, 16)
+    expected = heap.search(queries, 10)
+    assert matrix.search(queries, 10) == expected
+    assert matrix.search(queries, 10, candidate_pks=['pk0', 'pk1', 'pk2']) == (
+        heap.search(queries, 10, candidate_pks=['pk0', 'pk2'])
+    )
+    matrix.build_index(IVFIndex(nlist=4, nprobe=4, exact_threshold=0))
+    assert [[pk for pk, _ in r] for r in matrix.search(queries, 10)] == [
+        [pk for pk, _ in r] for r in expected
+    ]
+    matrix.set_storage('int8')
+    assert [[pk for pk, _ in r] for r in matrix.search(queries, 10, exact=True)] == [
+        [pk for pk, _ in r] for r in expected
+    ]
+
+    # rewriting the file merges the delta in iteration order
+    blocks = list(matrix.blocks(64))
+    assert sum((block_pks for block_pks, _ in blocks), []) == list(matrix)
+    assert torch.equal(torch.cat([embeds for _, embeds in blocks]), heap.embeds())
+
+
+def test_embed_matrix_quantized_storage() -> None:
+    torch.manual_seed(0)
+    embeds = torch.randn(300, 32)
+    queries = torch.randn(5, 32)
+    pks = [str(i) for i in range(300)]
+    exact = EmbedMatrix()
+    exact.add_many(pks, embeds)
+    expected = exact.search(queries, 10)
+
+    for storage in ['float16', 'int8']:
+        matrix = EmbedMatrix(initial_capacity=16)
+        matrix.set_storage(storage)
+        # codes follow growth, overwrites and swap-deletes
+        matrix.add_many(pks + ['extra'], torch.cat([embeds, torch.randn(1, 32)], 0))
+        matrix['0'] = embeds[0]
+        del matrix['extra']
+        results = matrix.search(queries, 10)
+        # rescored in float32, so ranks and scores match the exact search
+        assert [[pk for pk, _ in r] for r in results] == [
+            [pk for pk, _ in r] for r in expected
+        ]
+        assert results[0][0][1] == pytest.approx(expected[0][0][1], abs=1e-6)
+        assert matrix.search(queries[:1], 3, candidate_pks=[]) == [[]]
+        # only the codes stay on the heap, the float32 rows are spilled to a file
+        assert torch.equal(matrix['299'], exact['299'])
+        usage = matrix.memory_usage()
+        assert usage['float32'] == 0
+        assert usage['codes'] < usage['file']
+
+    # switching an existing matrix to int8 builds the codes from its rows
+    assert exact.memory_usage()['float32'] == exact.capacity * 32 * 4
+    exact.set_storage('int8')
+    assert exact.memory_usage() == {
+        'float32': 0,
+        'codes': exact.capacity * (32 + 4),
+        'file': exact.capacity * 32 * 4,
+    }
+    assert [[pk for pk, _ in r] for r in exact.search(queries, 10)] == [
+        [pk for pk, _ in r] for r in expected
+    ]
+    with pytest.raises(ValueError):
+        exact.set_storage('int4')
+    exact.set_storage('float32')
+    assert exact.memory_usage()['file'] == 0
+    assert [[pk for pk, _ in r] for r in exact.search(queries, 10)] == [
+        [pk for pk, _ in r] for r in expected
+    ]
+
+
+def test_embed_matrix_filter_columns() -> None:
+    torch.manual_seed(0)
+    pks = [f'pk{i}' for i in range(50)]
+    embeds = torch.randn(50, 8)
+    domains = [['nlp', 'cv', None][i % 3] for i in range(50)]
+    flags = [i % 2 == 0 for i in range(50)]
+    queries = torch.randn(4, 8)
+    for storage in ['float32', 'int8']:
+        matrix = EmbedMatrix(initial_capacity=4)
+        matrix.set_storage(storage)
+        matrix.add_many(pks, embeds)
+        matrix.set_columns(pks, {'domain': domains, 'flag': flags})
+        assert matrix.has_columns(['domain', 'flag'])
+        assert not matrix.has_columns(['title'])
+
+        # a masked search returns the same as searching the matching pks
+        conditions = {'domain': 'nlp', 'flag': True}
+        candidate_pks = [
+            pk
+            for pk, domain, flag in zip(pks, domains, flags)
+            if domain == 'nlp' and flag
+        ]
+        assert int(matrix.mask(conditions).sum()) == len(candidate_pks)
+        masked = matrix.search(queries, 20, conditions=conditions)
+        expected = matrix.search(queries, 20, candidate_pks=candidate_pks)
+        for result, expected_result in zip(masked, expected):
+            assert [pk for pk, _ in result] == [pk for pk, _ in expected_result]
+            assert [score for _, score in result] == pytest.approx(
+                [score for _, score in expected_result], abs=1e-5
+            )
+        assert matrix.search(queries, 3, conditions={'domain': 'math'}) == [[]] * 4
+        with pytest.raises(ValueError):
+            matrix.mask({'title': 'x'})
+
+        # columns follow rows through swap-deletes and reused slots
+        del matrix['pk0']
+        matrix.add_many(['new'], torch.randn(1, 8))
+        assert not matrix.mask({'domain': 'nlp'})[matrix.rows['new']]
+        matrix.set_columns(
+            ['new', 'pk3'], {'domain': ['cv', 'cv'], 'flag': [True, True]}
+        )
+        results = matrix.search(queries, 50, conditions={'domain': 'cv', 'flag': True})
+        assert all(pk in {'new', 'pk3'} or flags[int(pk[2:])] for pk, _ in results[0])
+        assert {'new', 'pk3'} <= {pk for pk, _ in results[0]}
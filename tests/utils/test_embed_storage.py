@@ -0,0 +1,103 @@
+import os
+from tempfile import TemporaryDirectory
+
+import numpy as np
+import pytest
+from beartype.typing import Iterator, List, Tuple
+from numpy.typing import NDArray
+
+from research_town.utils.embed_storage import (
+    embed_file_exists,
+    load_embed_file,
+    remove_embed_file,
+    rewrite_embed_file,
+    save_embed_file,
+    search_embed_file,
+    write_embed_file,
+)
+
+
+def test_embed_file_round_trip() -> None:
+    embeds = np.random.default_rng(0).standard_normal((5, 4)).astype(np.float32)
+    with TemporaryDirectory() as temp_dir:
+        prefix = os.path.join(temp_dir, 'PaperDB')
+        assert not embed_file_exists(prefix)
+        save_embed_file(prefix, ['a', 'b', 'c', 'd', 'e'], embeds)
+        assert embed_file_exists(prefix)
+
+        pks, loaded = load_embed_file(prefix)
+        assert pks == ['a', 'b', 'c', 'd', 'e']
+        assert isinstance(loaded, np.memmap)
+        np.testing.assert_array_equal(loaded, embeds)
+
+        # writes to a copy-on-write mapping never reach the file
+        loaded[0] = 0
+        _, reloaded = load_embed_file(prefix)
+        np.testing.assert_array_equal(reloaded, embeds)
+
+        save_embed_file(prefix, [], np.empty((0, 4), dtype=np.float32))
+        pks, loaded = load_embed_file(prefix)
+        assert pks == [] and loaded.shape == (0, 4)
+
+        with pytest.raises(ValueError):
+            save_embed_file(prefix, ['a'], embeds)
+
+
+def test_search_embed_file() -> None:
+    embeds = np.random.default_rng(0).standard_normal((1000, 8)).astype(np.float32)
+    embeds /= np.linalg.norm(embeds, axis=1, keepdims=True)
+    queries = embeds[:3]
+    with TemporaryDirectory() as temp_dir:
+        prefix = os.path.join(temp_dir, 'PaperDB')
+        save_embed_file(prefix, [str(i) for i in range(1000)], embeds)
+
+        scores = queries @ embeds.T
+        results = search_embed_file(prefix, 8, queries, 5, block_size=64, num_threads=3)
+        expected = np.argsort(-scores, axis=1)[:, :5]
+        assert [[row for row, _ in result] for result in results] == expected.tolist()
+        assert results[0][0][1] == pytest.approx(1.0, abs=1e-5)
+
+        # blocks without selected rows are skipped
+        for row_mask in [np.arange(1000) % 2 == 1, np.arange(1000) % 100 == 1]:
+            results = search_embed_file(
+                prefix, 8, queries, 5, row_mask=row_mask, block_size=64
+            )
+            masked = np.where(row_mask, scores, -np.inf)
+            expected = np.argsort(-masked, axis=1)[:, : min(5, row_mask.sum())]
+            assert [
+                [row for row, _ in result] for result in results
+            ] == expected.tolist()
+
+        pks = rewrite_embed_file(
+            prefix, prefix, np.arange(1000) < 2, ['x'], embeds[5:6], block_size=64
+        )
+        assert pks == ['0', '1', 'x']
+        _, loaded = load_embed_file(prefix)
+        np.testing.assert_array_equal(loaded, embeds[[0, 1, 5]])
+
+
+def test_write_embed_file() -> None:
+    embeds = np.random.default_rng(0).standard_normal((5, 4)).astype(np.float32)
+    with TemporaryDirectory() as temp_dir:
+        prefix = os.path.join(temp_dir, 'PaperDB.v1')
+        blocks = [(['a', 'b'], embeds[:2]), ([], embeds[:0]), (['c'], embeds[2:3])]
+        assert write_embed_file(prefix, iter(blocks)) == ['a', 'b', 'c']
+        pks, loaded = load_embed_file(prefix)
+        assert pks == ['a', 'b', 'c']
+        np.testing.assert_array_equal(loaded, embeds[:3])
+
+        # a failed write leaves the previous files as they were
+        def failing_blocks() -> Iterator[Tuple[List[str], NDArray[np.float32]]]:
+            yield ['d'], embeds[3:4]
+            raise RuntimeError('cancelled')
+
+        with pytest.raises(RuntimeError):
+            write_embed_file(prefix, failing_blocks())
+        assert load_embed_file(prefix)[0] == ['a', 'b', 'c']
+        assert sorted(os.listdir(temp_dir)) == [
+            'PaperDB.v1.embeds.bin',
+            'PaperDB.v1.embeds.json',
+        ]
+
+        remove_embed_file(prefix)
+        assert not embed_file_exists(prefix)
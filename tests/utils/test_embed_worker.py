@@ -0,0 +1,42 @@
+import threading
+
+import torch
+from beartype.typing import List, Tuple
+
+from research_town.utils.embed_worker import EmbedWorker
+
+
+def test_embed_worker() -> None:
+    gate = threading.Event()
+    batches: List[Tuple[List[str], List[str]]] = []
+
+    def embed_fn(texts: List[str]) -> torch.Tensor:
+        gate.wait()
+        if 'broken' in texts:
+            raise RuntimeError('embedding failed')
+        return torch.ones(len(texts), 4)
+
+    def on_embedded(pks: List[str], texts: List[str], embeds: torch.Tensor) -> None:
+        assert embeds.shape == (len(texts), 4)
+        batches.append((pks, texts))
+
+    worker = EmbedWorker(embed_fn, on_embedded, batch_size=8)
+    worker.submit('a', 'first')
+    worker.submit('b', 'second')
+    # a newer text replaces the queued one
+    worker.submit('b', 'second, edited')
+    assert worker.pending_pks() == {'a', 'b'}
+    assert not worker.wait(timeout=0.05)
+
+    gate.set()
+    assert worker.wait(timeout=10)
+    assert worker.pending_pks() == set()
+    embedded = {pk: text for pks, texts in batches for pk, text in zip(pks, texts)}
+    assert embedded['b'] == 'second, edited'
+    assert len(batches) <= 2
+
+    # a failed batch is dropped instead of blocking waiters
+    worker.submit('c', 'broken')
+    assert worker.wait(['c'], timeout=10)
+    assert 'c' not in embedded
+    worker.stop()
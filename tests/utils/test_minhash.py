@@ -0,0 +1,42 @@
+from research_town.utils.minhash import MinHashLSH, get_shingles
+
+ABSTRACT = (
+    'We propose a graph neural network for molecular property prediction that '
+    'combines message passing with attention over substructures and reaches '
+    'state of the art results on several benchmarks while using fewer parameters.'
+)
+
+
+def test_get_shingles() -> None:
+    assert len(get_shingles('a b c d')) == 2
+    assert len(get_shingles('one')) == 1
+    assert len(get_shingles(' ,. ')) == 0
+    # case, punctuation and whitespace do not matter
+    assert (
+        get_shingles('Graph  neural, Networks!')
+        == get_shingles('graph neural networks')
+    ).all()
+
+
+def test_minhash_lsh() -> None:
+    index = MinHashLSH(threshold=0.7)
+    index.add('a', 'Graph Networks ' + ABSTRACT)
+    index.add('b', 'Language Models Are Few-Shot Learners. We train a large model.')
+    index.add('c', '')
+    assert len(index) == 2
+    assert 'c' not in index
+
+    # another version of the same paper with a small edit
+    edited = ABSTRACT.replace('several benchmarks', 'six benchmarks')
+    duplicate = index.find_duplicate('graph networks  ' + edited.upper())
+    assert duplicate is not None
+    assert duplicate[0] == 'a'
+    assert 0.7 <= duplicate[1] < 1
+    assert (
+        index.find_duplicate('A survey of reinforcement learning for robotics') is None
+    )
+
+    index.remove('a')
+    index.remove('missing')
+    assert index.find_duplicate('Graph Networks ' + ABSTRACT) is None
+    assert not any('a' in pks for buckets in index.buckets for pks in buckets.values())
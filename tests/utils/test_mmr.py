@@ -0,0 +1,33 @@
+import pytest
+import torch
+
+from research_town.utils.mmr import mmr_rerank
+
+
+def test_mmr_rerank() -> None:
+    query_embeds = torch.tensor([[1.0, 0.0, 0.0], [1.0, 0.0, 0.0]])
+    candidates = torch.tensor(
+        [[1.0, 0.1, 0.0], [1.0, 0.11, 0.0], [0.7, 0.0, 0.7], [0.0, 1.0, 0.0]]
+    )
+    candidate_embeds = candidates.expand(2, -1, -1)
+    candidate_mask = torch.tensor(
+        [[True, True, True, True], [True, True, False, False]]
+    )
+
+    # lambda=1 is the relevance order
+    assert mmr_rerank(query_embeds, candidate_embeds, candidate_mask, 3, 1.0) == [
+        [0, 1, 2],
+        [0, 1],
+    ]
+    # the near-duplicate of the first pick is pushed down, and a query with
+    # fewer candidates than num only gets its own
+    assert mmr_rerank(query_embeds, candidate_embeds, candidate_mask, 3, 0.5) == [
+        [0, 2, 1],
+        [0, 1],
+    ]
+    assert mmr_rerank(query_embeds, candidate_embeds, candidate_mask, 0, 0.5) == [
+        [],
+        [],
+    ]
+    with pytest.raises(ValueError):
+        mmr_rerank(query_embeds, candidate_embeds, candidate_mask, 3, 1.5)
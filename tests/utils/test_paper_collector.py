@@ -4,6 +4,7 @@ from unittest.mock import MagicMock, patch
 from research_town.utils.paper_collector import (
     get_paper_content_from_html,
     get_paper_introduction,
+    get_paper_key,
     get_recent_papers,
     get_related_papers,
 )
@@ -106,3 +107,19 @@ def test_get_paper_introduction() -> None:
     assert 'Introduction' in intro1
     assert 'Introduction' in intro2
     assert 'Introduction' in intro3
+
+
+def test_get_paper_key() -> None:
+    key = 'arxiv:2401.01234'
+    assert get_paper_key('http://arxiv.org/abs/2401.01234v2') == key
+    assert get_paper_key('https://arxiv.org/pdf/2401.01234v1.pdf') == key
+    assert get_paper_key('https://www.arxiv.org/html/2401.01234') == key
+    assert get_paper_key('arXiv:2401.01234v3') == key
+    assert get_paper_key('http://arxiv.org/abs/hep-th/9901001v1') == (
+        'arxiv:hep-th/9901001'
+    )
+    assert get_paper_key('https://Example.com/Paper/1/?a=b') == (
+        'url:example.com/Paper/1'
+    )
+    assert get_paper_key('') is None
+    assert get_paper_key(None) is None
@@ -0,0 +1,118 @@
+import pytest
+import torch
+
+from research_town.data import Paper
+from research_town.dbs import PaperDB
+from research_town.utils.passage_index import PassageIndex, chunk_text
+from tests.mocks.mocking_func import mock_retriever
+
+
+def test_chunk_text() -> None:
+    text = ' '.join(f'w{i}' for i in range(10))
+    spans = chunk_text(text, window=4, stride=3)
+    assert [text[start:end] for start, end in spans] == [
+        'w0 w1 w2 w3',
+        'w3 w4 w5 w6',
+        'w6 w7 w8 w9',
+    ]
+    assert chunk_text('  ') == []
+    assert chunk_text('one two', window=4, stride=3) == [(0, 7)]
+
+
+def test_passage_index_search() -> None:
+    index = PassageIndex(window=4, stride=2)
+    with pytest.raises(ValueError):
+        PassageIndex(window=2, stride=3)
+    sections = {'intro': 'a b c d e f'}
+    passages = index.chunk(sections)
+    assert passages == [('intro', 0, 7), ('intro', 4, 11)]
+    index.add('p1', sections, passages, torch.tensor([[1.0, 0.0], [0.0, 1.0]]))
+    index.add('p2', {'intro': 'x'}, [('intro', 0, 1)], torch.tensor([[1.0, 1.0]]))
+    assert not index.needs_update('p1', sections)
+    assert index.needs_update('p1', {'intro': 'changed'})
+
+    # a paper scores as its best passage
+    results = index.search(torch.tensor([[0.0, 1.0], [1.0, 0.9]]), 2)
+    assert [(pk, round(score, 4)) for pk, score, _ in results[0]] == [
+        ('p1', 1.0),
+        ('p2', 0.7071),
+    ]
+    assert results[0][0][2][0][:3] == ('intro', 4, 11)
+    assert results[1][0][0] == 'p2'
+    assert (
+        index.search(torch.tensor([[0.0, 1.0]]), 2, candidate_paper_pks=['p2'])[0][0][0]
+        == 'p2'
+    )
+
+    index.remove('p1')
+    assert len(index.passage_embed) == 1
+    assert [pk for pk, _, _ in index.search(torch.tensor([[0.0, 1.0]]), 2)[0]] == ['p2']
+
+
+def test_paper_match_passages() -> None:
+    db = PaperDB()
+    db.retriever_tokenizer, db.retriever_model = mock_retriever()
+    db.add(
+        Paper(
+            title='graph',
+            abstract='graph',
+            sections={'intro': 'graph neural networks for data ' * 20},
+        )
+    )
+    db.add(
+        Paper(
+            title='nlp',
+            abstract='nlp',
+            sections={'intro': 'nlp', 'method': 'machine learning in vision'},
+        )
+    )
+    db.add(Paper(title='no sections', abstract='survey'))
+    with pytest.raises(ValueError):
+        db.match_passages('graph neural networks')
+
+    db.build_passage_index(window=16, stride=8)
+    assert db.passage_index is not None
+    assert len(db.passage_index.paper_passages) == 2
+    matches = db.match_passages(
+        'machine learning in vision', num=3, passages_per_paper=2
+    )
+    assert len(matches) == 2
+    for paper, passages in matches:
+        assert 1 <= len(passages) <= 2
+        for passage in passages:
+            assert (
+                passage.text
+                == (paper.sections or {})[passage.section][passage.start : passage.end]
+            )
+    assert matches[0][0].title == 'nlp'
+    assert [
+        paper.title for paper, _ in db.match_passages('nlp', num=3, title='graph')
+    ] == ['graph']
+
+
+def test_paper_match_passages_stale() -> None:
+    db = PaperDB()
+    db.retriever_tokenizer, db.retriever_model = mock_retriever()
+    papers = [
+        Paper(title='graph', abstract='graph', sections={'intro': 'graph networks'}),
+        Paper(title='nlp', abstract='nlp', sections={'intro': 'language models'}),
+    ]
+    for paper in papers:
+        db.add(paper)
+    db.build_passage_index()
+
+    # deleted or changed papers drop out until the next build
+    db.delete(papers[0].pk)
+    db.update(papers[1].pk, {'sections': {'method': 'vision'}})
+    assert db.passage_index is not None
+    assert db.passage_index.fingerprints == {}
+    assert db.match_passages('graph networks', num=2) == []
+
+    db.build_passage_index()
+    matches = db.match_passages('vision', num=2)
+    assert [(paper.pk, passages[0].text) for paper, passages in matches] == [
+        (papers[1].pk, 'vision')
+    ]
+    # sections edited in place are skipped instead of raising
+    (papers[1].sections or {}).clear()
+    assert db.match_passages('vision', num=2) == []
@@ -1,9 +1,23 @@
 from unittest.mock import MagicMock, patch
 
 import torch
-from beartype.typing import Any, Dict
+from beartype.typing import Any, Dict, List
 
-from research_town.utils.retriever import get_embed, rank_topk
+from research_town.utils.retriever import (
+    FastRetrieverModel,
+    check_retriever_parity,
+    get_embed,
+    get_embed_batch,
+    get_embed_stats,
+    get_hashing_backend,
+    get_retriever,
+    get_retriever_stats,
+    rank_topk,
+    reset_embed_stats,
+    tokenize_batch,
+    warmup_retriever,
+)
+from tests.mocks.mocking_func import mock_retriever
 
 
 def test_get_embed() -> None:
@@ -15,14 +29,17 @@ def test_get_embed() -> None:
         mock_tokenizer_instance = MagicMock()
         mock_tokenizer.return_value = mock_tokenizer_instance
 
-        def mock_tokenize(*args: Any, **kwargs: Any) -> Dict[str, torch.Tensor]:
+        def mock_tokenize(
+            texts: List[str], *args: Any, **kwargs: Any
+        ) -> Dict[str, List[List[int]]]:
             return {
                 # Example token IDs
-                'input_ids': torch.tensor([[101, 102, 103]]),
-                'attention_mask': torch.tensor([[1, 1, 1]]),
+                'input_ids': [[101, 102, 103] for _ in texts],
+                'attention_mask': [[1, 1, 1] for _ in texts],
             }
 
         mock_tokenizer_instance.side_effect = mock_tokenize
+        mock_tokenizer_instance.pad_token_id = 0
 
         # Mock model instance
         mock_model_instance = MagicMock()
@@ -67,9 +84,142 @@ def test_get_embed() -> None:
         assert all(torch.equal(t1, t2) for t1, t2 in zip(result_1, result_2))
 
 
+def test_get_embed_batch() -> None:
+    retriever_tokenizer, retriever_model = mock_retriever()
+    instructions = [
+        'a survey of graph neural networks',
+        'machine learning',
+        'this paper is a survey of the data for machine learning in vision',
+        'nlp',
+        'expert in ai',
+    ]
+    result = get_embed_batch(
+        instructions,
+        retriever_tokenizer=retriever_tokenizer,
+        retriever_model=retriever_model,
+        batch_size=2,
+    )
+    assert result.shape == (5, 16)
+
+    # padded batches must pool to the same vectors as unpadded single texts
+    for instruction, embed in zip(instructions, result):
+        encoded_input = retriever_tokenizer(instruction, return_tensors='pt')
+        with torch.no_grad():
+            single = retriever_model(**encoded_input)['last_hidden_state'].mean(1)
+        assert torch.allclose(embed, single[0], atol=1e-5)
+
+    empty = get_embed_batch(
+        [], retriever_tokenizer=retriever_tokenizer, retriever_model=retriever_model
+    )
+    assert empty.shape == (0, 16)
+
+
 def test_rank_topk() -> None:
     query_embed = [torch.tensor([[1.0, 2.0, 3.0]])]
     corpus_embed = [torch.tensor([[1.0, 2.0, 3.0], [4.0, 5.0, 6.0]])]
     num = 1
     result = rank_topk(query_embed, corpus_embed, num)
     assert result == [[0]]
+
+
+def test_get_retriever() -> None:
+    with (
+        patch(
+            'research_town.utils.retriever.AutoTokenizer.from_pretrained'
+        ) as mock_tokenizer,
+        patch('research_town.utils.retriever.BertModel.from_pretrained') as mock_model,
+    ):
+        mock_tokenizer.return_value = MagicMock()
+        mock_model.return_value = MagicMock()
+
+        thread = warmup_retriever('mock/retriever', background=True)
+        assert thread is not None
+        thread.join()
+        tokenizer, model = get_retriever('mock/retriever')
+        assert get_retriever('mock/retriever') == (tokenizer, model)
+        assert mock_tokenizer.call_count == 1
+        assert mock_model.call_count == 1
+
+        stats = get_retriever_stats()['mock/retriever']
+        assert stats['load_time'] >= 0
+        assert 'rss_mb' in stats
+
+
+def test_fast_retriever_model() -> None:
+    retriever_tokenizer, retriever_model = mock_retriever()
+    instructions = ['graph neural networks', 'a survey of machine learning in nlp']
+    for quantize, compile_mode in [(True, None), (True, 'trace'), (False, 'trace')]:
+        fast_model = FastRetrieverModel(retriever_model, quantize, compile_mode)
+        parity = check_retriever_parity(
+            instructions, retriever_tokenizer, retriever_model, fast_model
+        )
+        assert parity['min_cosine'] > 0.99
+        assert fast_model.variant == ('dynamic_int8' if quantize else 'fp32')
+
+    with (
+        patch(
+            'research_town.utils.retriever.AutoTokenizer.from_pretrained'
+        ) as mock_tokenizer,
+        patch('research_town.utils.retriever.BertModel.from_pretrained') as mock_model,
+    ):
+        mock_tokenizer.return_value = retriever_tokenizer
+        mock_model.return_value = retriever_model
+        num_threads = torch.get_num_threads()
+        _, model = get_retriever(
+            'mock/fast_retriever', quantize=True, num_threads=num_threads
+        )
+        assert isinstance(model, FastRetrieverModel)
+        assert get_retriever('mock/fast_retriever', quantize=True)[1] is model
+        assert get_retriever('mock/fast_retriever')[1] is retriever_model
+        assert mock_model.call_count == 1
+        stats = get_retriever_stats()['mock/fast_retriever[int8]']
+        assert stats['min_cosine'] > 0.99
+
+
+def test_tokenize_batch_stats() -> None:
+    retriever_tokenizer, retriever_model = mock_retriever()
+    instructions = ['graph neural networks', 'nlp']
+    token_ids = tokenize_batch(instructions, retriever_tokenizer, max_length=4)
+    assert token_ids == [
+        retriever_tokenizer(text, truncation=True, max_length=4)['input_ids']
+        for text in instructions
+    ]
+    assert all(len(ids) <= 4 for ids in token_ids)
+
+    reset_embed_stats()
+    get_embed_batch(instructions, retriever_tokenizer, retriever_model)
+    stats = get_embed_stats()
+    # tokenization and the forward pass are timed separately
+    assert stats['texts'] == 2
+    assert stats['tokens'] == sum(
+        len(ids) for ids in tokenize_batch(instructions, retriever_tokenizer)
+    )
+    assert stats['tokenize_seconds'] > 0
+    assert stats['model_seconds'] > 0
+
+
+def test_hashing_backend() -> None:
+    tokenizer, model = get_retriever('hashing:256')
+    assert get_retriever('hashing:256') == (tokenizer, model)
+    with patch('research_town.utils.retriever.BertModel.from_pretrained') as mock_model:
+        get_retriever('hashing:256', quantize=True)
+        assert mock_model.call_count == 0
+
+    texts = [
+        'Graph neural networks for molecules',
+        'graph neural networks for molecule property prediction',
+        'Large language models trained on code',
+    ]
+    embeds = get_embed_batch(texts, tokenizer, model)
+    assert embeds.shape == (3, 256)
+    assert torch.allclose(embeds.norm(dim=1), torch.ones(3))
+    similarity = embeds @ embeds.t()
+    assert similarity[0, 1] > similarity[0, 2]
+    assert torch.equal(get_embed(texts[:1], tokenizer, model)[0][0], embeds[0])
+
+    # fitting idf changes the weights and the variant used by embedding caches
+    tokenizer, model = get_hashing_backend('hashing:256')
+    assert model.variant == 'tf'
+    model.fit(texts)
+    assert model.variant.startswith('tfidf-')
+    assert not torch.equal(get_embed_batch(texts, tokenizer, model), embeds)
@@ -0,0 +1,20 @@
+from research_town.utils.timestamp_index import TimestampIndex
+
+
+def test_timestamp_index() -> None:
+    index = TimestampIndex()
+    for pk, timestamp in [('c', 30), ('a', 10), ('b', 20), ('d', 20), ('e', None)]:
+        index.add(pk, timestamp)
+    assert len(index) == 4
+    assert 'e' not in index
+
+    assert index.range() == ['a', 'b', 'd', 'c']
+    assert index.range(before=20) == ['a']
+    assert index.range(after=20) == ['c']
+    assert index.range(before=30, after=10) == ['b', 'd']
+    assert index.range(before=10) == []
+
+    index.add('a', 40)
+    index.remove('b')
+    index.remove('missing')
+    assert index.range(after=15) == ['d', 'c', 'a']